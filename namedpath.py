@@ -1,34 +1,53 @@
 # coding=utf-8
-from __future__ import print_function, absolute_import
+from __future__ import print_function, absolute_import, annotations
 from os.path import join, normpath, exists
-from pathlib import Path
+from array import array
 import os
-import json
-import copy
+import io
+import abc
 import logging
-import getpass
+import collections
+import threading
+import types
+import sys
+import time
 import re
 
 __version__ = '0.2.0'
 
-from typing import Callable
+logger = logging.getLogger(__name__)
+
+_current_user = None
 
 
-def __setup_simple_logger(lg):      # type: (logging.Logger) -> logging.Logger
-    lg.addHandler(logging.StreamHandler())
-    lg.propagate = False
+def setup_logger(lg=None):      # type: (logging.Logger) -> logging.Logger
+    """
+    Add simple stream handler to the module logger.
+    Not called at import, applications configure logging by themselves.
+    """
+    lg = lg or logger
+    if not lg.handlers:
+        lg.addHandler(logging.StreamHandler())
+        lg.propagate = False
     return lg
 
 
-logger = logging.getLogger(__name__)
-if not logger.handlers:
-    logger = __setup_simple_logger(logger)
+def _get_user() -> str:
+    """
+    Current user name, resolved once per process
+    """
+    global _current_user
+    if _current_user is None:
+        import getpass
+        _current_user = getpass.getuser()
+    return _current_user
 
 
 class NamedPath(object):
     """Class provide logic of one single named path"""
     _default_dir_permission = 0o755
     _default_file_permission = 0o644
+    _stats = None
 
     def __init__(self, base_dir: str, name: str, options: dict, scope: dict, **kwargs):
         if 'path' not in options:
@@ -37,8 +56,9 @@ class NamedPath(object):
         self.options = options
         self._scope = scope
         self.kwargs = kwargs
-        self.base_dir = Path(base_dir)
+        self._base_dir = _as_posix(base_dir)
         self.default_context = kwargs.get('default_context', {})
+        self._cache = {}
 
     def __str__(self):
         return self.path
@@ -50,13 +70,21 @@ class NamedPath(object):
         """
         Collect context values
         """
+        import copy
         ctx = copy.deepcopy(self.default_context)
         ctx.update(context)
         for k, v in self.options.get('defaults', {}).items():
             ctx.setdefault(k, v)
-        ctx.setdefault('user', getpass.getuser())
+        ctx.setdefault('user', _get_user())
         return ctx
 
+    @property
+    def base_dir(self):
+        """
+        Root directory as pathlib.Path
+        """
+        return _to_path(self._base_dir)
+
     @property
     def path(self) -> str:
         """
@@ -67,10 +95,31 @@ class NamedPath(object):
     # solve
 
     def solve(self, context: dict, skip_context_errors: bool = False,
-              relative: bool = False, local: bool = False) -> str:
+              relative: bool = False, local: bool = False, as_path: bool = False) -> str:
         """
-        Resolve path from pattern with context to relative path
+        Resolve path from pattern with context to relative path.
+        Compiled solver is used if pattern supports it (see get_solver)
+
+        Parameters
+        ----------
+        context: dict
+        skip_context_errors: bool
+        relative: bool
+            Without base dir
+        local: bool
+            Without parent path
+        as_path: bool
+            Return pathlib.Path instead of string
         """
+        if as_path:
+            return _to_path(self.solve(context, skip_context_errors, relative, local))
+        if not relative and not local and self.get_shard_rule() is not None:
+            return _posix_join(self.get_base_dir(context, skip_context_errors),
+                               self.solve(context, skip_context_errors, relative=True))
+        if not skip_context_errors:
+            solver = self.get_solver()
+            if solver:
+                return solver(context or {}, relative, local)
         if local:
             parent_path = ''
         else:
@@ -81,43 +130,271 @@ class NamedPath(object):
                 if relative:
                     parent_path = ''
                 else:
-                    parent_path = self.base_dir
+                    parent_path = self._base_dir
         parts = self.get_parts(context, solve=True, dirs_only=False, skip_context_errors=skip_context_errors)
-        if parts:
-            rel_path = Path(*parts)
-        else:
-            rel_path = ''
-        return Path(parent_path, rel_path).as_posix()
+        return _posix_join(parent_path, *parts)
+
+    def get_solver(self) -> Callable:
+        """
+        Function generated from pattern source with inlined parents, literals, format specs and filters.
+        Function receives context, relative and local flags and works like solve().
+        Disabled with tree option compile_solvers=False.
+
+        Returns
+        -------
+        Callable or None
+            None if pattern uses syntax not supported by generator
+        """
+        if not self.kwargs.get('compile_solvers', True):
+            return None
+        return self._cached('solver', self._build_solver)
+
+    def _build_solver(self) -> Callable:
+        chain = [self]
+        while chain[0].get_parent():
+            chain.insert(0, chain[0].get_parent())
+        namespace = dict(format=format, _posix_join=_posix_join, _getuser=_get_user,
+                         _filtered_value=_filtered_value, PathContextError=PathContextError,
+                         default_context=self.default_context, base_dir=self._base_dir)
+        blocks = []
+        parts = []
+        for level, path_instance in enumerate(chain):
+            namespace['defaults_%d' % level] = dict(path_instance.options.get('defaults', {}))
+            source = path_instance._get_solver_source(level, namespace['defaults_%d' % level])
+            if source is None:
+                return None
+            blocks.append(source[0])
+            parts.append(source[1])
+        lines = ['def solve(context, relative=False, local=False):',
+                 '    ctx = {**default_context, **context} if default_context else context',
+                 '    if local:']
+        lines.extend('    ' + x for x in blocks[-1])
+        lines.append('        return _posix_join(%s)' % ', '.join(parts[-1] or ["''"]))
+        for block in blocks:
+            lines.extend(block)
+        all_parts = [x for level_parts in parts for x in level_parts]
+        lines.append('    if relative:')
+        lines.append('        return _posix_join(%s)' % ', '.join(all_parts or ["''"]))
+        lines.append('    return _posix_join(%s)' % ', '.join(['base_dir'] + all_parts))
+        source = '\n'.join(lines)
+        try:
+            exec(compile(source, '<solver %s>' % self.name, 'exec'), namespace)
+        except SyntaxError:
+            logger.debug('Can not compile solver for {}'.format(self.name))
+            return None
+        solver = namespace['solve']
+        solver.source = source
+        return solver
+
+    def _get_solver_source(self, level: int, defaults: dict) -> tuple:
+        """
+        Source lines for one level of parents chain
+
+        Returns
+        -------
+        tuple or None
+            Lines and list of variables names with resolved parts
+        """
+        path = self.path
+        if '{{' in path or '}}' in path:
+            return None
+        optional_blocks = list(_OPTIONAL_BLOCK.finditer(path))
+        rest = re.sub(r"{.*?}", '', _OPTIONAL_BLOCK.sub('', path))
+        if '<' in rest or '>' in rest:
+            return None
+        for block in optional_blocks:
+            if '/' in block.group(0) or path[:block.start()].count('{') != path[:block.start()].count('}'):
+                return None
+        variables = {}
+
+        def lookup(name, inline=False):
+            if name in defaults:
+                expr = "(ctx[%r] if %r in ctx else defaults_%d[%r])" % (name, name, level, name)
+            elif name == 'user':
+                expr = "(ctx['user'] if 'user' in ctx else _getuser())"
+            else:
+                expr = "ctx[%r]" % name
+            if inline:
+                return expr
+            if name not in variables:
+                variables[name] = ('v%d_%d' % (level, len(variables)), expr)
+            return variables[name][0]
+
+        def compile_field(field, inline):
+            match = re.match(r'^(\w+)(?::([^{}!|]*))?$', field)
+            if match:
+                value = lookup(match.group(1), inline)
+                spec = match.group(2) or ''
+                if re.match(r'^[\w:]*$', spec):
+                    return "('*' if %s == '*' else format(%s, %r))" % (value, value, spec)
+                return "format(%s, %r)" % (value, spec)
+            match = re.match(r'^(\w+)((?:\|\w+\([^{}]*?\))+)$', field)
+            if match and re.match(r"^({([\w\d_:]+)([|\w]+\(.*?\))?})$", '{%s}' % field):
+                value = lookup(match.group(1), inline)
+                methods = ''.join('.' + x for x in match.group(2).split('|') if x)
+                return "('*' if %s == '*' else format(_filtered_value(%s, %r)%s, ''))" % (
+                    value, value, match.group(1), methods)
+
+        def compile_text(text, inline):
+            pieces = []
+            for i, token in enumerate(re.split(r"({.*?})", text)):
+                if i % 2:
+                    expr = compile_field(token[1:-1], inline)
+                    if expr is None:
+                        return None
+                    pieces.append(expr)
+                elif token:
+                    if '{' in token or '}' in token:
+                        return None
+                    pieces.append(repr(token))
+            return ' + '.join(pieces) or "''"
+
+        part_lines = []
+        part_names = []
+        for i, part in enumerate(self.get_short_parts()):
+            pieces = []
+            position = 0
+            for block in _OPTIONAL_BLOCK.finditer(part):
+                pieces.append(compile_text(part[position:block.start()], False))
+                condition = block.group(1).split(':')[0].split('.')[0]
+                expr = compile_text(block.group(0).strip('<>'), True)
+                if expr is None:
+                    return None
+                if condition in defaults or condition == 'user':
+                    pieces.append('(%s)' % expr)
+                else:
+                    pieces.append("((%s) if %r in ctx else '')" % (expr, condition))
+                position = block.end()
+            pieces.append(compile_text(part[position:], False))
+            if None in pieces:
+                return None
+            pieces = [x for x in pieces if x != "''"] or ["''"]
+            if len(pieces) == 1 and re.match(r"^'[^'\\\\]*'$", pieces[0]):
+                # literal part
+                part_names.append(pieces[0])
+                continue
+            part_names.append('p%d_%d' % (level, i))
+            part_lines.append('        %s = %s' % (part_names[-1], ' + '.join(pieces)))
+        if not variables and not part_lines:
+            return [], part_names
+        lines = ['    try:']
+        lines.extend('        %s = %s' % (var, expr) for var, expr in variables.values())
+        lines.extend(part_lines)
+        lines.append('    except KeyError as e:')
+        lines.append('        raise PathContextError(str(e)) from None')
+        return lines, part_names
 
     def iter_path(self, context: dict = None, solve: bool = True, dirs_only: bool = True,
-                  skip_context_errors: bool = False, full_path: bool = False, include_parents: bool = False):
+                  skip_context_errors: bool = False, full_path: bool = False, include_parents: bool = False,
+                  as_path: bool = False):
         """
         Iterate path by parts
         """
-        base = ''
-        if full_path:
-            parent = self.get_parent()
-            if parent:
-                base = parent.solve(context, skip_context_errors=skip_context_errors) if solve else parent.path
-                if include_parents:
-                    try:
-                        for part in parent.iter_path(context, solve=solve,
-                                                     dirs_only=dirs_only,
-                                                     full_path=full_path,
-                                                     skip_context_errors=False,
-                                                     include_parents=include_parents):
-                            yield part
-                    except PathContextError:
-                        return
+        if as_path:
+            for path in self.iter_path(context, solve, dirs_only, skip_context_errors, full_path, include_parents):
+                yield _to_path(path)
+            return
+        if not full_path:
+            p = ''
+            for part in self.get_parts(context, solve, dirs_only, skip_context_errors):
+                p = _posix_join(p, part)
+                yield p
+            return
+        for pattern, paths, complete in self.iter_path_levels(context, solve, dirs_only, skip_context_errors):
+            if pattern is not self:
+                if not include_parents:
+                    continue
+                if not complete:
+                    return
+            for path in paths:
+                yield path
+
+    def iter_path_levels(self, context: dict = None, solve: bool = True, dirs_only: bool = True,
+                         skip_context_errors: bool = False):
+        """
+        Full paths of all pattern components from root pattern to this one.
+        Each pattern in chain resolved once, full path of parent is the base of next level.
+
+        Parameters
+        ----------
+        context: dict
+        solve: bool
+        dirs_only: bool
+            Skip components with file extension
+        skip_context_errors: bool
+            Cut incomplete levels instead of raising PathContextError
+
+        Yields
+        ------
+        tuple
+            Pattern, list of paths and completeness flag, from root pattern to this one
+        """
+        shard_unknown = False
+        try:
+            base = self.get_base_dir(context, skip_context_errors=not solve)
+        except PathContextError:
+            if not skip_context_errors:
+                raise
+            base = self._base_dir
+            shard_unknown = True
+        for pattern in self.get_parent_chain():
+            if shard_unknown and pattern.get_shard_rule() is not None:
+                # levels of sharded patterns are cut, their root is unknown
+                return
+            if pattern is self:
+                parts, complete = pattern._resolve_parts(context, solve, skip_context_errors, dirs_only)
+                level_parts = parts
+            else:
+                try:
+                    parts, complete = pattern._resolve_parts(context, solve, False)
+                    level_parts = parts
+                except PathContextError:
+                    if not solve:
+                        parts, level_parts, complete = [], [], False
+                    elif not skip_context_errors:
+                        # raise error with message of solve
+                        pattern.solve(context)
+                        raise
+                    else:
+                        # truncated full path of parent is the base of next levels
+                        parts, _ = pattern._resolve_parts(context, solve, True)
+                        level_parts, _ = pattern._resolve_parts(context, solve, True, dirs_only)
+                        complete = False
+            p = ''
+            paths = []
+            for part, is_file in level_parts:
+                if not (dirs_only and is_file):
+                    p = _posix_join(p, part)
+                    paths.append(_posix_join(base, p))
+            yield pattern, paths, complete
+            if solve:
+                base = _posix_join(base, *[part for part, _ in parts])
             else:
-                base = self.base_dir
-        p = ''
-        for part in self.get_parts(context, solve, dirs_only, skip_context_errors):
-            p = Path(p, part)
-            yield Path(base, p).as_posix()
+                base = pattern.path
+
+    def get_parent_chain(self) -> list:
+        """
+        Patterns from root pattern to this one
+
+        Returns
+        -------
+        list
+        """
+        def get_chain():
+            parent = self.get_parent()
+            return (parent.get_parent_chain() if parent else []) + [self]
+        return self._cached('parent_chain', get_chain)
 
     def get_parts(self, context: dict = None, solve: bool = False,
                   dirs_only: bool = False, skip_context_errors: bool = False) -> list:
+        parts, _ = self._resolve_parts(context, solve, skip_context_errors, dirs_only)
+        return [part for part, _ in parts]
+
+    def _resolve_parts(self, context: dict, solve: bool, skip_context_errors: bool,
+                       dirs_only: bool = False) -> tuple:
+        """
+        Components of short path with file flags and completeness of context
+        """
         context = self.get_context(context or {})
         if context:
             src_path = self.__class__.remove_optional(self.path, context)
@@ -126,20 +403,21 @@ class NamedPath(object):
             src_path = self.path
             context_variables = {}
         parts = []
-        for part in Path(self.get_short(src_path)).parts:
-            if dirs_only and Path(part).suffix:
+        for part in self.get_short_parts(src_path):
+            is_file = _has_suffix(part)
+            if dirs_only and is_file:
                 continue
             if solve:
                 variables = self.get_pattern_variables(part)
                 miss = [x for x in variables if x not in context_variables]
                 if miss:
                     if skip_context_errors:
-                        break
+                        return parts, False
                     else:
                         raise PathContextError(str(miss))
                 part = self.expand_variables(part, context)
-            parts.append(part)
-        return parts
+            parts.append((part, is_file))
+        return parts, True
 
     def parts_count(self):
         count = len(self.path.split('/'))
@@ -148,6 +426,29 @@ class NamedPath(object):
             count = parent.parts_count() + count
         return count
 
+    def _get_list(self, values, default=None):
+        list_length = self.parts_count()
+        if not isinstance(values, (list, tuple)):
+            values = [values]*list_length
+        values = [x if x is not None else default for x in values]
+        return values
+
+    def _valid_mode(self, value):
+        if value is None:
+            return None
+        if isinstance(value, int):
+            return oct(value)
+        if isinstance(value, bytes):
+            value = value.decode()
+        if isinstance(value, str):
+            if value.isdigit():
+                # '0755'
+                return oct(int('0o%s' % value, 8))
+            elif re.match(r"^\do\d+$", value):
+                # '0o755'
+                return oct(int(value, 8))
+        raise ValueError('Wrong mode: {} ({})'.format(value, type(value)))
+
     def expand_variables(self, text: str, context: dict) -> str:
         """
         Resolve variables in pattern
@@ -200,7 +501,7 @@ class NamedPath(object):
                 new_var = var_name
                 if var_name not in context:
                     if not skip_context_errors:
-                        raise PathContextError
+                        raise PathContextError(repr(var_name))
                 else:
                     new_context[new_var] = context[var_name]
             new_text = new_text.replace(f'{{{var}}}', f'{{{new_var+options}}}')
@@ -218,27 +519,55 @@ class NamedPath(object):
 
     @classmethod
     def remove_optional(cls, text: str, context: dict):
-        pat = re.compile(r"<.*?\{([\w\d:]+)}>")
-        for var in pat.finditer(text):
-            if var.group(1).split(':')[0].split('.')[0] not in context:
-                text = text.replace(var.group(0), '')
-            text = text.replace(var.group(0), var.group(0).strip('<>'))
-        return text
+        if '<' not in text:
+            return text
+        return _OPTIONAL_BLOCK.sub(
+            lambda m: m.group(0).strip('<>') if m.group(1).split(':')[0].split('.')[0] in context else '', text)
 
     def convert_types(self, context: dict) -> dict:
         """
         Convert context types after parsing
         """
-        import builtins
-        types = self.options.get('types')
-        if not types:
-            return context
-        for name, tp in types.items():
+        converters = self._cached('converters', self._get_converters)
+        for name, func in converters.items():
             if name in context:
-                func = getattr(builtins, tp)
                 context[name] = func(context[name])
         return context
 
+    def _get_converters(self) -> dict:
+        import builtins
+        return {name: getattr(builtins, tp) for name, tp in (self.options.get('types') or {}).items()}
+
+    def _cached(self, key: str, func: Callable):
+        """
+        Compute value once per pattern options
+        """
+        try:
+            value = self._cache[key]
+        except KeyError:
+            if self._stats is None:
+                value = self._cache[key] = func()
+                return value
+            self._stats.count('cache.miss')
+            with self._stats.timer('compile.%s' % key):
+                value = self._cache[key] = func()
+            return value
+        if self._stats is not None:
+            self._stats.count('cache.hit')
+        return value
+
+    def _syscall(self, name: str, func: Callable, *args):
+        """
+        Call filesystem function with statistics
+        """
+        if self._stats is None:
+            return func(*args)
+        with self._stats.timer('fs.%s' % name):
+            return func(*args)
+
+    def _reset_cache(self):
+        self._cache.clear()
+
     def get_pattern_variables(self, pattern: str = None) -> list:
         """
         Extract variables names from pattern
@@ -264,7 +593,7 @@ class NamedPath(object):
         """
         par = self.get_parent()
         if par:
-            return str(Path(par.get_relative(), self.get_short()))
+            return self._cached('relative', lambda: _posix_join(par.get_relative(), self.get_short()))
         else:
             return self.path
 
@@ -276,13 +605,43 @@ class NamedPath(object):
         -------
         str
         """
-        return Path((custom_path or self.path).split(']', 1)[-1].lstrip('\\/')).as_posix()
+        if not custom_path or custom_path == self.path:
+            return self._cached('short', lambda: self._short_path(self.path))
+        return self._short_path(custom_path)
+
+    def get_short_parts(self, custom_path: str = None) -> tuple:
+        """
+        Components of short path, same as parts of pathlib.Path
+
+        Returns
+        -------
+        tuple
+        """
+        if not custom_path or custom_path == self.path:
+            return self._cached('short_parts', lambda: self._split_parts(self.get_short()))
+        return self._split_parts(self._short_path(custom_path))
 
-    def get_absolute(self) -> str:
+    @staticmethod
+    def _short_path(path: str) -> str:
+        return _as_posix(path.split(']', 1)[-1].lstrip('\\/'))
+
+    @staticmethod
+    def _split_parts(path: str) -> tuple:
+        if path == '.':
+            return ()
+        return tuple(path.split('/'))
+
+    def get_absolute(self, as_path: bool = False) -> str:
         """
         Absolute path
+
+        Parameters
+        ----------
+        as_path: bool
+            Return pathlib.Path instead of string
         """
-        return str(Path(self.base_dir, self.get_relative()))
+        path = _posix_join(self._base_dir, self.get_relative())
+        return _to_path(path) if as_path else path
 
     # parent
 
@@ -342,7 +701,7 @@ class NamedPath(object):
         """
         path = self.get_relative()
         if prefix:
-            path = Path(prefix, path.lstrip('\\/'))
+            path = _posix_join(prefix, path.lstrip('\\/'))
 
         def get_context_val(match):
             val = match.group(0)
@@ -371,45 +730,228 @@ class NamedPath(object):
         -------
         str
         """
-        simple_pattern = r'[^/\\]+'
-        named_pattern = r'(?P<%s>[^/\\]+)'
         path = self.get_relative()
         if prefix:
             path = normpath(join(prefix, path.lstrip('\\/')))
+        return '^%s$' % self._regex_body(path, named_values, context)
+
+    def get_level_regex(self):
+        """
+        Compiled regex of pattern part relative to parent, matched from start of path component.
+        None for patterns without own part.
+        """
+        def build():
+            short = self.get_short()
+            if short == '.':
+                return None
+            return re.compile('%s(?=/|$)' % self._regex_body(short), re.IGNORECASE)
+        return self._cached('level_regex', build)
+
+    def match_level_prefix(self, path: str) -> bool:
+        """
+        Path matches first components (not all) of pattern part relative to parent
+        """
+        def build():
+            parts = self.get_short_parts()
+            return [re.compile('%s$' % self._regex_body('/'.join(parts[:i])), re.IGNORECASE)
+                    for i in range(1, len(parts))]
+        return any(regex.match(path) for regex in self._cached('level_prefix_regex', build))
+
+    def _regex_body(self, path: str, named_values: bool = True, context: dict = None) -> str:
         names = set()
 
-        def get_subpattern(match):
-            v = match.group(0)
+        def escape(text):
+            return text.replace('\\', '\\\\').replace('.', '\\.')
+
+        def get_subpattern(v):
             name = v.strip('{}').split(':')[0].split('|')[0]#.lower()
             if context:
                 try:
                     expanded = self.expand_variables(v, context)
                     names.add(name)
-                    return expanded
-                except KeyError:
+                    return escape(expanded)
+                except (KeyError, PathContextError):
                     pass
+            simple_pattern = self.get_variable_pattern(v.strip('{}'))
             if name in names:
                 return simple_pattern
             names.add(name)
             if named_values:
-                return named_pattern % name
+                return '(?P<%s>%s)' % (name, simple_pattern)
             else:
                 return simple_pattern
 
-        pattern = re.sub(r"{.*?}", get_subpattern, path.replace('\\', '\\\\'))
-        pattern = pattern.replace('.', '\\.')
-        pattern = '^%s$' % pattern
-        return pattern
+        def convert(text):
+            return ''.join(get_subpattern(part) if i % 2 else escape(part)
+                           for i, part in enumerate(re.split(r"({.*?})", text)))
+
+        # optional blocks are optional non-capturing groups
+        pieces = []
+        position = 0
+        for block in _OPTIONAL_BLOCK.finditer(path):
+            pieces.append(convert(path[position:block.start()]))
+            pieces.append('(?:%s)?' % convert(block.group(0).strip('<>')))
+            position = block.end()
+        pieces.append(convert(path[position:]))
+        return ''.join(pieces)
+
+    def get_components(self) -> list:
+        """
+        Tokenized components of relative pattern.
+        Each optional block gives extra variants of components list.
+
+        Returns
+        -------
+        list
+            List of variants, each is a list of PatternComponent
+        """
+        variants = []
+        for path in self.iter_optional_variants(self.get_relative()):
+            variants.append([PatternComponent(x, self.get_variable_pattern)
+                             for x in path.replace('\\', '/').split('/') if x])
+        return variants
+
+    @classmethod
+    def iter_optional_variants(cls, text: str):
+        """
+        All combinations of text with and without optional blocks
+        """
+        blocks = _OPTIONAL_ANY.findall(text)
+        for mask in range(2 ** len(blocks)):
+            variant = text
+            for i, block in enumerate(blocks):
+                variant = variant.replace(block, block.strip('<>') if mask & (1 << i) else '', 1)
+            yield variant
+
+    def get_variable_pattern(self, variable: str) -> str:
+        """
+        Regex for variable value.
+        Priority: option "regex", option "choices", format spec, option "types".
+
+        Parameters
+        ----------
+        variable: str
+            Variable with format spec and filters, like "VERSION:03d"
+
+        Returns
+        -------
+        str
+        """
+        name, options = self.split_var_name_and_options(variable)
+        regex = (self.options.get('regex') or {}).get(name)
+        if regex:
+            return '(?:%s)' % regex
+        choices = (self.options.get('choices') or {}).get(name)
+        if choices:
+            choices = sorted(set(str(x) for x in choices), key=lambda x: (-len(x), x))
+            return '(?:%s)' % '|'.join(re.escape(x) for x in choices)
+        if '|' in options:
+            # filters can change any value
+            return PatternComponent.variable_pattern
+        tp = (self.options.get('types') or {}).get(name)
+        return self.format_spec_to_regex(options.lstrip(':'), tp)
+
+    @classmethod
+    def format_spec_to_regex(cls, spec: str, tp: str = None) -> str:
+        r"""
+        Convert format spec to regex which match formatted value
+
+        >>> NamedPath.format_spec_to_regex('03d')
+        '(?:-\\d{2,}|\\d{3,})'
+        """
+        match = re.match(r'^(?:(?P<fill>.)?(?P<align>[<>=^]))?(?P<sign>[+\- ]?)(?P<alt>#?)(?P<zero>0?)'
+                         r'(?P<width>\d*)(?P<grouping>[,_]?)(?:\.(?P<precision>\d+))?(?P<type>[bcdeEfFgGnosxX%]?)$',
+                         spec or '')
+        if not match or match.group('align') or match.group('grouping') or match.group('alt') \
+                or match.group('sign') not in ('', '-'):
+            return PatternComponent.variable_pattern
+        spec_type = match.group('type') or {'int': 'd', 'float': 'g'}.get(tp, '')
+        width = int(match.group('width') or 0)
+        if spec_type in ('d', 'x', 'X', 'o', 'b', 'n'):
+            digit = {'x': '[0-9a-f]', 'X': '[0-9A-F]', 'o': '[0-7]', 'b': '[01]'}.get(spec_type, r'\d')
+            if width > 1 and match.group('zero'):
+                return '(?:-{0}{{{1},}}|{0}{{{2},}})'.format(digit, width - 1, width)
+            elif width > 1:
+                return ' *-?%s+' % digit
+            return '-?%s+' % digit
+        if spec_type in ('f', 'F'):
+            return r'-?\d+\.\d{%s}' % (match.group('precision') or 6)
+        if spec_type in ('e', 'E', 'g', 'G') and not width:
+            return r'-?(?:\d+(?:\.\d+)?(?:e[-+]\d+)?|inf|nan)'
+        return PatternComponent.variable_pattern
 
     def parse(self, path: str) -> dict:
         """
         Extract context from path
         """
-        pattern = self.as_regex(self.base_dir.as_posix())
-        m = re.match(pattern, str(path), re.IGNORECASE)
-        if m:
-            context = self.convert_types(m.groupdict())
-            return {k.upper(): v for k, v in context.items()}
+        patterns = self._cached('parse_regex', lambda: [
+            re.compile(self.as_regex(base_dir), re.IGNORECASE) for base_dir in self.get_base_dirs()])
+        for pattern in patterns:
+            m = pattern.match(str(path))
+            if m:
+                context = self.convert_types({k: v for k, v in m.groupdict().items() if v is not None})
+                return {k.upper(): v for k, v in context.items()}
+
+    # shards
+
+    def get_shard_rule(self) -> dict:
+        """
+        Option "shard" of this pattern or nearest parent.
+        Sharded pattern and its children are placed in one of tree "shard_roots" selected by
+        stable hash of context values (keys) or explicit map of values to root index or root path.
+
+        >>> {'path': '[SHOTS]/{ENTITY_NAME}', 'shard': {'keys': ['ENTITY_NAME'], 'map': {'sh001': 0}}}
+
+        Returns
+        -------
+        dict or None
+        """
+        def get_rule():
+            if not self.kwargs.get('shard_roots'):
+                return None
+            for pattern in reversed(self.get_parent_chain()):
+                rule = pattern.options.get('shard')
+                if rule:
+                    if isinstance(rule, (list, tuple)):
+                        rule = dict(keys=list(rule))
+                    if not rule.get('keys'):
+                        raise ValueError('No "keys" in shard option of pattern {}'.format(pattern.name))
+                    return rule
+        return self._cached('shard_rule', get_rule)
+
+    def get_base_dirs(self) -> list:
+        """
+        All possible base dirs of pattern, shard roots for sharded patterns
+        """
+        if self.get_shard_rule() is None:
+            return [self._base_dir]
+        return list(self.kwargs['shard_roots'])
+
+    def get_base_dir(self, context: dict = None, skip_context_errors: bool = False) -> str:
+        """
+        Base dir for context, shard root for sharded patterns
+
+        Parameters
+        ----------
+        context: dict
+        skip_context_errors: bool
+            Use tree root if context has no shard keys
+        """
+        rule = self.get_shard_rule()
+        if rule is None:
+            return self._base_dir
+        roots = self.kwargs['shard_roots']
+        ctx = self.get_context(context or {})
+        try:
+            key = '/'.join(str(ctx[name]) for name in rule['keys'])
+        except KeyError as e:
+            if skip_context_errors:
+                return self._base_dir
+            raise PathContextError(str(e)) from None
+        mapped = (rule.get('map') or {}).get(key)
+        if mapped is not None:
+            return roots[mapped] if isinstance(mapped, int) else _as_posix(mapped)
+        return roots[_shard_index(key, len(roots))]
 
 
 class NamedPathDrive(NamedPath):    # TODO: Work in progress! dont use this class
@@ -417,6 +959,13 @@ class NamedPathDrive(NamedPath):    # TODO: Work in progress! dont use this clas
     named path class with dick drive access
     """
 
+    @property
+    def fs(self) -> 'FileSystem':
+        """
+        Filesystem backend from option "filesystem" of tree, local filesystem by default
+        """
+        return self.kwargs.get('filesystem') or _LOCAL_FILESYSTEM
+
     @property
     def default_dir_permission(self) -> int:
         return self.kwargs.get('default_dir_permission') or self._default_dir_permission
@@ -427,7 +976,7 @@ class NamedPathDrive(NamedPath):    # TODO: Work in progress! dont use this clas
 
     @property
     def default_user(self) -> str:
-        return getpass.getuser()
+        return _get_user()
 
     @property
     def default_group(self) -> str:
@@ -435,21 +984,18 @@ class NamedPathDrive(NamedPath):    # TODO: Work in progress! dont use this clas
 
     def update_owner(self, context, skip_context_errors=False,
                      parents=False, skip_non_exists=False, **kwargs):
-        if parents:
-            parent = self.get_parent()
-            if parent:
-                parent.update_owner(context, skip_context_errors, parents, skip_non_exists)
+        for pattern, paths, _ in self.iter_path_levels(context, dirs_only=False, skip_context_errors=True):
+            if parents or pattern is self:
+                pattern._update_owner(paths, **kwargs)
 
-        for path, user, group in zip(self.iter_path(context, dirs_only=False, skip_context_errors=True, full_path=True),
-                                     self.get_user_list(**kwargs),
-                                     self.get_group_list(**kwargs)):
+    def _update_owner(self, paths: list, **kwargs):
+        for path, user, group in zip(paths, self.get_user_list(**kwargs), self.get_group_list(**kwargs)):
             # user
             user = user or kwargs.get('default_user') or self.default_user
             # group
             group = group or kwargs.get('default_group') or self.default_group
-            os.makedirs(path)
-            chown(path, user, group)
-
+            self._syscall('makedirs', self.fs.makedirs, path)
+            self._syscall('chown', self.fs.chown, path, user, group)
 
     def update_attributes(self, context, **kwargs):
         self.update_permissions(context, **kwargs)
@@ -457,18 +1003,17 @@ class NamedPathDrive(NamedPath):    # TODO: Work in progress! dont use this clas
 
     def update_permissions(self, context, skip_context_errors=False, parents=False,
                            skip_non_exists=False, **kwargs):
-        if parents:
-            parent = self.get_parent()
-            if parent:
-                parent.update_permissions(context, skip_context_errors, parents, skip_non_exists, **kwargs)
+        for pattern, paths, _ in self.iter_path_levels(context, dirs_only=False, skip_context_errors=True):
+            if parents or pattern is self:
+                pattern._update_permissions(paths, skip_non_exists, **kwargs)
 
-        for path, perm in zip(self.iter_path(context, dirs_only=False, skip_context_errors=True, full_path=True),
-                              self.get_permission_list(**kwargs)):
-            if skip_non_exists and not os.path.exists(path):
+    def _update_permissions(self, paths: list, skip_non_exists=False, **kwargs):
+        for path, perm in zip(paths, self.get_permission_list(**kwargs)):
+            if skip_non_exists and not self._syscall('exists', self.fs.exists, path):
                 continue
             perm = perm or kwargs.get('default_permission') or (
                 self.default_dir_permission if not os.path.splitext(path)[1] else self.default_file_permission)
-            chmod(path, perm)
+            self._syscall('chmod', self.fs.chmod, path, perm)
 
     def get_permission_list(self, **kwargs) -> list:
         """chmod parameter"""
@@ -488,58 +1033,119 @@ class NamedPathDrive(NamedPath):    # TODO: Work in progress! dont use this clas
     # I/O
 
     def makedirs(self, context, skip_context_errors=False, **kwargs):
-        parent: NamedPath = self.get_parent()
-        if parent:
-            try:
-                if not parent.makedirs(context, skip_context_errors=False, **kwargs):
-                    return False
-            except PathContextError:
-                if skip_context_errors:
+        levels = self.iter_path_levels(context, solve=True, dirs_only=True, skip_context_errors=skip_context_errors)
+        try:
+            for pattern, paths, complete in levels:
+                if not complete and pattern is not self:
                     return False
+                pattern._makedirs(context, paths, **kwargs)
+        except PathContextError:
+            if skip_context_errors:
+                return False
+            raise
+        return True
+
+    def _makedirs(self, context, paths: list, **kwargs):
         parts = list(zip(
-                self.iter_path(context, solve=True, dirs_only=True,
-                               skip_context_errors=skip_context_errors, full_path=True),
+                paths,
                 self.get_permission_list(),
                 self.get_group_list(),
                 self.get_user_list()))
         parts_count = len(parts)
         for i, (path, perm, group, user) in enumerate(parts):
             # итерация по частям пути от начала к концу
-            if not os.path.exists(path):
-                # если путь еще не существует, то создаём его
-                # permission
-                perm = kwargs.get('default_permission') or perm
-                if not perm:
-                    perm = self.default_dir_permission
-                # user
-                user = user or kwargs.get('default_user') or self.default_user
-                # group
-                group = group or kwargs.get('default_group') or self.default_group
-                if i == parts_count-1 and self.options.get('symlink_to'):
-                    # если это последняя часть пути и есть опция линковки, то делаем линк
-                    link_source = self.expand_variables(self.options.get('symlink_to'), context)
-                    if not os.path.exists(link_source):
-                        raise IOError('Source path for link not exists: {}'.format(link_source))
-                    os.symlink(link_source, path)
-                else:
-                    os.makedirs(path)
-                    chmod(path, perm)
-                    chown(path, user, group)
-                logger.info('Make {}: {}'.format(self.name, path))
-            elif i == parts_count-1 and self.options.get('symlink_to'):
-                # если путь уже существует
-                if not os.path.islink(path):
-                    # и это не линк, то выбрасываем ошибку
-                    raise IOError('Path for symlink already exists and it is not a symlink: {}'.format(path))
+            self._make_path(context, path, perm, group, user, i == parts_count-1, **kwargs)
+
+    def _make_path(self, context, path: str, perm, group, user, is_last: bool, **kwargs) -> bool:
+        """
+        Create one directory of pattern or symlink for last directory
+
+        Returns
+        -------
+        bool
+            False if path already exists
+        """
+        if not self.fs.supports_dirs and not (is_last and self.options.get('symlink_to')):
+            # directories of flat key space exist only as prefixes of keys
+            return False
+        if not self._syscall('exists', self.fs.exists, path):
+            # если путь еще не существует, то создаём его
+            # permission
+            perm = kwargs.get('default_permission') or perm
+            if not perm:
+                perm = self.default_dir_permission
+            # user
+            user = user or kwargs.get('default_user') or self.default_user
+            # group
+            group = group or kwargs.get('default_group') or self.default_group
+            if is_last and self.options.get('symlink_to'):
+                # если это последняя часть пути и есть опция линковки, то делаем линк
                 link_source = self.expand_variables(self.options.get('symlink_to'), context)
-                real_path = os.readlink(path)
-                if real_path != link_source:
-                    raise IOError('Linked path {} referenced to different source: {}, correct source: {}'.format(
-                        path, real_path, link_source))
-        return True
+                if not self._syscall('exists', self.fs.exists, link_source):
+                    raise IOError('Source path for link not exists: {}'.format(link_source))
+                self._syscall('symlink', self.fs.symlink, link_source, path)
+            else:
+                self._syscall('makedirs', self.fs.makedirs, path)
+                self._syscall('chmod', self.fs.chmod, path, perm)
+                self._syscall('chown', self.fs.chown, path, user, group)
+            logger.info('Make {}: {}'.format(self.name, path))
+            return True
+        elif is_last and self.options.get('symlink_to'):
+            # если путь уже существует
+            if not self._syscall('islink', self.fs.islink, path):
+                # и это не линк, то выбрасываем ошибку
+                raise IOError('Path for symlink already exists and it is not a symlink: {}'.format(path))
+            link_source = self.expand_variables(self.options.get('symlink_to'), context)
+            real_path = self._syscall('readlink', self.fs.readlink, path)
+            if real_path != link_source:
+                raise IOError('Linked path {} referenced to different source: {}, correct source: {}'.format(
+                    path, real_path, link_source))
+        return False
+
+    def remove_empty_dirs(self, context, dry_run: bool = False, removed: set = None) -> list:
+        """
+        Remove empty directories of own pattern part for context, deepest first.
+        Failed rmdir means that directory is not empty, upper directories are not checked then.
 
-    def remove_empty_dirs(self, context):
-        raise NotImplementedError
+        Parameters
+        ----------
+        context: dict
+        dry_run: bool
+            Do not remove, emptiness is checked by listing
+        removed: set
+            Paths already removed (or to be removed in dry run)
+
+        Returns
+        -------
+        list
+            Removed paths
+        """
+        removed = removed if removed is not None else set()
+        result = []
+        if self.options.get('protected'):
+            return result
+        paths = []
+        for pattern, level_paths, complete in self.iter_path_levels(context, dirs_only=True, skip_context_errors=True):
+            if pattern is self and complete:
+                paths = level_paths
+        for path in reversed(paths):
+            if path in removed:
+                continue
+            if dry_run:
+                try:
+                    entries = self.fs.listdir(path)
+                except OSError:
+                    break
+                if any('/'.join([path, name]) not in removed for name in entries):
+                    break
+            else:
+                try:
+                    self._syscall('rmdir', self.fs.rmdir, path)
+                except OSError:
+                    break
+            removed.add(path)
+            result.append(path)
+        return result
     # utils
 
     def _get_option_list_by_value_name(self, value, default_value_key=None, default_value=None, **kwargs) -> list:
@@ -552,29 +1158,6 @@ class NamedPathDrive(NamedPath):    # TODO: Work in progress! dont use this clas
             value_list.extend([default_value]*(list_length-list_length))
         return [self.expand_variables(x, kwargs) if x else x for x in value_list]
 
-    def _get_list(self, values, default=None):
-        list_length = self.parts_count()
-        if not isinstance(values, (list, tuple)):
-            values = [values]*list_length
-        values = [x if x is not None else default for x in values]
-        return values
-
-    def _valid_mode(self, value):
-        if value is None:
-            return None
-        if isinstance(value, int):
-            return oct(value)
-        if isinstance(value, bytes):
-            value = value.decode()
-        if isinstance(value, str):
-            if value.isdigit():
-                # '0755'
-                return oct(int('0o%s' % value, 8))
-            elif re.match(r"^\do\d+$", value):
-                # '0o755'
-                return oct(int(value, 8))
-        raise ValueError('Wrong mode: {} ({})'.format(value, type(value)))
-
 
 class NamedPathTree:
     """
@@ -582,17 +1165,24 @@ class NamedPathTree:
     """
     path_class = NamedPath
 
-    def __init__(self, root_path: str or Path,
+    def __init__(self, root_path: str | os.PathLike,
                  path_list: dict = None,
                  default_context: dict = None,
                  path_class=None,
                  **kwargs):
         self.kwargs = kwargs
-        if not isinstance(root_path, (str, Path)):
+        if not isinstance(root_path, (str, os.PathLike)):
             raise ValueError('Root directory must be string type')
-        self._root_path = Path(root_path).resolve().as_posix()
-        self._scope = {}
-        self.default_context = {}
+        self._root_path = _as_posix(os.path.realpath(root_path))
+        if kwargs.get('shard_roots'):
+            kwargs['shard_roots'] = [_as_posix(os.path.realpath(x)) for x in kwargs['shard_roots']]
+        self._state = _TreeState({}, {})
+        self._children_map = None
+        self._marks = {}
+        self._marks_lock = threading.Lock()
+        self._stats = None
+        self._frozen = False
+        self._update_lock = threading.Lock()
         if default_context:
             self.update_default_context(default_context)
         if path_list:
@@ -605,7 +1195,7 @@ class NamedPathTree:
         return '<NamedPathTree "{}">'.format(self.root)
 
     @classmethod
-    def load_from_files(cls, root: str or Path, files: list, **kwargs):
+    def load_from_files(cls, root: str | os.PathLike, files: list, **kwargs):
         patterns = {}
         for f in files:
             patterns.update(cls._load_commented_json(f))
@@ -613,7 +1203,9 @@ class NamedPathTree:
 
     @staticmethod
     def _load_commented_json(path: str, **kwargs) -> dict:
-        text = Path(path).read_text()
+        import json
+        with open(path) as f:
+            text = f.read()
         regex = r'\s*(/{2}).*$'
         regex_inline = r'(:?(?:\s)*([A-Za-z\d.{}]*)|((?<=\").*\"),?)(?:\s)*(((/{2}).*)|)$'
         lines = text.split('\n')
@@ -640,27 +1232,89 @@ class NamedPathTree:
         """
         return self._root_path
 
-    def get_patterns(self) -> dict:
-        return {name: path.options for name, path in self._scope.items()}
+    @property
+    def fs(self) -> 'FileSystem':
+        """
+        Filesystem backend (option "filesystem"), local filesystem by default
+        """
+        return self.kwargs.get('filesystem') or _LOCAL_FILESYSTEM
 
-    def get_context(self) -> dict:
-        return self.default_context
+    @property
+    def _scope(self) -> dict:
+        return self._state.scope
 
-    def update_patterns(self, path_list: dict):
+    @property
+    def default_context(self):
         """
-        Update pattern list
+        Read-only view of default context, use update_default_context to change it
+        """
+        return types.MappingProxyType(self._state.default_context)
 
-        Parameters
-        ----------
-        path_list: dict
+    def get_roots(self) -> list:
         """
-        to_remove = []
-        option_presets = path_list.pop('option_presets', {})
-        for path_name, options in path_list.items():    # type: str, str
-            # skip empty and lowercase names
-            if not path_name or not path_name.isupper():
-                continue
-            # None in options mean DELETE pattern
+        Root path and shard roots of tree
+
+        Returns
+        -------
+        list
+        """
+        roots = [self.root]
+        for root in self.kwargs.get('shard_roots') or []:
+            if root not in roots:
+                roots.append(root)
+        return roots
+
+    def get_patterns(self) -> dict:
+        return {name: dict(path.options) for name, path in self._scope.items()}
+
+    def get_context(self) -> dict:
+        """
+        Copy of default context
+        """
+        return dict(self._state.default_context)
+
+    def snapshot(self) -> 'NamedPathTree':
+        """
+        Read-only tree with current patterns and default context.
+        Patterns and context are never changed in place: updates of tree build new pattern instances
+        and swap them in, so readers of tree or snapshot see complete state without locks.
+
+        Returns
+        -------
+        NamedPathTree
+        """
+        import copy
+        tree = copy.copy(self)
+        tree._frozen = True
+        return tree
+
+    def update_patterns(self, path_list: dict):
+        """
+        Update pattern list
+
+        Parameters
+        ----------
+        path_list: dict
+        """
+        with self._update_lock:
+            state = self._state
+            scope = self._build_scope(path_list, state.scope, state.default_context)
+            self._state = _TreeState(scope, state.default_context)
+
+    def _build_scope(self, path_list: dict, current_scope: dict, default_context: dict) -> dict:
+        """
+        New pattern instances from current patterns and updates
+        """
+        if self._frozen:
+            raise TypeError('Snapshot of tree is read-only')
+        all_options = {name: path.options for name, path in current_scope.items()}
+        to_remove = []
+        option_presets = path_list.pop('option_presets', {})
+        for path_name, options in path_list.items():    # type: str, str
+            # skip empty and lowercase names
+            if not path_name or not path_name.isupper():
+                continue
+            # None in options mean DELETE pattern
             if options is None:
                 to_remove.append(path_name)
                 continue
@@ -670,6 +1324,9 @@ class NamedPathTree:
             # check options type
             if not isinstance(options, dict):
                 raise TypeError('Wrong type of Pattern options')
+            # own copy of options, caller dict and nested dicts and lists are not changed later
+            options = {k: (dict(v) if isinstance(v, dict) else list(v) if isinstance(v, list) else v)
+                       for k, v in options.items()}
             # apply preset
             preset_name = options.pop('preset', None)
             if preset_name:
@@ -687,16 +1344,21 @@ class NamedPathTree:
             # additive mode
             if path_name.endswith('+'):
                 path_name = path_name.strip('+')
-                if path_name in self._scope:
-                    self._scope[path_name].options.update(options)
+                if path_name in all_options:
+                    all_options[path_name] = dict(all_options[path_name], **options)
                     continue
             # check options
-            if 'path' not in options and path_name not in self._scope:
+            if 'path' not in options and path_name not in all_options:
                 raise ValueError('No "path" parameter in pattern options: {}'.format(path_name))
-            self._scope[path_name] = self.path_class(self.root, path_name, options, self._scope,
-                                               default_context=self.default_context, **self.kwargs)
+            all_options[path_name] = options
         for name in to_remove:
-            self._scope.pop(name, None)
+            all_options.pop(name, None)
+        scope = {}
+        for path_name, options in all_options.items():
+            scope[path_name] = self.path_class(self.root, path_name, options, scope,
+                                               default_context=default_context, **self.kwargs)
+            scope[path_name]._stats = self._stats
+        return scope
 
     def update_default_context(self, context: dict):
         """
@@ -706,7 +1368,11 @@ class NamedPathTree:
         ----------
         context: dict
         """
-        self.default_context.update(context)
+        with self._update_lock:
+            state = self._state
+            default_context = dict(state.default_context, **context)
+            scope = self._build_scope({}, state.scope, default_context)
+            self._state = _TreeState(scope, default_context)
 
     # get path
 
@@ -728,9 +1394,15 @@ class NamedPathTree:
         -------
         str
         """
+        if self._stats is not None:
+            with self._stats.timer('get_path'):
+                return self._get_path(name, context, skip_context_errors, create, **kwargs)
+        return self._get_path(name, context, skip_context_errors, create, **kwargs)
+
+    def _get_path(self, name: str, context, skip_context_errors, create, **kwargs) -> str:
         ctl = self.get_path_instance(name)    # type: NamedPath
         path = ctl.solve(context, skip_context_errors=skip_context_errors, **kwargs)
-        if create and not exists(path):
+        if create and not ctl._syscall('exists', self.fs.exists, path):
             ctl.makedirs(context, skip_context_errors=skip_context_errors)
         return path
 
@@ -827,6 +1499,12 @@ class NamedPathTree:
         -------
         str or list
         """
+        if self._stats is not None:
+            with self._stats.timer('parse'):
+                return self._parse(path, with_context)
+        return self._parse(path, with_context)
+
+    def _parse(self, path: str, with_context=False):
         match_names = []
         for name, path_instance in self._scope.items():  # type: NamedPath
             context = path_instance.parse(path)
@@ -842,6 +1520,164 @@ class NamedPathTree:
         else:
             return name
 
+    def parse_nearest(self, path: str) -> 'NearestMatch':
+        """
+        Deepest pattern matching beginning of path.
+        Pattern hierarchy is walked once along path components, unmatched rest of path is returned as remainder.
+
+        >>> tree.parse_nearest('/mnt/prj/shots/sh010/cache/tmp.abc')
+        NearestMatch(name='SHOT', context={'PROJECT_NAME': 'prj', 'ENTITY_NAME': 'sh010'}, remainder='cache/tmp.abc')
+
+        Parameters
+        ----------
+        path: str
+
+        Returns
+        -------
+        NearestMatch
+        """
+        path = _as_posix(path)
+        end, pattern, context, _ = self._parse_nearest(path)
+        context = pattern.convert_types(dict(context))
+        return NearestMatch(pattern.name, {k.upper(): v for k, v in context.items()}, path[end:].lstrip('/'))
+
+    def _parse_nearest(self, path: str, parent: tuple = None) -> tuple:
+        """
+        End position, pattern, raw context and root of deepest match of path beginning.
+        With parent match of path beginning only its child patterns are tried on the rest of path.
+        """
+        children = self._get_children_map()
+        found = []
+        if parent is None:
+            for root in self.get_roots():
+                start = len(root.rstrip('/'))
+                if path[:start] != root.rstrip('/') or path[start:start + 1] not in ('/', ''):
+                    continue
+                found.extend(self._match_levels(path, root, [(x, start, {}) for x in children.get(None, ())]))
+        else:
+            pos, pattern, context, root = parent
+            found.append(parent)
+            found.extend(self._match_levels(path, root, [(x, pos, context) for x in children.get(pattern.name, ())]))
+        if not found:
+            raise NoPatternMatchError(path)
+        end = max(x[0] for x in found)
+        found = [x for x in found if x[0] == end]
+        if len({x[1].name for x in found}) > 1:
+            raise MultiplePatternMatchError(', '.join(sorted({x[1].name for x in found})))
+        return found[0]
+
+    def _match_levels(self, path: str, root: str, stack: list) -> list:
+        """
+        Walk pattern hierarchy along path components from (pattern, position, context) items of stack
+        """
+        children = self._get_children_map()
+        found = []
+        while stack:
+            pattern, pos, context = stack.pop()
+            regex = pattern.get_level_regex()
+            if regex is not None:
+                m = regex.match(path, pos + 1) if path[pos:pos + 1] == '/' else None
+                if m is None:
+                    continue
+                # first occurrence of variable wins, same as in parse()
+                context = dict({k: v for k, v in m.groupdict().items() if v is not None}, **context)
+                pos = m.end()
+            if root in pattern.get_base_dirs():
+                found.append((pos, pattern, context, root))
+            stack.extend((child, pos, context) for child in children.get(pattern.name, ()))
+        return found
+
+    def _get_children_map(self) -> dict:
+        """
+        Patterns by parent name (None for top patterns) for current scope
+        """
+        scope = self._scope
+        cached = self._children_map
+        if cached is None or cached[0] is not scope:
+            children = collections.defaultdict(list)
+            for name in sorted(scope):
+                children[scope[name].get_parent_name()].append(scope[name])
+            cached = self._children_map = (scope, dict(children))
+        return cached[1]
+
+    def allocate_next(self, name: str, context: dict, key: str = 'VERSION', start: int = 1,
+                      retries: int = 100) -> int:
+        """
+        Reserve next value of numeric variable (version) with exclusive creation of its directory.
+        Only directory of variable component is listed to find max value, next allocations in
+        the same directory start from cached max value and list again only after collision.
+
+        >>> context = {'PROJECT_NAME': 'prj', 'ENTITY_NAME': 'sh010', 'EXT': 'ma'}
+        >>> version = tree.allocate_next('SHOT_PUBLISH', context)
+        >>> tree.get_path('SHOT_PUBLISH', dict(context, VERSION=version))
+
+        Parameters
+        ----------
+        name: str
+            Pattern name
+        context: dict
+            Context of all variables before variable component
+        key: str
+            Variable name
+        start: int
+            First value if no existing values
+        retries: int
+            Max count of collisions
+
+        Returns
+        -------
+        int
+        """
+        path_ctl = self.get_path_instance(name)
+        context = {k: v for k, v in (context or {}).items() if k != key}
+        parts = path_ctl.get_relative().split('/')
+        for index, part in enumerate(parts):
+            if key in path_ctl.get_pattern_variables(part):
+                break
+        else:
+            raise PathContextError('{} not in pattern {}'.format(key, name))
+        if index == len(parts) - 1 and _has_suffix(part):
+            raise ValueError('Variable {} of pattern {} is not in directory name'.format(key, name))
+        parent = _posix_join(path_ctl.get_base_dir(context), path_ctl.expand_variables('/'.join(parts[:index]), context))
+        regex = re.compile('^%s$' % path_ctl._regex_body(part, context=context), re.IGNORECASE)
+        mark_key = (name, key, parent, regex.pattern)
+        self.fs.makedirs(parent)
+        with self._marks_lock:
+            value = self._marks.get(mark_key)
+        for _ in range(retries):
+            if value is None:
+                value = self._find_max_value(parent, regex, key, start - 1)
+            value += 1
+            path = '/'.join([parent, path_ctl.expand_variables(part, dict(context, **{key: value}))])
+            try:
+                self.fs.mkdir(path)
+            except FileExistsError:
+                value = None
+                continue
+            with self._marks_lock:
+                if value > self._marks.get(mark_key, value - 1):
+                    self._marks[mark_key] = value
+            return value
+        raise RuntimeError('Can not allocate {} of {} after {} attempts'.format(key, name, retries))
+
+    def _find_max_value(self, path: str, regex, key: str, default: int) -> int:
+        """
+        Max integer value of variable in names of directory entries
+        """
+        value = default
+        try:
+            names = self.fs.listdir(path)
+        except FileNotFoundError:
+            return value
+        for entry_name in names:
+            m = regex.match(entry_name)
+            if m:
+                try:
+                    value = max(value, int(m.group(key)))
+                except (TypeError, ValueError):
+                    pass
+        return value
+
     def get_pattern_variables(self, name):
         return self.get_path_instance(name).get_pattern_variables()
 
@@ -861,13 +1697,94 @@ class NamedPathTree:
     def is_empty(self):
         return len(self._scope) > 0
 
+    # stats
+
+    def enable_stats(self, callback: Callable = None) -> 'PathStats':
+        """
+        Start collecting counters and timings of get_path, parse, compilation, cache and filesystem calls
+
+        Parameters
+        ----------
+        callback: Callable
+            Function called for each measure with kind ("count" or "timing"), name and value
+
+        Returns
+        -------
+        PathStats
+        """
+        self._set_stats(PathStats(callback))
+        return self._stats
+
+    def disable_stats(self):
+        self._set_stats(None)
+
+    def get_stats(self) -> dict:
+        """
+        Collected statistics, empty dict if statistics are disabled
+        """
+        if self._stats is None:
+            return {}
+        return self._stats.as_dict()
+
+    def _set_stats(self, stats: 'PathStats'):
+        self._stats = stats
+        for path_instance in self._scope.values():
+            path_instance._stats = stats
+
     # check
 
-    def check_uniqueness_of_parsing(self, full_context: dict) -> dict:
+    def find_ambiguous_patterns(self) -> list:
+        """
+        Static search of patterns which can match the same path.
+        Patterns are compared by components without any sample context:
+        only patterns with same depth and compatible components are checked.
+
+        Returns
+        -------
+        list
+            Sorted list of pattern name pairs
+        """
+        root = _ComponentTrieNode()
+        for name, path_instance in self._scope.items():
+            for components in path_instance.get_components():
+                node = root
+                for comp in components:
+                    node = node.get_child(comp)
+                node.names.add(name)
+        pairs = set()
+        visited = set()
+        stack = [(root, root)]
+        while stack:
+            a, b = stack.pop()
+            key = (id(a), id(b)) if id(a) <= id(b) else (id(b), id(a))
+            if key in visited:
+                continue
+            visited.add(key)
+            for name1 in a.names:
+                for name2 in b.names:
+                    if name1 != name2:
+                        pairs.add(tuple(sorted((name1, name2))))
+            if a is b:
+                children = list(a.iter_children())
+                for i, child in enumerate(children):
+                    stack.append((child, child))
+                    if child.component.is_literal:
+                        continue
+                    for other in children[:i] + children[i+1:]:
+                        if child.component.overlaps(other.component):
+                            stack.append((child, other))
+            else:
+                for child in a.iter_children():
+                    for other in b.iter_compatible_children(child.component):
+                        stack.append((child, other))
+        return sorted(pairs)
+
+    def check_uniqueness_of_parsing(self, full_context: dict = None) -> dict:
         """
         Checking your patterns for uniques.
         Each path should be reversible without match with other patterns.
-        This checking require full context with variables for all patterns.
+        Patterns are compared statically, see find_ambiguous_patterns().
+        If full context is defined each pattern also checked to parse its own generated path.
         Use this method when you develop your structure.
 
         Parameters
@@ -882,25 +1799,26 @@ class NamedPathTree:
             errors={},
             success=[]
         )
+        overlaps = {}
+        for name1, name2 in self.find_ambiguous_patterns():
+            overlaps.setdefault(name1, []).append(name2)
+            overlaps.setdefault(name2, []).append(name1)
         for name in self.get_path_names():
-            path = self.get_path(name, full_context)
-            try:
-                parsed_name = self.parse(path)
-            except NoPatternMatchError as e:
-                msg = 'Error {}: {}'.format(e.__class__.__name__, e)
-                logger.warning(msg)
-                result['errors'][name] = msg
-            except MultiplePatternMatchError as e:
-                msg = 'Error {}: {}'.format(e.__class__.__name__, e)
+            if name in overlaps:
+                msg = 'Error {}: {}'.format(MultiplePatternMatchError.__name__, MultiplePatternMatchError(
+                    ', '.join(sorted([name] + overlaps[name]))))
                 logger.warning(msg)
                 result['errors'][name] = msg
-            else:
-                if parsed_name != name:
-                    msg = 'Generated and parsed names not match: {} -> {}'.format(name, parsed_name)
+                continue
+            if full_context is not None:
+                path_instance = self.get_path_instance(name)
+                path = path_instance.solve(full_context)
+                if path_instance.parse(path) is None:
+                    msg = 'Error {}: {}'.format(NoPatternMatchError.__name__, NoPatternMatchError(path))
                     logger.warning(msg)
                     result['errors'][name] = msg
-                else:
-                    result['success'].append(name)
+                    continue
+            result['success'].append(name)
         logger.info('Total patterns: %s' % len(self._scope))
         logger.info('Success parsing: %s' % len(result['success']))
         logger.info('Errors: %s' % len(result['errors']))
@@ -925,6 +1843,256 @@ class NamedPathTree:
 
     # utils
 
+    def diff(self, contexts, names: list = None):
+        """
+        Compare expected directories and files of contexts with disk.
+        Expected paths are collected without duplicates and compared with sorted scandir
+        listings of directories which have expected children, one listing per directory.
+        File of pattern is expected only if its name is resolved with context.
+        Content of expected leaf directories is not checked.
+
+        Parameters
+        ----------
+        contexts: iterable
+            Contexts of expected structure
+        names: list
+            Pattern names, all patterns by default
+
+        Yields
+        ------
+        DiffEntry
+            Entries with status "missing", "extra" or "mismatch" in sorted path order
+        """
+        expected = {}
+        patterns = [self.get_path_instance(name) for name in (names or self.get_path_names())]
+        for context in contexts:
+            for path_ctl in patterns:
+                try:
+                    for pattern, paths, complete in path_ctl.iter_path_levels(context, dirs_only=False,
+                                                                              skip_context_errors=True):
+                        short_parts = pattern.get_short_parts()
+                        modes = pattern._get_list(pattern.options.get('perm'))
+                        users = pattern._get_list(pattern.options.get('users'))
+                        groups = pattern._get_list(pattern.options.get('groups'))
+                        link = pattern.options.get('symlink_to') if complete else None
+                        for i, path in enumerate(paths):
+                            if path in expected:
+                                continue
+                            attrs = dict(is_file=i < len(short_parts) and _has_suffix(short_parts[i]),
+                                         mode=pattern._valid_mode(modes[i]) if i < len(modes) else None,
+                                         user=users[i] if i < len(users) else None,
+                                         group=groups[i] if i < len(groups) else None,
+                                         link=pattern.expand_variables(link, context)
+                                         if link and i == len(paths) - 1 else None)
+                            for key in ('user', 'group'):
+                                if attrs[key]:
+                                    attrs[key] = pattern.expand_variables(attrs[key], context)
+                            expected[path] = (pattern.name, attrs)
+                except (CustomException, KeyError, ValueError) as e:
+                    logger.debug('Skip {} in diff: {}'.format(path_ctl.name, e))
+        children = collections.defaultdict(list)
+        top_paths = []
+        for path in expected:
+            parent, _, name = path.rpartition('/')
+            if parent in expected:
+                children[parent].append(name)
+            else:
+                top_paths.append(path)
+        for path in sorted(top_paths):
+            try:
+                st = self.fs.lstat(path)
+            except FileNotFoundError:
+                entry = None
+            else:
+                entry = _StatEntry(path, st, self.fs)
+            yield from self._diff_walk(path, entry, expected, children)
+
+    def _diff_walk(self, path: str, entry, expected: dict, children: dict):
+        """
+        Compare expected path with scandir entry (or lstat result of top path) and merge sorted children
+        """
+        pattern_name, attrs = expected[path]
+        if entry is None:
+            yield DiffEntry(DiffEntry.MISSING, path, pattern_name, '')
+            for name in sorted(children.get(path, ())):
+                yield from self._diff_walk('/'.join([path, name]), None, expected, children)
+            return
+        messages = []
+        is_link = entry.is_symlink()
+        if attrs['link']:
+            if not is_link:
+                messages.append('not a symlink')
+            elif self.fs.readlink(path) != attrs['link']:
+                messages.append('symlink to {}'.format(self.fs.readlink(path)))
+        elif attrs['is_file']:
+            if not entry.is_file(follow_symlinks=False):
+                messages.append('not a file')
+        elif not entry.is_dir(follow_symlinks=False):
+            messages.append('not a directory')
+        if attrs['mode'] and not is_link and self.fs.supports_dirs:
+            import stat
+
+            mode = oct(stat.S_IMODE(entry.stat(follow_symlinks=False).st_mode))
+            if mode != attrs['mode']:
+                messages.append('mode {} != {}'.format(mode, attrs['mode']))
+        if (attrs['user'] or attrs['group']) and self.fs.supports_dirs:
+            for key, value in zip(('user', 'group'), self.fs.get_owner(path)):
+                if attrs[key] and str(value) != attrs[key]:
+                    messages.append('{} {} != {}'.format(key, value, attrs[key]))
+        if messages:
+            yield DiffEntry(DiffEntry.MISMATCH, path, pattern_name, ', '.join(messages))
+        names = sorted(children.get(path, ()))
+        if not names:
+            return
+        try:
+            entries = sorted(((entry.name, entry) for entry in self.fs.scandir(path)), key=lambda x: x[0])
+        except OSError as e:
+            logger.warning('Scan error: {}'.format(e))
+            entries = []
+        index = 0
+        for entry_name, entry in entries:
+            while index < len(names) and names[index] < entry_name:
+                yield from self._diff_walk('/'.join([path, names[index]]), None, expected, children)
+                index += 1
+            if index < len(names) and names[index] == entry_name:
+                yield from self._diff_walk(entry.path, entry, expected, children)
+                index += 1
+            else:
+                yield DiffEntry(DiffEntry.EXTRA, entry.path, None, '')
+        for name in names[index:]:
+            yield from self._diff_walk('/'.join([path, name]), None, expected, children)
+
+    def usage(self, names: list = None, group_by: tuple = ('ENTITY_NAME',), path: str = None,
+              workers: int = 8) -> list:
+        """
+        Count files, directories and bytes of existing entries by pattern and context values.
+        Each entry is counted once in deepest pattern (see parse_nearest), entries not matched any pattern
+        are counted with pattern name None.
+
+        >>> tree.usage(names=['SHOT'], group_by=('ENTITY_NAME',))
+        [UsageEntry(pattern_name='SHOT', values=('sh010',), files=120, dirs=14, bytes=1073741824)]
+
+        Parameters
+        ----------
+        names: list
+            Patterns to report, all by default
+        group_by: tuple
+            Context variables of groups
+        path: str
+            Subtree to walk, all roots by default
+        workers: int
+            Count of threads scanning directories
+
+        Returns
+        -------
+        list
+            UsageEntry sorted by pattern name and values
+        """
+        table = []
+        for table in self.iter_usage(names, group_by, path, workers):
+            pass
+        return table
+
+    def iter_usage(self, names: list = None, group_by: tuple = ('ENTITY_NAME',), path: str = None,
+                   workers: int = 8, partial_dirs: int = 10000):
+        """
+        Same as usage(), partial tables are yielded after each partial_dirs scanned directories,
+        last yielded table is complete.
+
+        Yields
+        ------
+        list
+        """
+        import concurrent.futures
+
+        names = set(names) if names else None
+        group_by = tuple(group_by or ())
+        totals = {}
+        executor = concurrent.futures.ThreadPoolExecutor(max(workers, 1), 'NamedPathUsage')
+        pending = set()
+        scanned = 0
+        try:
+            for root in ([_as_posix(path)] if path else self._get_walk_roots()):
+                pending.add(executor.submit(self._usage_scan, root, None, names, group_by))
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    counts, subdirs = future.result()
+                    for key, values in counts.items():
+                        total = totals.setdefault(key, [0, 0, 0])
+                        for i in range(3):
+                            total[i] += values[i]
+                    for subdir, match in subdirs:
+                        pending.add(executor.submit(self._usage_scan, subdir, match, names, group_by))
+                    scanned += 1
+                    if pending and partial_dirs and not scanned % partial_dirs:
+                        yield self._usage_table(totals)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+        yield self._usage_table(totals)
+
+    def _usage_scan(self, path: str, match, names: set, group_by: tuple) -> tuple:
+        """
+        Counts of one directory entries and subdirectories with their matches.
+        Match of directory is inherited by entries, only its child patterns are tried on the rest of path,
+        match of leaf pattern is kept by all content. Entries are parsed from root only without match.
+        """
+        import stat
+
+        counts = {}
+        subdirs = []
+        children = self._get_children_map()
+        inherit = match is not None and match[0][1].name not in children
+        try:
+            entries = self.fs.scandir(path)
+        except OSError as e:
+            logger.warning('Scan error: {}'.format(e))
+            return counts, subdirs
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            entry_match = match
+            if not inherit:
+                try:
+                    nearest = self._parse_nearest(_as_posix(entry.path), match[0] if match else None)
+                except (NoPatternMatchError, MultiplePatternMatchError):
+                    entry_match = None
+                else:
+                    if match is None or nearest is not match[0]:
+                        pattern, context = nearest[1], nearest[2]
+                        context = {k.upper(): v for k, v in pattern.convert_types(dict(context)).items()}
+                        entry_match = nearest, context
+            if is_dir:
+                subdirs.append((_as_posix(entry.path), entry_match))
+            name = entry_match[0][1].name if entry_match else None
+            if names is not None and name not in names:
+                continue
+            key = (name, tuple(entry_match[1].get(x) for x in group_by) if entry_match else (None,) * len(group_by))
+            values = counts.setdefault(key, [0, 0, 0])
+            if is_dir:
+                values[1] += 1
+            else:
+                values[0] += 1
+                values[2] += st.st_size
+        return counts, subdirs
+
+    @staticmethod
+    def _usage_table(totals: dict) -> list:
+        return [UsageEntry(name, values, *counts) for (name, values), counts in
+                sorted(totals.items(), key=lambda x: (x[0][0] or '', [str(v) for v in x[0][1]]))]
+
+    def _get_walk_roots(self) -> list:
+        """
+        Roots of tree without roots inside other roots
+        """
+        roots = self.get_roots()
+        return [x for x in roots if not any(x.startswith(r.rstrip('/') + '/') for r in roots)]
+
     def show_tree(self, **kwargs):
         """
         Print tree structure to console
@@ -960,6 +2128,58 @@ class NamedPathTree:
         print('=' * 50)
 
 
+_TreeState = collections.namedtuple('_TreeState', ['scope', 'default_context'])
+
+
+UsageEntry = collections.namedtuple('UsageEntry', ['pattern_name', 'values', 'files', 'dirs', 'bytes'])
+NearestMatch = collections.namedtuple('NearestMatch', ['name', 'context', 'remainder'])
+
+
+class DiffEntry(collections.namedtuple('DiffEntry', ['status', 'path', 'pattern_name', 'message'])):
+    """
+    Result entry of NamedPathTree.diff
+    """
+    __slots__ = ()
+    MISSING = 'missing'
+    EXTRA = 'extra'
+    MISMATCH = 'mismatch'
+
+
+class _StatEntry(object):
+    """
+    os.DirEntry-like wrapper of lstat result
+    """
+    def __init__(self, path: str, st, fs: 'FileSystem' = None):
+        import stat
+
+        self.path = path
+        self.name = path.rpartition('/')[2]
+        self._st = st
+        self._stat = stat
+        self._fs = fs or _LOCAL_FILESYSTEM
+
+    def __repr__(self):
+        return '<_StatEntry {}>'.format(self.name)
+
+    def is_symlink(self) -> bool:
+        return self._stat.S_ISLNK(self._st.st_mode)
+
+    def is_dir(self, follow_symlinks: bool = True) -> bool:
+        if follow_symlinks and self.is_symlink():
+            return self._fs.isdir(self.path)
+        return self._stat.S_ISDIR(self._st.st_mode)
+
+    def is_file(self, follow_symlinks: bool = True) -> bool:
+        if follow_symlinks and self.is_symlink():
+            return self._fs.exists(self.path) and not self._fs.isdir(self.path)
+        return self._stat.S_ISREG(self._st.st_mode)
+
+    def stat(self, follow_symlinks: bool = True):
+        if follow_symlinks and self.is_symlink():
+            return self._fs.stat(self.path)
+        return self._st
+
+
 class NamedPathTreeDrive(NamedPathTree):    # TODO: Work in progress! dont use this class
     """
     Named path tree with access to drive
@@ -969,28 +2189,258 @@ class NamedPathTreeDrive(NamedPathTree):    # TODO: Work in progress! dont use t
 
     def makedirs(self, context=None, names=None, root_path_name=None, skip_context_errors=True, **kwargs):
         """Create dirs"""
+        paths = self._get_path_instances(names, root_path_name)
+        context = context or self.get_context()
+        for path_ctl in paths:
+            path_ctl.makedirs(context, skip_context_errors=skip_context_errors, **kwargs)
+
+    def _get_path_instances(self, names=None, root_path_name=None) -> list:
         names = names or self.get_path_names()
         paths = [self.get_path_instance(name) for name in names]
         if root_path_name:
             if root_path_name not in self.get_path_names():
                 raise PathNameError
             paths = [path for path in paths if root_path_name in path.get_all_parent_names()]
-        context = context or self.get_context()
-        for path_ctl in paths:
-            path_ctl.makedirs(context, skip_context_errors=skip_context_errors, **kwargs)
+        return paths
 
-    def clear_empty_dirs(self, context=None, names=None):
-        raise NotImplementedError
+    def materialize(self, rows, names=None, root_path_name=None, workers: int = 1,
+                    dry_run: bool = False, **kwargs) -> dict:
+        """
+        Create directories for many contexts at once.
+        Directories of all rows and patterns are collected without duplicates,
+        then created level by level from the root, in parallel if workers > 1.
+        Rows with missing context are reported for each pattern instead of skipping silently.
+
+        Parameters
+        ----------
+        rows: iterable or str
+            Contexts or path to .csv or .jsonl file with one context per row
+        names: list
+            Pattern names, all patterns by default
+        root_path_name: str
+            Only patterns inherited from this pattern
+        workers: int
+            Count of threads creating directories of one level
+        dry_run: bool
+            Collect directories without creating
+
+        Returns
+        -------
+        dict
+            created - list of created paths (paths to create in dry run),
+            existing - count of already existing paths,
+            failed_rows - row index, pattern name and error of rows with wrong context,
+            failed_paths - path and error of directories which can not be created
+        """
+        path_instances = self._get_path_instances(names, root_path_name)
+        plan = {}
+        failed_rows = []
+        for index, row in enumerate(self._iter_rows(rows)):
+            for path_ctl in path_instances:
+                try:
+                    # variables are typed by each pattern, not by the whole tree
+                    context = path_ctl.convert_types(dict(row))
+                    for pattern, paths, _ in path_ctl.iter_path_levels(context, dirs_only=True):
+                        count = len(paths)
+                        for i, (path, perm, group, user) in enumerate(zip(
+                                paths, pattern.get_permission_list(), pattern.get_group_list(),
+                                pattern.get_user_list())):
+                            if path not in plan:
+                                plan[path] = (pattern, context, perm, group, user, i == count - 1)
+                except (CustomException, KeyError, TypeError, ValueError) as e:
+                    failed_rows.append(dict(row=index, name=path_ctl.name, error=str(e)))
+        levels = collections.defaultdict(list)
+        for path in plan:
+            levels[path.count('/')].append(path)
+        result = dict(created=[], existing=0, failed_rows=failed_rows, failed_paths=[])
+        if dry_run:
+            result['created'] = [path for depth in sorted(levels) for path in sorted(levels[depth])
+                                 if not self.fs.exists(path)]
+            result['existing'] = len(plan) - len(result['created'])
+            return result
+
+        def make(path):
+            pattern, context, perm, group, user, is_last = plan[path]
+            try:
+                return path, pattern._make_path(context, path, perm, group, user, is_last, **kwargs), None
+            except (OSError, KeyError, ValueError) as e:
+                return path, False, e
+
+        executor = None
+        if workers > 1:
+            import concurrent.futures
+            executor = concurrent.futures.ThreadPoolExecutor(workers, 'NamedPathMaterialize')
+        try:
+            for depth in sorted(levels):
+                paths = sorted(levels[depth])
+                for path, created, error in (executor.map(make, paths) if executor else map(make, paths)):
+                    if error is not None:
+                        result['failed_paths'].append(dict(path=path, error=str(error)))
+                    elif created:
+                        result['created'].append(path)
+                    else:
+                        result['existing'] += 1
+        finally:
+            if executor:
+                executor.shutdown()
+        return result
+
+    @staticmethod
+    def _iter_rows(rows):
+        """
+        Contexts from iterable or .csv / .jsonl file. Empty csv cells are skipped
+        """
+        if not isinstance(rows, (str, os.PathLike)):
+            yield from rows
+            return
+        with open(rows, newline='') as f:
+            if os.fspath(rows).lower().endswith('.csv'):
+                import csv
+
+                for row in csv.DictReader(f):
+                    yield {k: v for k, v in row.items() if k and v not in ('', None)}
+            else:
+                import json
+
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def clear_empty_dirs(self, context: dict = None, names: list = None, protected: list = None,
+                         dry_run: bool = False, workers: int = 1) -> list:
+        """
+        Remove empty directories of patterns with one post-order walk.
+        Only directories matched with patterns (or with beginning of child pattern) are removed,
+        unmatched directories and patterns from "protected" list or with option "protected" are kept,
+        so their parents are not empty too. Failed rmdir is the emptiness test, no extra listings.
+
+        Parameters
+        ----------
+        context: dict
+            Walk only directories of patterns solved with context, all roots if None
+        names: list
+            Patterns to clean with their child patterns, all by default
+        protected: list
+            Names of patterns which directories are never removed
+        dry_run: bool
+            Return directories which would be removed
+        workers: int
+            Count of threads for top subtrees
+
+        Returns
+        -------
+        list
+            Removed paths, children before parents
+        """
+        allowed = set(self._iter_descendant_names(names)) if names else None
+        protected = set(protected or ()) | {name for name, path in self._scope.items()
+                                            if path.options.get('protected')}
+        starts = []
+        patterns = []
+        if context is None:
+            for root in self._get_walk_roots():
+                try:
+                    starts.extend(entry.path for entry in self.fs.scandir(root) if entry.is_dir(follow_symlinks=False))
+                except OSError as e:
+                    logger.warning('Scan error: {}'.format(e))
+        else:
+            for path_ctl in self._get_path_instances(names):
+                levels = list(path_ctl.iter_path_levels(context, dirs_only=True, skip_context_errors=True))
+                pattern, paths, complete = levels[-1] if levels else (None, [], False)
+                if pattern is path_ctl and complete and paths and path_ctl.name not in protected:
+                    starts.append(paths[-1])
+                    patterns.append(path_ctl)
+        # nested start is walked with outer one
+        starts = sorted(set(starts))
+        starts = [x for i, x in enumerate(starts) if not any(x.startswith(y + '/') for y in starts[:i])]
+
+        def prune(path: str) -> list:
+            result = []
+            self._prune_dir(path, allowed, protected, dry_run, result)
+            return result
+
+        removed = []
+        if workers > 1 and len(starts) > 1:
+            import concurrent.futures
+
+            with concurrent.futures.ThreadPoolExecutor(workers, 'NamedPathPrune') as executor:
+                for result in executor.map(prune, starts):
+                    removed.extend(result)
+        else:
+            for path in starts:
+                removed.extend(prune(path))
+        # upper directories of patterns
+        removed_set = set(removed)
+        for path_ctl in patterns:
+            removed.extend(path_ctl.remove_empty_dirs(context, dry_run, removed_set))
+        return removed
+
+    def _prune_dir(self, path: str, allowed: set, protected: set, dry_run: bool, removed: list) -> bool:
+        """
+        Remove empty subdirectories and directory itself, True if directory is removed
+        """
+        try:
+            entries = self.fs.scandir(path)
+        except OSError as e:
+            logger.warning('Scan error: {}'.format(e))
+            return False
+        empty = True
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False) or not self._prune_dir(
+                    entry.path, allowed, protected, dry_run, removed):
+                empty = False
+        if not empty:
+            return False
+        owners = self._get_dir_owners(path)
+        if not owners or owners & protected or (allowed is not None and not owners & allowed):
+            return False
+        if not dry_run:
+            try:
+                self.fs.rmdir(path)
+            except OSError:
+                return False
+        removed.append(path)
+        return True
+
+    def _get_dir_owners(self, path: str) -> set:
+        """
+        Names of patterns which can own directory: deepest matched pattern or
+        its children which pattern part begins with unmatched rest of path
+        """
+        try:
+            match = self.parse_nearest(path)
+        except (NoPatternMatchError, MultiplePatternMatchError):
+            return set()
+        if not match.remainder:
+            return {match.name}
+        return {child.name for child in self._get_children_map().get(match.name, ())
+                if child.match_level_prefix(match.remainder)}
+
+    def _iter_descendant_names(self, names: list):
+        children = self._get_children_map()
+        stack = list(names)
+        while stack:
+            name = stack.pop()
+            yield name
+            stack.extend(x.name for x in children.get(name, ()))
 
     def transfer_to(self,
                     other_tree: 'NamedPathTree',
                     pattern_names_map: dict | Callable = None,
                     context_keys_map: dict | Callable = None,
                     context_values_map: dict | Callable = None,
-                    action: Callable = None) -> dict:
+                    action: Callable | str = None,
+                    compact: bool = False,
+                    dry_run: bool = False,
+                    on_conflict: str = 'ignore',
+                    max_memory_paths: int = 1000000,
+                    workers: int = 1,
+                    journal: 'str | TransferJournal' = None) -> 'dict | TransferResult':
         """
         Move files from one tree to others.
         All names must be matched or have renamed map.
+        Files with the same target path (collisions) and files with already existing target
+        are reported as conflicts in TransferResult.conflicts.
 
         Parameters
         ----------
@@ -1002,12 +2452,126 @@ class NamedPathTreeDrive(NamedPathTree):    # TODO: Work in progress! dont use t
             rename map for context keys
         context_values_map: dict
             replace context values
-        action: Callable
+        action: Callable or str
             Action for paths. Must receive tho values. Default print()
+            Name of built-in action: move, copy, hardlink, symlink or reflink (see TransferAction)
+        compact: bool
+            Return TransferResult object instead of dict
+        dry_run: bool
+            Do not call action
+        on_conflict: str
+            "ignore" - report conflicts and transfer anyway (default),
+            "skip" - exclude conflicting file from transfer,
+            "error" - raise TransferConflictError
+        max_memory_paths: int
+            Count of target paths stored in memory, more paths are stored in temporary sqlite database
+        workers: int
+            Count of threads for built-in action
+        journal: str or TransferJournal
+            Journal file of processed paths. Paths completed in previous run with the same journal are skipped
 
         Returns
         -------
-        dict
+        dict or TransferResult
+        """
+        if on_conflict not in ('skip', 'error', 'ignore'):
+            raise ValueError('Wrong on_conflict value: {}'.format(on_conflict))
+        result = TransferResult(self.root, other_tree.root)
+        target_paths = _SpillingDict(max_memory_paths)
+        target_listing = _DirListingCache(fs=other_tree.fs)
+        if isinstance(action, str):
+            action = TransferAction(action, workers=workers, filesystem=other_tree.fs, source_filesystem=self.fs)
+        elif isinstance(action, TransferAction) and not (_same_filesystem(action.fs, other_tree.fs)
+                                                         and _same_filesystem(action.source_fs, self.fs)):
+            raise ValueError('Filesystems of {} differ from filesystems of trees'.format(action))
+        if isinstance(journal, (str, os.PathLike)):
+            journal = TransferJournal(journal)
+        if journal and not dry_run:
+            journal.open(self.root, other_tree.root)
+        else:
+            journal = None
+
+        # pattern names of paths submitted to TransferAction, added to result when transfer succeeds
+        pending_names = {}
+        result_lock = threading.Lock()
+
+        def on_done(old, new, error):
+            with result_lock:
+                name = pending_names.pop(old, None)
+                if error:
+                    result.add_failed(old, new, error)
+                elif name is not None:
+                    result.add(old, new, name)
+            if journal:
+                journal.mark_done(old, error)
+
+        if isinstance(action, TransferAction):
+            action.add_callback(on_done)
+        try:
+            for item in self.iter_transfer(other_tree, pattern_names_map, context_keys_map, context_values_map):
+                path, new_path, pat_name, is_dir = item[:4]
+                if new_path is None:
+                    result.add_skipped(path)
+                    continue
+                if journal and journal.is_done(path):
+                    continue
+                if not is_dir:
+                    conflict = None
+                    other_path = target_paths.setdefault(new_path, path)
+                    if other_path != path:
+                        conflict = result.add_conflict(path, new_path, TransferResult.COLLISION, other_path)
+                    elif target_listing.exists(new_path):
+                        conflict = result.add_conflict(path, new_path, TransferResult.EXISTS)
+                    if conflict:
+                        logger.warning('Transfer conflict ({}): {} -> {}'.format(conflict.reason, path, new_path))
+                        if on_conflict == 'error':
+                            raise TransferConflictError('{} -> {} ({})'.format(path, new_path, conflict.reason))
+                        elif on_conflict == 'skip':
+                            continue
+                if isinstance(action, TransferAction) and not dry_run:
+                    if journal:
+                        journal.mark_submitted(path)
+                    with result_lock:
+                        pending_names[path] = pat_name
+                    action.submit(path, new_path, is_dir,
+                                  other_tree.get_path_instance(item.new_pattern_name), item.new_context)
+                    continue
+                elif action and not dry_run:
+                    if journal:
+                        journal.mark_submitted(path)
+                    try:
+                        action(path, new_path)
+                    except Exception as e:
+                        on_done(path, new_path, e)
+                        raise
+                    if journal:
+                        journal.mark_done(path)
+                result.add(path, new_path, pat_name)
+        finally:
+            target_paths.close()
+            if isinstance(action, TransferAction):
+                action.wait()
+                action.remove_callback(on_done)
+            if journal:
+                journal.close()
+        if compact:
+            return result
+        return result.to_dict()
+
+    def iter_transfer(self,
+                      other_tree: 'NamedPathTree',
+                      pattern_names_map: dict | Callable = None,
+                      context_keys_map: dict | Callable = None,
+                      context_values_map: dict | Callable = None):
+        """
+        Iterate all paths of tree with remapped paths in other tree.
+        Arguments are the same as in transfer_to()
+
+        Yields
+        ------
+        TransferItem
+            Source path, target path (None if source path not matched any pattern), pattern name,
+            is directory, target pattern name, target context
         """
         def remap_pattern_name(name: str) -> str:
             if pattern_names_map:
@@ -1033,35 +2597,2952 @@ class NamedPathTreeDrive(NamedPathTree):    # TODO: Work in progress! dont use t
                     return context_values_map[key]
             return value
 
-        skipped_paths = []
-        path_pairs = []
-        for path in Path(self.root).rglob('*'):
+        for path, is_dir in self.iter_entries():
             try:
-                pat_name, context = self.parse(path.as_posix(), True)
+                pat_name, context = self.parse(path, True)
             except NoPatternMatchError as e:
                 logger.warning(f"{e}: {path}")
-                skipped_paths.append(path.as_posix())
+                yield TransferItem(path, None, None, is_dir, None, None)
                 continue
             new_pat_name = remap_pattern_name(pat_name)
             new_context = {remap_context_name(k): replace_context_values(k, v) for k, v in context.items()}
             new_path = other_tree.get_path(new_pat_name, new_context)
-            if action:
-                action(path.as_posix(), new_path)
-            path_pairs.append(dict(old_path=path.as_posix(), new_path=new_path))
-        return dict(
-            remapped_paths=path_pairs,
-            skipped_paths=skipped_paths
-        )
+            yield TransferItem(path, new_path, pat_name, is_dir, new_pat_name, new_context)
 
+    def iter_rebalance(self, shard_roots: list = None, shard_rules: dict = None):
+        """
+        Iterate sharded paths which change volume with new shard roots or rules.
+        Only paths of patterns with own "shard" option are returned, content of them moves together.
 
-def chown(path: str, user: str, group: str):
-    if os.name == 'nt':
-        raise OSError('Not implemented for Windows OS')
-    # TODO: implement for windows
-    import pwd, grp
-    uid = pwd.getpwnam(user).pw_uid
-    gid = grp.getgrnam(group).gr_gid
-    try:
+        Parameters
+        ----------
+        shard_roots: list
+            New shard roots, current by default
+        shard_rules: dict
+            New "shard" options by pattern names
+
+        Yields
+        ------
+        TransferItem
+        """
+        patterns = self.get_patterns()
+        for name, rule in (shard_rules or {}).items():
+            if name.upper() not in patterns:
+                raise PathNameError('Pattern named {} not found'.format(name.upper()))
+            patterns[name.upper()]['shard'] = rule
+        kwargs = dict(self.kwargs)
+        if shard_roots is not None:
+            kwargs['shard_roots'] = shard_roots
+        new_tree = self.__class__(self.root, patterns, default_context=dict(self.default_context), **kwargs)
+        owners = {name for name, options in patterns.items() if options.get('shard')}
+        for item in self.iter_transfer(new_tree):
+            if item.pattern_name in owners and item.old_path != item.new_path:
+                yield item
+
+    def iter_entries(self, path: str = None):
+        """
+        Walk all entries inside roots of tree (or path) in sorted order, directories before their content
+
+        Yields
+        ------
+        tuple
+            Path and is directory flag
+        """
+        if path:
+            stack = [path]
+        else:
+            stack = list(reversed(self._get_walk_roots()))
+        while stack:
+            try:
+                entries = sorted(((entry.path, entry.is_dir(follow_symlinks=False))
+                                  for entry in self.fs.scandir(stack.pop())), reverse=True)
+            except OSError as e:
+                logger.warning('Scan error: {}'.format(e))
+                continue
+            for entry_path, is_dir in reversed(entries):
+                yield entry_path, is_dir
+            stack.extend(entry_path for entry_path, is_dir in entries if is_dir)
+
+
+TransferItem = collections.namedtuple(
+    'TransferItem', ['old_path', 'new_path', 'pattern_name', 'is_dir', 'new_pattern_name', 'new_context'])
+
+
+class TransferAction(object):
+    """
+    Built-in action for NamedPathTreeDrive.transfer_to.
+    Target directories are created once per directory with NamedPathDrive.makedirs,
+    files are processed by pool of threads.
+
+    Modes:
+        move - rename on the same device, copy and remove on different devices
+        copy - copy data and stat, large files are copied with copy_file_range or sendfile
+        hardlink - hard link to source file
+        symlink - symbolic link to source file
+        reflink - copy-on-write clone (FICLONE), copy if filesystem not support it
+
+    All file operations go through filesystem backends. If source backend differs from target one,
+    data is streamed from source to target: move and copy modes are supported, reflink is a copy.
+
+    >>> tree1.transfer_to(tree2, action=TransferAction('hardlink', workers=8))
+    """
+    MOVE = 'move'
+    COPY = 'copy'
+    HARDLINK = 'hardlink'
+    SYMLINK = 'symlink'
+    REFLINK = 'reflink'
+    _chunk_size = 1024 * 1024
+
+    def __init__(self, mode: str = COPY, workers: int = 1, large_file_size: int = None,
+                 max_pending: int = None, filesystem: 'FileSystem' = None, source_filesystem: 'FileSystem' = None):
+        if mode not in (self.MOVE, self.COPY, self.HARDLINK, self.SYMLINK, self.REFLINK):
+            raise ValueError('Wrong transfer mode: {}'.format(mode))
+        self.mode = mode
+        if filesystem is None and large_file_size is not None:
+            filesystem = LocalFileSystem(large_file_size=large_file_size)
+        self.fs = filesystem or _LOCAL_FILESYSTEM
+        self.source_fs = source_filesystem or self.fs
+        self._streamed = not _same_filesystem(self.source_fs, self.fs)
+        if self._streamed and mode in (self.HARDLINK, self.SYMLINK):
+            raise ValueError('Mode {} requires the same source and target filesystem'.format(mode))
+        self.workers = workers
+        self.max_pending = max_pending or workers * 4
+        self._callbacks = []
+        self._dirs = set()
+        self._executor = None
+        self._pending = None
+
+    def __repr__(self):
+        return '<TransferAction {} ({} workers)>'.format(self.mode, self.workers)
+
+    def __call__(self, old_path: str, new_path: str):
+        self.submit(old_path, new_path, self.source_fs.isdir(old_path))
+
+    def add_callback(self, callback: Callable):
+        """
+        Callback receives source path, target path and error or None when file is processed
+        """
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback: Callable):
+        self._callbacks.remove(callback)
+
+    def submit(self, old_path: str, new_path: str, is_dir: bool = False,
+               path_instance: 'NamedPath' = None, context: dict = None):
+        """
+        Process one path. Directories are created immediately, files are processed in pool
+        """
+        try:
+            if is_dir:
+                self._makedirs(new_path, path_instance, context)
+            else:
+                self._makedirs(new_path.rpartition('/')[0] or '/', path_instance, context)
+        except OSError as e:
+            self._done(old_path, new_path, e)
+            return
+        if is_dir:
+            self._done(old_path, new_path, None)
+        elif self.workers > 1:
+            if self._executor is None:
+                self._start_executor()
+            self._pending.acquire()
+            future = self._executor.submit(self._process, old_path, new_path)
+            future.add_done_callback(lambda _: self._pending.release())
+        else:
+            self._process(old_path, new_path)
+
+    def wait(self):
+        """
+        Wait for all submitted files
+        """
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    # processing
+
+    def _start_executor(self):
+        import concurrent.futures
+        import threading
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, 'TransferAction')
+        self._pending = threading.BoundedSemaphore(self.max_pending)
+
+    def _process(self, old_path: str, new_path: str):
+        try:
+            getattr(self, '_%s' % self.mode)(old_path, new_path)
+        except Exception as e:
+            # futures of pool are not read, all errors go to callbacks
+            self._done(old_path, new_path, e)
+        else:
+            self._done(old_path, new_path, None)
+
+    def _done(self, old_path: str, new_path: str, error: Exception = None):
+        if error:
+            logger.warning('Transfer error {} -> {}: {}'.format(old_path, new_path, error))
+        for callback in self._callbacks:
+            callback(old_path, new_path, error)
+
+    def _makedirs(self, path: str, path_instance: 'NamedPath' = None, context: dict = None):
+        if path in self._dirs:
+            return
+        if path_instance is not None and context is not None and hasattr(path_instance, 'makedirs'):
+            try:
+                path_instance.makedirs(context, skip_context_errors=True)
+            except (OSError, KeyError, PathContextError) as e:
+                logger.warning('Can not create dirs of {}: {}'.format(path_instance.name, e))
+        self.fs.makedirs(path)
+        self._dirs.add(path)
+
+    def _move(self, old_path: str, new_path: str):
+        import errno
+
+        if self._streamed:
+            self._stream(old_path, new_path)
+            self.source_fs.unlink(old_path)
+            return
+        try:
+            self.fs.rename(old_path, new_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # different devices
+            self.fs.copy(old_path, new_path)
+            self.fs.unlink(old_path)
+
+    def _copy(self, old_path: str, new_path: str):
+        if self._streamed:
+            self._stream(old_path, new_path)
+        else:
+            self.fs.copy(old_path, new_path)
+
+    def _hardlink(self, old_path: str, new_path: str):
+        self.fs.link(old_path, new_path)
+
+    def _symlink(self, old_path: str, new_path: str):
+        self.fs.symlink(old_path, new_path)
+
+    def _reflink(self, old_path: str, new_path: str):
+        if self._streamed:
+            self._stream(old_path, new_path)
+        else:
+            self.fs.reflink(old_path, new_path)
+
+    def _stream(self, old_path: str, new_path: str):
+        """
+        Copy file between different backends, symbolic link is copied as link
+        """
+        import stat
+
+        st = self.source_fs.lstat(old_path)
+        if stat.S_ISLNK(st.st_mode):
+            self.fs.symlink(self.source_fs.readlink(old_path), new_path)
+            return
+        with self.source_fs.open(old_path, 'rb') as src:
+            with self.fs.open(new_path, 'xb') as dst:
+                while True:
+                    chunk = src.read(self._chunk_size)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+        if self.fs.supports_dirs:
+            self.fs.chmod(new_path, stat.S_IMODE(st.st_mode))
+
+
+class TransferJournal(object):
+    """
+    Journal of transfer job stored as text file.
+    Each processed source path is written relative to source root with status, so that
+    next run with the same journal skips completed paths and repeats failed ones.
+    Completed paths are kept in memory as 64-bit hashes.
+
+    >>> journal = TransferJournal('/tmp/transfer.journal')
+    >>> tree1.transfer_to(tree2, action='copy', workers=8, journal=journal)
+    >>> journal.get_status()
+    >>> {'done': 1200, 'resumed': 800, 'failed': 2, 'pending': 0, 'elapsed': 10.2, 'throughput': 39.2}
+    """
+    DONE = 'D'
+    FAILED = 'F'
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        import threading
+
+        self.path = _as_posix(path)
+        self.flush_interval = flush_interval
+        self.source_root = None
+        self.target_root = None
+        self._done = set()
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._resumed = 0
+        self._start_time = None
+        self._flush_time = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<TransferJournal "{}">'.format(self.path)
+
+    def open(self, source_root: str, target_root: str):
+        """
+        Load completed paths and open journal for writing
+        """
+        import time
+
+        header = '# {}\t{}\n'.format(source_root, target_root)
+        self.source_root = source_root
+        self.target_root = target_root
+        self._done.clear()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                first_line = f.readline()
+                if first_line and first_line != header:
+                    raise ValueError('Journal {} is created for other trees: {}'.format(
+                        self.path, first_line.strip('# \n')))
+                for line in f:
+                    status, _, rel_path = line.rstrip('\n').partition('\t')
+                    rel_path = rel_path.partition('\t')[0]
+                    if status == self.DONE:
+                        self._done.add(self._hash(rel_path))
+                    elif status == self.FAILED:
+                        self._done.discard(self._hash(rel_path))
+        self._file = open(self.path, 'a')
+        if not self._file.tell():
+            self._file.write(header)
+        self._start_time = time.time()
+
+    def close(self):
+        if self._file:
+            with self._lock:
+                self._file.close()
+                self._file = None
+
+    def is_done(self, path: str) -> bool:
+        """
+        Path completed in previous run
+        """
+        if self._hash(self._relative(path)) in self._done:
+            self._resumed += 1
+            return True
+        return False
+
+    def mark_submitted(self, path: str):
+        with self._lock:
+            self._submitted += 1
+
+    def mark_done(self, path: str, error: Exception = None):
+        """
+        Write path status, error means failed path
+        """
+        import time
+
+        rel_path = self._relative(path)
+        with self._lock:
+            if error:
+                self._failed += 1
+                self._file.write('{}\t{}\t{}\n'.format(self.FAILED, rel_path, ' '.join(str(error).split())))
+            else:
+                self._completed += 1
+                self._done.add(self._hash(rel_path))
+                self._file.write('{}\t{}\n'.format(self.DONE, rel_path))
+            now = time.time()
+            if now - self._flush_time > self.flush_interval:
+                self._file.flush()
+                self._flush_time = now
+
+    def get_status(self) -> dict:
+        """
+        Counters of current run
+
+        Returns
+        -------
+        dict
+            done - completed in this run, resumed - skipped as completed in previous run,
+            failed, pending - submitted and not completed, elapsed - seconds, throughput - done per second
+        """
+        import time
+
+        elapsed = time.time() - self._start_time if self._start_time else 0
+        return dict(
+            done=self._completed,
+            resumed=self._resumed,
+            failed=self._failed,
+            pending=self._submitted - self._completed - self._failed,
+            elapsed=elapsed,
+            throughput=self._completed / elapsed if elapsed else 0
+        )
+
+    def _relative(self, path: str) -> str:
+        if self.source_root and path.startswith(self.source_root + '/'):
+            return path[len(self.source_root) + 1:]
+        return path
+
+    @staticmethod
+    def _hash(rel_path: str) -> int:
+        import hashlib
+
+        return int.from_bytes(hashlib.blake2b(rel_path.encode(errors='surrogateescape'), digest_size=8).digest(),
+                              'little')
+
+
+class _SpillingDict(object):
+    """
+    String mapping stored in memory until size limit, then moved to temporary sqlite database
+    """
+
+    def __init__(self, max_memory_items: int = 1000000):
+        self.max_memory_items = max_memory_items
+        self._items = {}
+        self._db = None
+        self._db_dir = None
+
+    def __len__(self):
+        if self._db:
+            return self._db.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+        return len(self._items)
+
+    def setdefault(self, key: str, value: str) -> str:
+        """
+        Set value if key not exists and return current value
+        """
+        if self._db is None:
+            current = self._items.setdefault(key, value)
+            if len(self._items) > self.max_memory_items:
+                self._spill()
+            return current
+        row = self._db.execute('SELECT value FROM items WHERE key = ?', (key,)).fetchone()
+        if row:
+            return row[0]
+        self._db.execute('INSERT INTO items VALUES (?, ?)', (key, value))
+        return value
+
+    def close(self):
+        if self._db:
+            self._db.close()
+            self._db = None
+            import shutil
+            shutil.rmtree(self._db_dir, ignore_errors=True)
+        self._items.clear()
+
+    def _spill(self):
+        import sqlite3
+        import tempfile
+
+        self._db_dir = tempfile.mkdtemp(prefix='namedpath_')
+        self._db = sqlite3.connect(os.path.join(self._db_dir, 'items.db'), isolation_level=None)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute('CREATE TABLE items (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID')
+        self._db.executemany('INSERT INTO items VALUES (?, ?)', self._items.items())
+        self._items.clear()
+        logger.debug('Paths moved to {}'.format(self._db_dir))
+
+
+class _DirListingCache(object):
+    """
+    Existence check using cached listings of recently used directories
+    """
+
+    def __init__(self, max_dirs: int = 1024, fs: 'FileSystem' = None):
+        self.max_dirs = max_dirs
+        self.fs = fs or _LOCAL_FILESYSTEM
+        self._dirs = collections.OrderedDict()
+
+    def exists(self, path: str) -> bool:
+        dir_name, _, name = path.rpartition('/')
+        if dir_name in self._dirs:
+            self._dirs.move_to_end(dir_name)
+        else:
+            try:
+                self._dirs[dir_name] = frozenset(self.fs.listdir(dir_name or '/'))
+            except OSError:
+                self._dirs[dir_name] = frozenset()
+            if len(self._dirs) > self.max_dirs:
+                self._dirs.popitem(last=False)
+        return name in self._dirs[dir_name]
+
+
+class NamedPathIndex(object):
+    """
+    In-memory index of existing paths.
+    Entries are grouped by pattern name, context values are stored in columns of integer codes.
+    Paths are stored relative to tree root, paths on shard roots outside of it are stored as absolute.
+
+    >>> index = NamedPathIndex(tree).scan()
+    >>> index.latest('SHOT_PUBLISH', {'ENTITY_NAME': 'sh010'}, key='VERSION')
+    >>> ('/mnt/prj/shots/sh010/publish/v003', {'PROJECT_NAME': 'prj', 'ENTITY_NAME': 'sh010', 'VERSION': 3})
+    """
+
+    def __init__(self, tree: 'NamedPathTree', names: list = None):
+        self.tree = tree
+        self.names = set(x.upper() for x in names) if names else None
+        self._tables = {}
+        self._path_names = {}
+
+    def __repr__(self):
+        return '<NamedPathIndex "{}" ({})>'.format(self.root, len(self))
+
+    def __len__(self):
+        return len(self._path_names)
+
+    def __contains__(self, path):
+        return self._relative(path) in self._path_names
+
+    @property
+    def root(self) -> str:
+        return self.tree.root
+
+    # update
+
+    def scan(self, path: str = None) -> 'NamedPathIndex':
+        """
+        Scan root or subtree and add all matched paths.
+        Existing entries of subtree are removed before scanning.
+
+        Parameters
+        ----------
+        path: str
+            Subtree path, all roots of tree by default
+
+        Returns
+        -------
+        NamedPathIndex
+        """
+        if path is None:
+            for root in self.tree._get_walk_roots():
+                self.scan(root)
+            return self
+        path = _as_posix(path)
+        fs = self.tree.fs
+        self.remove(path, recursive=True)
+        if fs.isdir(path):
+            if path != self.root:
+                self.add(path)
+            stack = [path]
+            while stack:
+                try:
+                    for entry in fs.scandir(stack.pop()):
+                        self.add(entry.path)
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                except OSError as e:
+                    logger.warning('Scan error: {}'.format(e))
+        elif fs.exists(path):
+            self.add(path)
+        return self
+
+    def refresh(self, path: str) -> 'NamedPathIndex':
+        """
+        Rescan single subtree
+        """
+        return self.scan(path)
+
+    def load_manifest(self, manifest) -> 'NamedPathIndex':
+        """
+        Add paths from manifest without disk access
+
+        Parameters
+        ----------
+        manifest: str or list
+            Text file with one path per line or list of paths.
+            Relative paths are relative to the root
+
+        Returns
+        -------
+        NamedPathIndex
+        """
+        if isinstance(manifest, (str, os.PathLike)):
+            with open(manifest) as f:
+                manifest = [line.rstrip('\n') for line in f]
+        for path in manifest:
+            if path:
+                self.add(path if os.path.isabs(path) else '/'.join([self.root, path]))
+        return self
+
+    def add(self, path: str) -> tuple:
+        """
+        Parse path and add it to index
+
+        Returns
+        -------
+        tuple or None
+            Pattern name and context
+        """
+        path = _as_posix(path)
+        try:
+            name, context = self.tree.parse(path, with_context=True)
+        except (NoPatternMatchError, MultiplePatternMatchError):
+            return None
+        if self.names is not None and name not in self.names:
+            return None
+        rel_path = self._relative(path)
+        if rel_path in self._path_names:
+            self._tables[self._path_names[rel_path]].remove(rel_path)
+        if name not in self._tables:
+            self._tables[name] = _IndexTable()
+        self._tables[name].add(rel_path, context)
+        self._path_names[rel_path] = name
+        return name, context
+
+    def remove(self, path: str, recursive: bool = False) -> list:
+        """
+        Remove path from index
+
+        Parameters
+        ----------
+        path: str
+        recursive: bool
+            Remove all paths inside
+
+        Returns
+        -------
+        list
+            Removed entries as tuples of pattern name, full path and context
+        """
+        removed = list(self.iter_subtree(path, recursive))
+        for name, full_path, _ in removed:
+            rel_path = self._relative(full_path)
+            self._tables[self._path_names.pop(rel_path)].remove(rel_path)
+        return removed
+
+    def iter_subtree(self, path: str, recursive: bool = True):
+        """
+        Iterate indexed entries of path and paths inside
+
+        Yields
+        ------
+        tuple
+            Pattern name, full path and context
+        """
+        rel_path = self._relative(_as_posix(path))
+        rel_paths = []
+        if rel_path in self._path_names:
+            rel_paths.append(rel_path)
+        if recursive:
+            if rel_path:
+                prefix = rel_path + '/'
+                rel_paths.extend(x for x in self._path_names if x.startswith(prefix))
+            else:
+                # absolute paths are outside of root
+                rel_paths.extend(x for x in self._path_names if x and not x.startswith('/'))
+        for rel_path in rel_paths:
+            name = self._path_names[rel_path]
+            yield name, self._full(rel_path), self._tables[name].get_row(rel_path)
+
+    # queries
+
+    def get_names(self) -> tuple:
+        return tuple(sorted(name for name, table in self._tables.items() if len(table)))
+
+    def iter_entries(self, name: str, context: dict = None):
+        """
+        Iterate paths of pattern matched with context
+
+        Yields
+        ------
+        tuple
+            Full path and context
+        """
+        table = self._tables.get(name.upper())
+        if table is None:
+            return
+        for rel_path, ctx in table.iter_rows(context):
+            yield self._full(rel_path), ctx
+
+    def find(self, name: str, context: dict = None) -> list:
+        """
+        All indexed paths of pattern matched with context
+        """
+        return [path for path, _ in self.iter_entries(name, context)]
+
+    def list_values(self, name: str, key: str, context: dict = None) -> list:
+        """
+        Sorted unique values of context variable
+        """
+        table = self._tables.get(name.upper())
+        if table is None:
+            return []
+        return sorted(table.get_values(key, context), key=lambda x: (str(type(x)), x))
+
+    def latest(self, name: str, context: dict = None, key: str = 'VERSION') -> tuple:
+        """
+        Entry with max value of variable
+
+        Returns
+        -------
+        tuple or None
+            Full path and context
+        """
+        result = None
+        for path, ctx in self.iter_entries(name, context):
+            if ctx.get(key) is None:
+                continue
+            if result is None or ctx[key] > result[1][key]:
+                result = path, ctx
+        return result
+
+    # utils
+
+    def _relative(self, path: str) -> str:
+        """
+        Key of path, path outside of root is kept absolute
+        """
+        if path == self.root:
+            return ''
+        if path.startswith(self.root + '/'):
+            return path[len(self.root) + 1:]
+        return path
+
+    def _full(self, rel_path: str) -> str:
+        if not rel_path:
+            return self.root
+        if rel_path.startswith('/'):
+            return rel_path
+        return '/'.join([self.root, rel_path])
+
+
+class NamedPathWatcher(object):
+    """
+    Keep NamedPathIndex updated with filesystem changes.
+    Uses inotify on Linux and polling of directories modification time on other systems
+    and filesystem backends.
+    Subscribers receive pattern name, context and event type for each matched path.
+
+    >>> watcher = NamedPathWatcher(index)
+    >>> watcher.subscribe(lambda name, context, event: print(name, context, event))
+    >>> watcher.start()
+    """
+    CREATED = 'created'
+    DELETED = 'deleted'
+    MOVED_FROM = 'moved_from'
+    MOVED_TO = 'moved_to'
+
+    # inotify flags
+    _IN_MOVED_FROM = 0x00000040
+    _IN_MOVED_TO = 0x00000080
+    _IN_CREATE = 0x00000100
+    _IN_DELETE = 0x00000200
+    _IN_Q_OVERFLOW = 0x00004000
+    _IN_IGNORED = 0x00008000
+    _IN_ONLYDIR = 0x01000000
+    _IN_ISDIR = 0x40000000
+
+    def __init__(self, index: NamedPathIndex, poll_interval: float = 2.0, use_inotify: bool = None):
+        self.index = index
+        self.poll_interval = poll_interval
+        self._subscribers = []
+        self._thread = None
+        self._stop = None
+        self._libc = None
+        self._fd = None
+        self._watches = {}
+        self._dirs = {}
+        self.max_depth = max([len(c) for p in index.tree.iter_patterns() for c in p.get_components()] or [0])
+        self.fs = index.tree.fs
+        if use_inotify is None:
+            use_inotify = sys.platform.startswith('linux')
+        if use_inotify and isinstance(self.fs, LocalFileSystem):
+            self._libc = self._load_libc()
+
+    def __repr__(self):
+        return '<NamedPathWatcher "{}" ({})>'.format(self.index.root, self.backend)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def backend(self) -> str:
+        return 'inotify' if self._libc is not None else 'polling'
+
+    def subscribe(self, callback: Callable):
+        """
+        Add event callback. Callback receives pattern name, context and event type
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable):
+        self._subscribers.remove(callback)
+
+    # loop
+
+    def start(self):
+        """
+        Start watching in background thread
+        """
+        if self._thread:
+            return
+        self.setup()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='NamedPathWatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._watches.clear()
+            self._dirs.clear()
+
+    def setup(self):
+        """
+        Register directories for watching. Call it before first poll() if you do not use start()
+        """
+        if self._libc is not None and self._fd is None:
+            self._open_inotify()
+        for root in self.index.tree._get_walk_roots():
+            for path, depth in self._iter_dirs(root, 0):
+                self._add_dir(path)
+
+    def poll(self, timeout: float = 0):
+        """
+        Process changes once
+        """
+        if self._fd is not None:
+            self._poll_inotify(timeout)
+        else:
+            self._poll_dirs()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._fd is not None:
+                    self._poll_inotify(min(self.poll_interval, 0.5))
+                else:
+                    self._poll_dirs()
+                    self._stop.wait(self.poll_interval)
+            except Exception as e:
+                logger.exception('Watcher error: {}'.format(e))
+
+    # events
+
+    def _emit(self, name: str, context: dict, event: str):
+        for callback in list(self._subscribers):
+            try:
+                callback(name, context, event)
+            except Exception as e:
+                logger.exception('Watcher callback error: {}'.format(e))
+
+    def _on_created(self, path: str, is_dir: bool, event: str = CREATED):
+        if is_dir:
+            if self._get_depth(path) < self.max_depth:
+                for dir_path, _ in self._iter_dirs(path, self._get_depth(path)):
+                    self._add_dir(dir_path)
+            known = set(x[1] for x in self.index.iter_subtree(path))
+            self.index.scan(path)
+            for name, full_path, context in self.index.iter_subtree(path):
+                if full_path not in known:
+                    self._emit(name, context, event)
+        elif path not in self.index:
+            result = self.index.add(path)
+            if result:
+                self._emit(result[0], result[1], event)
+
+    def _on_deleted(self, path: str, event: str = DELETED):
+        self._remove_dir(path)
+        for name, _, context in self.index.remove(path, recursive=True):
+            self._emit(name, context, event)
+
+    def _resync(self):
+        roots = self.index.tree._get_walk_roots()
+        before = {path: (name, context) for root in roots for name, path, context in self.index.iter_subtree(root)}
+        self.setup()
+        self.index.scan()
+        after = {path: (name, context) for root in roots for name, path, context in self.index.iter_subtree(root)}
+        for path, (name, context) in before.items():
+            if path not in after:
+                self._emit(name, context, self.DELETED)
+        for path, (name, context) in after.items():
+            if path not in before:
+                self._emit(name, context, self.CREATED)
+
+    # inotify
+
+    @staticmethod
+    def _load_libc():
+        import ctypes
+        import ctypes.util
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            logger.debug('Inotify not available: {}'.format(e))
+            return None
+        return libc
+
+    def _open_inotify(self):
+        import ctypes
+
+        fd = self._libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if fd < 0:
+            logger.debug('Inotify not available: errno {}'.format(ctypes.get_errno()))
+            # fall back to polling
+            self._libc = None
+            return
+        self._fd = fd
+
+    def _poll_inotify(self, timeout: float):
+        import select
+        import struct
+
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            offset += 16
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='surrogateescape')
+            offset += length
+            if mask & self._IN_Q_OVERFLOW:
+                logger.warning('Inotify queue overflow, rescan {}'.format(self.index.root))
+                self._resync()
+                continue
+            if mask & self._IN_IGNORED:
+                parent = self._watches.pop(wd, None)
+                if parent is not None and self._dirs.get(parent) == wd:
+                    self._dirs.pop(parent)
+                continue
+            parent = self._watches.get(wd)
+            if parent is None or not name:
+                continue
+            path = '/'.join([parent, name])
+            is_dir = bool(mask & self._IN_ISDIR)
+            if mask & self._IN_CREATE:
+                self._on_created(path, is_dir)
+            elif mask & self._IN_MOVED_TO:
+                self._on_created(path, is_dir, self.MOVED_TO)
+            elif mask & self._IN_DELETE:
+                self._on_deleted(path)
+            elif mask & self._IN_MOVED_FROM:
+                self._on_deleted(path, self.MOVED_FROM)
+
+    # dirs
+
+    def _add_dir(self, path: str):
+        if path in self._dirs:
+            return
+        if self._fd is not None:
+            mask = self._IN_CREATE | self._IN_DELETE | self._IN_MOVED_FROM | self._IN_MOVED_TO | self._IN_ONLYDIR
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+            if wd < 0:
+                logger.warning('Can not watch {}'.format(path))
+                return
+            self._watches[wd] = path
+            self._dirs[path] = wd
+        else:
+            self._dirs[path] = self._get_dir_state(path)
+
+    def _remove_dir(self, path: str):
+        prefix = path + '/'
+        for dir_path in [x for x in self._dirs if x == path or x.startswith(prefix)]:
+            value = self._dirs.pop(dir_path)
+            if self._fd is not None:
+                self._watches.pop(value, None)
+                self._libc.inotify_rm_watch(self._fd, value)
+
+    def _iter_dirs(self, path: str, depth: int):
+        yield path, depth
+        if depth + 1 >= self.max_depth:
+            return
+        try:
+            dirs = [entry.path for entry in self.fs.scandir(path) if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            return
+        for dir_path in dirs:
+            for item in self._iter_dirs(dir_path, depth + 1):
+                yield item
+
+    def _get_depth(self, path: str) -> int:
+        for root in self.index.tree._get_walk_roots():
+            if path == root:
+                return 0
+            if path.startswith(root.rstrip('/') + '/'):
+                return path[len(root.rstrip('/')) + 1:].count('/') + 1
+        return 0
+
+    # polling
+
+    def _get_dir_state(self, path: str):
+        import time
+
+        scan_time = time.time_ns()
+        try:
+            mtime = self.fs.stat(path).st_mtime_ns
+            names = {entry.name: entry.is_dir(follow_symlinks=False) for entry in self.fs.scandir(path)}
+        except OSError:
+            return None
+        return mtime, scan_time, names
+
+    def _poll_dirs(self):
+        for path, state in list(self._dirs.items()):
+            if path not in self._dirs:
+                continue
+            try:
+                mtime = self.fs.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            # mtime resolution can be coarse, recently changed dirs are listed again
+            if state and mtime == state[0] and state[1] - mtime > 1e9:
+                continue
+            new_state = self._get_dir_state(path)
+            if new_state is None:
+                continue
+            self._dirs[path] = new_state
+            old_names = state[2] if state else {}
+            for name in old_names:
+                if name not in new_state[2]:
+                    self._on_deleted('/'.join([path, name]))
+            for name, is_dir in new_state[2].items():
+                if name not in old_names:
+                    self._on_created('/'.join([path, name]), is_dir)
+
+
+class _IndexTable(object):
+    """
+    Columnar storage of one pattern entries.
+    Each column keeps the list of unique values and integer codes per row.
+    """
+    __slots__ = ('paths', 'rows', 'columns', 'values', 'codes', 'removed')
+
+    def __init__(self):
+        self._reset()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _reset(self):
+        self.paths = []
+        self.rows = {}
+        self.columns = {}
+        self.values = {}
+        self.codes = {}
+        self.removed = 0
+
+    def add(self, rel_path: str, context: dict):
+        row = len(self.paths)
+        self.paths.append(rel_path)
+        self.rows[rel_path] = row
+        for key in context:
+            if key not in self.columns:
+                self.columns[key] = array('l', [self._get_code(key, None)] * row)
+        for key, column in self.columns.items():
+            column.append(self._get_code(key, context.get(key)))
+
+    def remove(self, rel_path: str):
+        row = self.rows.pop(rel_path, None)
+        if row is None:
+            return
+        self.paths[row] = None
+        self.removed += 1
+        if self.removed > len(self.rows):
+            self._compact()
+
+    def iter_rows(self, context: dict = None):
+        filters = []
+        for key, value in (context or {}).items():
+            code = self.codes.get(key.upper(), {}).get(value)
+            if code is None:
+                return
+            filters.append((self.columns[key.upper()], code))
+        for row, rel_path in enumerate(self.paths):
+            if rel_path is None:
+                continue
+            if all(column[row] == code for column, code in filters):
+                yield rel_path, self._get_context(row)
+
+    def get_values(self, key: str, context: dict = None) -> set:
+        key = key.upper()
+        if key not in self.columns:
+            return set()
+        if context:
+            values = set(ctx[key] for _, ctx in self.iter_rows(context))
+        else:
+            column = self.columns[key]
+            values = set(self.values[key][column[row]] for row, path in enumerate(self.paths) if path is not None)
+        values.discard(None)
+        return values
+
+    def get_row(self, rel_path: str) -> dict:
+        return self._get_context(self.rows[rel_path])
+
+    def _get_context(self, row: int) -> dict:
+        return {key: self.values[key][column[row]] for key, column in self.columns.items()
+                if self.values[key][column[row]] is not None}
+
+    def _get_code(self, key: str, value) -> int:
+        codes = self.codes.setdefault(key, {})
+        if value not in codes:
+            codes[value] = len(codes)
+            self.values.setdefault(key, []).append(value)
+        return codes[value]
+
+    def _compact(self):
+        rows = [(path, self._get_context(row)) for row, path in enumerate(self.paths) if path is not None]
+        self._reset()
+        for path, context in rows:
+            self.add(path, context)
+
+
+class NamedPathCatalog(object):
+    """
+    Persistent catalog of existing paths in SQLite database.
+    Each entry has pattern name, stat fields and context values in columns created from
+    variables of tree (get_all_required_variables), all variables are indexed together with pattern name.
+    Column is INTEGER or REAL if any pattern declares the variable numeric with option "types"
+    or format spec, other columns are TEXT and can not be compared with numbers.
+    Queries do not touch storage.
+
+    >>> catalog = NamedPathCatalog(tree, '/mnt/prj/.catalog.db').scan()
+    >>> catalog.find('SHOT_PUBLISH', {'ENTITY_NAME': 'sh010'}, where=[('VERSION', '>', 12)])
+    >>> catalog.refresh('/mnt/prj/shots/sh010')
+    """
+    OPERATORS = ('=', '!=', '<', '<=', '>', '>=', 'in', 'like')
+    _NUMERIC_OPERATORS = ('<', '<=', '>', '>=')
+    _batch_size = 10000
+
+    def __init__(self, tree: 'NamedPathTree', db_path: str | os.PathLike = ':memory:', names: list = None):
+        import sqlite3
+
+        self.tree = tree
+        self.db_path = os.fspath(db_path)
+        self.names = set(x.upper() for x in names) if names else None
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._columns = []
+        self._column_types = {}
+        self._staging_count = 0
+        self._init_schema()
+
+    def __repr__(self):
+        return '<NamedPathCatalog "{}" ({})>'.format(self.db_path, len(self))
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM entries')[0][0]
+
+    def __contains__(self, path):
+        return bool(self._query('SELECT 1 FROM entries WHERE path = ?', [_as_posix(path)]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    @property
+    def root(self) -> str:
+        return self.tree.root
+
+    @property
+    def columns(self) -> list:
+        """
+        Names of context columns
+        """
+        return list(self._columns)
+
+    def _init_schema(self):
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, pattern TEXT NOT NULL, '
+                             'is_dir INTEGER, size INTEGER, mtime_ns INTEGER)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS idx_entries_pattern ON entries (pattern)')
+            existing = {row[1]: row[2].upper() for row in self._db.execute('PRAGMA table_info(entries)')}
+            existing = {name: existing[name] for name in list(existing)[5:]}
+            column_types = self._get_column_types()
+            for name in sorted(set(x.upper() for x in self.tree.get_all_required_variables()) - set(existing)):
+                existing[name] = column_types.get(name, 'TEXT')
+                self._db.execute('ALTER TABLE entries ADD COLUMN %s %s' % (self._quote(name), existing[name]))
+                self._db.execute('CREATE INDEX IF NOT EXISTS %s ON entries (pattern, %s)' % (
+                    self._quote('idx_entries_' + name), self._quote(name)))
+        self._columns = list(existing)
+        self._column_types = existing
+
+    def _get_column_types(self) -> dict:
+        """
+        INTEGER or REAL type of variables declared numeric in any pattern
+        """
+        column_types = {}
+        for pattern in self.tree.iter_patterns():
+            types_option = {k.upper(): v for k, v in (pattern.options.get('types') or {}).items()}
+            for variable in re.findall(r'{(.*?)}', pattern.path):
+                name, _, spec = variable.partition(':')
+                name = name.split('|')[0].upper()
+                if '|' in variable:
+                    # filters return strings
+                    continue
+                tp = types_option.get(name)
+                spec_type = spec[-1:] if spec else ''
+                if tp == 'float' or (not tp and spec_type in ('e', 'E', 'f', 'F', 'g', 'G')):
+                    column_types[name] = 'REAL'
+                elif (tp == 'int' or (not tp and spec_type in ('d', 'n'))) and column_types.get(name) != 'REAL':
+                    column_types[name] = 'INTEGER'
+        return column_types
+
+    @staticmethod
+    def _quote(name: str) -> str:
+        return '"%s"' % name.replace('"', '""')
+
+    def _query(self, sql: str, params: list = ()) -> list:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    # update
+
+    def scan(self, path: str = None) -> 'NamedPathCatalog':
+        """
+        Scan root or subtree and replace its entries
+
+        Parameters
+        ----------
+        path: str
+            Subtree path, all roots of tree by default
+
+        Returns
+        -------
+        NamedPathCatalog
+        """
+        paths = [_as_posix(path)] if path else self.tree._get_walk_roots()
+        # rows are collected in temporary table without blocking queries,
+        # entries of subtree are replaced in one short transaction
+        with self._lock:
+            self._staging_count += 1
+            staging = 'temp.staging_%d' % self._staging_count
+            self._db.execute('CREATE TABLE %s AS SELECT * FROM entries WHERE 0' % staging)
+        try:
+            rows = []
+            for root in paths:
+                for row in self._iter_rows(root):
+                    rows.append(row)
+                    if len(rows) >= self._batch_size:
+                        self._insert(rows, staging)
+                        rows = []
+            self._insert(rows, staging)
+            with self._lock, self._db:
+                for root in paths:
+                    self._delete(root, recursive=True)
+                self._db.execute('INSERT OR REPLACE INTO entries SELECT * FROM %s' % staging)
+        finally:
+            with self._lock:
+                self._db.execute('DROP TABLE IF EXISTS %s' % staging)
+        return self
+
+    def _iter_rows(self, path: str):
+        """
+        Rows of existing path and all paths inside
+        """
+        fs = self.tree.fs
+        try:
+            st = fs.lstat(path)
+        except OSError:
+            return
+        if path != self.root:
+            yield self._make_row(path, st)
+        stack = [path] if _StatEntry(path, st, fs).is_dir(follow_symlinks=False) else []
+        while stack:
+            try:
+                entries = fs.scandir(stack.pop())
+            except OSError as e:
+                logger.warning('Scan error: {}'.format(e))
+                continue
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                yield self._make_row(entry.path, st)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+
+    def refresh(self, path: str) -> 'NamedPathCatalog':
+        """
+        Rescan single subtree
+        """
+        return self.scan(path)
+
+    def load_manifest(self, manifest) -> 'NamedPathCatalog':
+        """
+        Add paths from manifest without disk access, stat fields are empty
+
+        Parameters
+        ----------
+        manifest: str or list
+            Text file with one path per line or list of paths.
+            Relative paths are relative to the root
+
+        Returns
+        -------
+        NamedPathCatalog
+        """
+        if isinstance(manifest, (str, os.PathLike)):
+            with open(manifest) as f:
+                manifest = [line.rstrip('\n') for line in f]
+        self._insert([self._make_row(path if path.startswith('/') else '/'.join([self.root, path]))
+                      for path in manifest if path])
+        return self
+
+    def add(self, path: str, st=None) -> tuple:
+        """
+        Parse path and add it to catalog
+
+        Parameters
+        ----------
+        path: str
+        st: os.stat_result
+            Stat of path, empty stat fields if None
+
+        Returns
+        -------
+        tuple or None
+            Pattern name and context
+        """
+        row = self._make_row(_as_posix(path), st)
+        if row is None:
+            return None
+        self._insert([row])
+        return row[1], {k: v for k, v in zip(self._columns, row[5:]) if v is not None}
+
+    def remove(self, path: str, recursive: bool = False) -> int:
+        """
+        Remove path (and all paths inside) from catalog
+
+        Returns
+        -------
+        int
+            Count of removed entries
+        """
+        with self._lock, self._db:
+            return self._delete(_as_posix(path), recursive)
+
+    def _delete(self, path: str, recursive: bool) -> int:
+        if recursive:
+            prefix = path.rstrip('/')
+            # range of primary key: all paths starting with prefix/
+            return self._db.execute('DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)',
+                                    [path, prefix + '/', prefix + '0']).rowcount
+        return self._db.execute('DELETE FROM entries WHERE path = ?', [path]).rowcount
+
+    def _make_row(self, path: str, st=None) -> tuple:
+        try:
+            name, context = self.tree.parse(path, with_context=True)
+        except (NoPatternMatchError, MultiplePatternMatchError):
+            return None
+        if self.names is not None and name not in self.names:
+            return None
+        if st is None:
+            is_dir = size = mtime_ns = None
+        else:
+            import stat
+
+            is_dir = int(stat.S_ISDIR(st.st_mode))
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        unknown = set(context) - set(self._columns)
+        if unknown:
+            logger.warning('No catalog columns for {}: {}'.format(', '.join(sorted(unknown)), path))
+        return (path, name, is_dir, size, mtime_ns) + tuple(context.get(x) for x in self._columns)
+
+    def _insert(self, rows: list, table: str = 'entries'):
+        rows = [x for x in rows if x is not None]
+        if not rows:
+            return
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO %s VALUES (%s)' % (table, ', '.join(
+                '?' * (5 + len(self._columns)))), rows)
+
+    # queries
+
+    def get_names(self) -> tuple:
+        return tuple(row[0] for row in self._query('SELECT DISTINCT pattern FROM entries ORDER BY pattern'))
+
+    def iter_entries(self, name: str, context: dict = None, where: list = None, order_by: str = None,
+                     limit: int = None):
+        """
+        Iterate paths of pattern matched with context and conditions
+
+        Parameters
+        ----------
+        name: str
+        context: dict
+            Equal values of variables
+        where: list
+            Conditions (variable, operator, value), operators: =, !=, <, <=, >, >=, in, like
+        order_by: str
+            Variable or stat field, "-" prefix for descending order
+        limit: int
+
+        Yields
+        ------
+        tuple
+            Full path and context
+        """
+        sql, params = self._build_query('SELECT * FROM entries', name, context, where)
+        if order_by:
+            column = order_by.lstrip('-')
+            self._check_column(column, stat_fields=True)
+            sql += ' ORDER BY %s %s' % (self._quote(column), 'DESC' if order_by.startswith('-') else 'ASC')
+        if limit:
+            sql += ' LIMIT %d' % limit
+        for row in self._query(sql, params):
+            yield row[0], {k: v for k, v in zip(self._columns, row[5:]) if v is not None}
+
+    def find(self, name: str, context: dict = None, where: list = None) -> list:
+        """
+        All catalog paths of pattern matched with context and conditions
+        """
+        return [path for path, _ in self.iter_entries(name, context, where, order_by='path')]
+
+    def list_values(self, name: str, key: str, context: dict = None, where: list = None) -> list:
+        """
+        Sorted unique values of context variable
+        """
+        self._check_column(key)
+        sql, params = self._build_query('SELECT DISTINCT %s FROM entries' % self._quote(key), name, context, where)
+        values = [row[0] for row in self._query(sql, params) if row[0] is not None]
+        return sorted(values, key=lambda x: (str(type(x)), x))
+
+    def latest(self, name: str, context: dict = None, key: str = 'VERSION', where: list = None) -> tuple:
+        """
+        Entry with max value of numeric variable
+
+        Returns
+        -------
+        tuple or None
+            Full path and context
+        """
+        self._check_column(key)
+        if not self._is_numeric(key):
+            raise ValueError('Column {} is not numeric, declare type of variable with option "types"'.format(key))
+        where = list(where or []) + [(key, '!=', None)]
+        return next(self.iter_entries(name, context, where, order_by='-' + key, limit=1), None)
+
+    def get_usage(self, name: str, context: dict = None, where: list = None) -> tuple:
+        """
+        Count of files and sum of sizes from stored stat fields
+        """
+        sql, params = self._build_query('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries', name, context,
+                                        list(where or []) + [('is_dir', '=', 0)])
+        return tuple(self._query(sql, params)[0])
+
+    def _build_query(self, sql: str, name: str, context: dict = None, where: list = None) -> tuple:
+        conditions = ['pattern = ?']
+        params = [name.upper()]
+        where = [(k, '=', v) for k, v in (context or {}).items()] + list(where or [])
+        for column, op, value in where:
+            self._check_column(column, stat_fields=True)
+            op = op.lower()
+            if op not in self.OPERATORS:
+                raise ValueError('Unknown operator: {}'.format(op))
+            if op in self._NUMERIC_OPERATORS and isinstance(value, (int, float)) and not self._is_numeric(column):
+                # text is always greater than number in SQLite
+                raise ValueError('Column {} is not numeric, can not compare it with {}'.format(column, value))
+            if value is None and op in ('=', '!='):
+                conditions.append('%s IS %s NULL' % (self._quote(column), 'NOT' if op == '!=' else ''))
+            elif op == 'in':
+                value = list(value)
+                conditions.append('%s IN (%s)' % (self._quote(column), ', '.join('?' * len(value))))
+                params.extend(value)
+            else:
+                conditions.append('%s %s ?' % (self._quote(column), op.upper()))
+                params.append(value)
+        return '%s WHERE %s' % (sql, ' AND '.join(conditions)), params
+
+    def _is_numeric(self, column: str) -> bool:
+        if column in ('is_dir', 'size', 'mtime_ns'):
+            return True
+        return self._column_types.get(column) in ('INTEGER', 'REAL')
+
+    def _check_column(self, column: str, stat_fields: bool = False):
+        if column in self._columns or (stat_fields and column in ('path', 'is_dir', 'size', 'mtime_ns')):
+            return
+        raise ValueError('No catalog column {}'.format(column))
+
+
+class _TreeService(object):
+    """
+    Tree loaded from config files, reloaded when files change. Executes batches of calls for
+    NamedPathServer and in-process fallback of NamedPathClient.
+    """
+    METHODS = ('get_path', 'parse', 'parse_nearest', 'find', 'get_path_names', 'get_pattern_variables')
+
+    def __init__(self, root: str, files: list, tree_class=None, check_interval: float = 1.0,
+                 watch: bool = False, **kwargs):
+        self.root = root
+        self.files = [_as_posix(x) for x in files]
+        self.tree_class = tree_class or NamedPathTree
+        self.check_interval = check_interval
+        self.watch = watch
+        self.kwargs = kwargs
+        self._tree = None
+        self._index = None
+        self._watcher = None
+        self._mtimes = None
+        self._checked = 0
+        self._scanned = 0
+        self._lock = threading.Lock()
+
+    @property
+    def tree(self) -> 'NamedPathTree':
+        now = time.monotonic()
+        if self._tree is None or now - self._checked >= self.check_interval:
+            with self._lock:
+                self._checked = now
+                mtimes = self._get_mtimes()
+                if self._tree is None or mtimes != self._mtimes:
+                    self._reload(mtimes)
+        return self._tree
+
+    def _get_mtimes(self) -> tuple:
+        mtimes = []
+        for path in self.files:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def _reload(self, mtimes: tuple):
+        tree = self.tree_class.load_from_files(self.root, self.files, **self.kwargs)
+        if self._tree is not None:
+            logger.info('Reload patterns: {}'.format(', '.join(self.files)))
+        self.close()
+        self._tree, self._mtimes = tree, mtimes
+
+    def close(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+        self._index = self._watcher = None
+
+    def _get_index(self) -> 'NamedPathIndex':
+        tree = self.tree
+        now = time.monotonic()
+        with self._lock:
+            if self._index is None or self._index.tree is not tree:
+                self._index = NamedPathIndex(tree).scan()
+                self._scanned = now
+                if self.watch:
+                    self._watcher = NamedPathWatcher(self._index)
+                    self._watcher.start()
+            elif not self.watch and now - self._scanned >= self.check_interval:
+                # without watcher index is as old as check interval at most,
+                # new index is swapped in, running finds keep old one
+                self._index = NamedPathIndex(tree).scan()
+                self._scanned = now
+            return self._index
+
+    def call(self, method: str, *args):
+        if method not in self.METHODS:
+            raise ValueError('Unknown method: {}'.format(method))
+        if method == 'find':
+            return self._get_index().find(*args)
+        result = getattr(self.tree, method)(*args)
+        return list(result) if isinstance(result, tuple) else result
+
+    def batch(self, calls: list) -> list:
+        """
+        Execute list of calls [method, *args]
+
+        Returns
+        -------
+        list
+            [1, result] or [0, error class name, message] for each call
+        """
+        results = []
+        for call in calls:
+            try:
+                results.append([1, self.call(*call)])
+            except Exception as e:
+                results.append([0, type(e).__name__, e.args[0] if len(e.args) == 1 else str(e)])
+        return results
+
+
+class NamedPathServer(object):
+    """
+    Resident tree answering requests of NamedPathClient on Unix domain socket.
+    Protocol is one JSON array per line in both directions: request is a batch of calls
+    [[method, arg, ...], ...], response has [1, result] or [0, error class name, message] for each call.
+    Tree is reloaded when config files change.
+
+    >>> server = NamedPathServer('/tmp/namedpath.sock', '/mnt/projects', ['patterns.json'])
+    >>> server.serve_forever()
+
+    Parameters
+    ----------
+    socket_path: str
+    root: str
+        Root path of tree
+    files: list
+        Config files for NamedPathTree.load_from_files
+    check_interval: float
+        Seconds between checks of config files modification time and between rescans of index
+        for "find" requests without watch
+    watch: bool
+        Keep index for "find" requests updated with NamedPathWatcher
+    """
+
+    def __init__(self, socket_path: str, root: str, files: list, tree_class=None,
+                 check_interval: float = 1.0, watch: bool = False, **kwargs):
+        self.socket_path = _as_posix(socket_path)
+        self.service = _TreeService(root, files, tree_class, check_interval, watch, **kwargs)
+        self._server = None
+        self._thread = None
+
+    def __repr__(self):
+        return '<NamedPathServer "{}">'.format(self.socket_path)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _create_server(self):
+        import json
+        import socketserver
+
+        service = self.service
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = service.batch(json.loads(line))
+                    except ValueError as e:
+                        response = [[0, 'ValueError', 'Bad request: {}'.format(e)]]
+                    self.wfile.write(json.dumps(response).encode() + b'\n')
+                    self.wfile.flush()
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        service.tree    # load before first request
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        server.daemon_threads = True
+        return server
+
+    def serve_forever(self):
+        self._server = self._create_server()
+        logger.info('Serve {} on {}'.format(self.service.root, self.socket_path))
+        try:
+            self._server.serve_forever()
+        finally:
+            self._close()
+
+    def start(self):
+        """
+        Serve in background thread
+        """
+        if self._thread:
+            return
+        self._server = self._create_server()
+        self._thread = threading.Thread(target=self._server.serve_forever, name='NamedPathServer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._close()
+
+    def _close(self):
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        self.service.close()
+
+
+class NamedPathClient(object):
+    """
+    Client of NamedPathServer. Resolves paths in-process if server is not running
+    and root and config files are given, connection is retried after retry_interval seconds.
+
+    >>> client = NamedPathClient('/tmp/namedpath.sock', '/mnt/projects', ['patterns.json'])
+    >>> client.get_path('SHOT', {'ENTITY_NAME': 'sh010'})
+    >>> client.batch([['get_path', 'SHOT', {'ENTITY_NAME': 'sh010'}], ['parse', '/mnt/projects/prj']])
+    """
+
+    def __init__(self, socket_path: str, root: str = None, files: list = None, timeout: float = 5.0,
+                 retry_interval: float = 1.0, **kwargs):
+        self.socket_path = _as_posix(socket_path)
+        self.root = root
+        self.files = files
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.kwargs = kwargs
+        self._socket = None
+        self._file = None
+        self._service = None
+        self._retry_at = 0
+
+    def __repr__(self):
+        return '<NamedPathClient "{}" ({})>'.format(self.socket_path, 'remote' if self.is_remote else 'local')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def is_remote(self) -> bool:
+        """
+        Connected to server
+        """
+        return self._connect()
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = self._file = None
+
+    def _connect(self) -> bool:
+        if self._socket is not None:
+            return True
+        if self._service is not None and time.monotonic() < self._retry_at:
+            return False
+        import socket
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError as e:
+            sock.close()
+            if not self.root or not self.files:
+                raise ConnectionError('Server is not running and no config for local tree: {}'.format(e))
+            if self._service is None:
+                logger.debug('Server is not running, resolve locally: {}'.format(e))
+                self._service = _TreeService(self.root, self.files, **self.kwargs)
+            self._retry_at = time.monotonic() + self.retry_interval
+            return False
+        if self._service is not None:
+            logger.debug('Server is running, stop local resolving')
+            self._service.close()
+            self._service = None
+        self._socket = sock
+        self._file = sock.makefile('rwb')
+        return True
+
+    # calls
+
+    def batch(self, calls: list, raise_errors: bool = True) -> list:
+        """
+        Execute list of calls [method, *args] with one request
+
+        Parameters
+        ----------
+        calls: list
+        raise_errors: bool
+            Raise error of first failed call, otherwise exceptions are returned in results
+
+        Returns
+        -------
+        list
+        """
+        calls = [list(x) for x in calls]
+        if self._connect():
+            import json
+
+            try:
+                self._file.write(json.dumps(calls).encode() + b'\n')
+                self._file.flush()
+                line = self._file.readline()
+            except OSError:
+                self.close()
+                raise
+            if not line:
+                self.close()
+                raise ConnectionError('Server closed connection')
+            response = json.loads(line)
+        else:
+            response = self._service.batch(calls)
+        results = []
+        for item in response:
+            if item[0]:
+                results.append(item[1])
+                continue
+            error = self._make_error(item[1], item[2])
+            if raise_errors:
+                raise error
+            results.append(error)
+        return results
+
+    def call(self, method: str, *args):
+        return self.batch([[method] + list(args)])[0]
+
+    def get_path(self, name: str, context: dict = None) -> str:
+        return self.call('get_path', name, context)
+
+    def parse(self, path: str, with_context: bool = False):
+        result = self.call('parse', path, with_context)
+        return tuple(result) if isinstance(result, list) else result
+
+    def parse_nearest(self, path: str) -> 'NearestMatch':
+        return NearestMatch(*self.call('parse_nearest', path))
+
+    def find(self, name: str, context: dict = None) -> list:
+        return self.call('find', name, context)
+
+    def get_path_names(self) -> tuple:
+        return tuple(self.call('get_path_names'))
+
+    @staticmethod
+    def _make_error(name: str, message: str) -> Exception:
+        cls = {x.__name__: x for x in (PathNameError, MultiplePatternMatchError, NoPatternMatchError,
+                                       PathContextError, KeyError, ValueError, TypeError)}.get(name, RuntimeError)
+        error = cls(message)
+        error.args = (message,)
+        return error
+
+
+class PathStats(object):
+    """
+    Counters and timing histograms.
+    Histogram buckets are powers of two in microseconds.
+
+    >>> stats = tree.enable_stats(callback=lambda kind, name, value: statsd.send(kind, name, value))
+    >>> tree.get_stats()
+    >>> {'counters': {'cache.hit': 10}, 'timings': {'get_path': {'count': 10, 'total': 0.0001, ...}}}
+    """
+
+    def __init__(self, callback: Callable = None):
+        import threading
+
+        self.callback = callback
+        self._counters = {}
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<PathStats ({} counters, {} timings)>'.format(len(self._counters), len(self._timings))
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        if self.callback:
+            self.callback('count', name, value)
+
+    def timing(self, name: str, seconds: float):
+        bucket = int(seconds * 1e6).bit_length()
+        with self._lock:
+            if name not in self._timings:
+                self._timings[name] = [0, 0.0, 0.0, {}]
+            timing = self._timings[name]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+            timing[3][bucket] = timing[3].get(bucket, 0) + 1
+        if self.callback:
+            self.callback('timing', name, seconds)
+
+    def timer(self, name: str) -> '_StatsTimer':
+        """
+        Context manager which measures time of block
+        """
+        return _StatsTimer(self, name)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+    def as_dict(self) -> dict:
+        """
+        Returns
+        -------
+        dict
+            counters - name: value,
+            timings - name: count, total, mean, max and histogram with upper bound in microseconds as keys
+        """
+        with self._lock:
+            return dict(
+                counters=dict(self._counters),
+                timings={name: dict(
+                    count=count,
+                    total=total,
+                    mean=total / count,
+                    max=max_time,
+                    histogram={1 << bucket: value for bucket, value in sorted(buckets.items())}
+                ) for name, (count, total, max_time, buckets) in self._timings.items()}
+            )
+
+
+class _StatsTimer(object):
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats: PathStats, name: str):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.stats.timing(self.name, time.perf_counter() - self.start)
+
+
+class PatternComponent(object):
+    """
+    One component of pattern path (text between separators) split to literals and variables
+    """
+    variable_pattern = r'[^/\\]+'
+
+    def __init__(self, text: str, get_variable_pattern: Callable = None):
+        self.text = text
+        self.tokens = []
+        for i, token in enumerate(re.split(r"({.*?})", text)):
+            if i % 2:
+                variable = token.strip('{}')
+                self.tokens.append((variable.split(':')[0].split('|')[0],
+                                    get_variable_pattern(variable) if get_variable_pattern else self.variable_pattern))
+            elif token:
+                self.tokens.append((None, token))
+        self.is_literal = all(name is None for name, _ in self.tokens)
+        self.prefix = ''
+        for name, value in self.tokens:
+            if name is not None:
+                break
+            self.prefix += value.lower()
+        self.suffix = ''
+        for name, value in reversed(self.tokens):
+            if name is not None:
+                break
+            self.suffix = value.lower() + self.suffix
+        self.regex = ''.join(re.escape(value) if name is None else value for name, value in self.tokens)
+        self.key = self.text.lower() if self.is_literal else self.regex
+
+    def __repr__(self):
+        return '<PatternComponent "%s">' % self.text
+
+    def match(self, text: str) -> bool:
+        return re.match('^%s$' % self.regex, text, re.IGNORECASE) is not None
+
+    def overlaps(self, other: 'PatternComponent') -> bool:
+        """
+        Can both components match the same text
+        """
+        if self.is_literal and other.is_literal:
+            return self.key == other.key
+        if self.is_literal:
+            return other.match(self.text)
+        if other.is_literal:
+            return self.match(other.text)
+        if not (self.prefix.startswith(other.prefix) or other.prefix.startswith(self.prefix)):
+            return False
+        if not (self.suffix.endswith(other.suffix) or other.suffix.endswith(self.suffix)):
+            return False
+        return True
+
+
+class _ComponentTrieNode(object):
+    """
+    Node of patterns trie used for static analysis
+    """
+    __slots__ = ('component', 'literals', 'variables', 'names')
+
+    def __init__(self, component: PatternComponent = None):
+        self.component = component
+        self.literals = {}
+        self.variables = {}
+        self.names = set()
+
+    def get_child(self, component: PatternComponent) -> '_ComponentTrieNode':
+        children = self.literals if component.is_literal else self.variables
+        if component.key not in children:
+            children[component.key] = _ComponentTrieNode(component)
+        return children[component.key]
+
+    def iter_children(self):
+        for child in self.literals.values():
+            yield child
+        for child in self.variables.values():
+            yield child
+
+    def iter_compatible_children(self, component: PatternComponent):
+        if component.is_literal:
+            if component.key in self.literals:
+                yield self.literals[component.key]
+        else:
+            for child in self.literals.values():
+                if component.overlaps(child.component):
+                    yield child
+        for child in self.variables.values():
+            if component.overlaps(child.component):
+                yield child
+
+
+class TransferResult(object):
+    """
+    Compact result of NamedPathTreeDrive.transfer_to.
+    Paths are stored relative to tree roots with shared table of directories,
+    pattern names are stored as integer codes.
+
+    >>> result = tree1.transfer_to(tree2, compact=True)
+    >>> len(result)
+    >>> for old_path, new_path, pattern_name in result.filter('SHOT'):
+    >>>     print(old_path, new_path)
+    >>> result.to_jsonl('/tmp/transfer.jsonl')
+    """
+    COLLISION = 'collision'
+    EXISTS = 'exists'
+    record_class = collections.namedtuple('TransferRecord', ['old_path', 'new_path', 'pattern_name'])
+    conflict_class = collections.namedtuple('TransferConflict', ['old_path', 'new_path', 'reason', 'other_path'])
+
+    def __init__(self, source_root: str, target_root: str):
+        self.source_root = source_root
+        self.target_root = target_root
+        self._dirs = []
+        self._dir_codes = {}
+        self._names = []
+        self._name_codes = {}
+        self._old_dirs = array('L')
+        self._old_files = []
+        self._new_dirs = array('L')
+        self._new_files = []
+        self._patterns = array('H')
+        self._skipped_dirs = array('L')
+        self._skipped_files = []
+        self.conflicts = []
+        self.failed = []
+
+    def __repr__(self):
+        return '<TransferResult {} -> {} ({})>'.format(self.source_root, self.target_root, len(self))
+
+    def __len__(self):
+        return len(self._old_files)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._get_record(i)
+
+    # add
+
+    def add(self, old_path: str, new_path: str, pattern_name: str):
+        dir_code, file_name = self._split(old_path, self.source_root)
+        self._old_dirs.append(dir_code)
+        self._old_files.append(file_name)
+        dir_code, file_name = self._split(new_path, self.target_root)
+        self._new_dirs.append(dir_code)
+        self._new_files.append(file_name)
+        if pattern_name not in self._name_codes:
+            self._name_codes[pattern_name] = len(self._names)
+            self._names.append(pattern_name)
+        self._patterns.append(self._name_codes[pattern_name])
+
+    def add_skipped(self, path: str):
+        dir_code, file_name = self._split(path, self.source_root)
+        self._skipped_dirs.append(dir_code)
+        self._skipped_files.append(file_name)
+
+    def add_conflict(self, old_path: str, new_path: str, reason: str, other_path: str = None):
+        """
+        Register conflict. Other path is the source path already transferred to the same target
+        """
+        conflict = self.conflict_class(old_path, new_path, reason, other_path)
+        self.conflicts.append(conflict)
+        return conflict
+
+    def add_failed(self, old_path: str, new_path: str, error: Exception):
+        self.failed.append((old_path, new_path, str(error)))
+
+    # access
+
+    @property
+    def pattern_names(self) -> tuple:
+        return tuple(self._names)
+
+    def filter(self, pattern_name: str):
+        """
+        Iterate records of source pattern
+        """
+        code = self._name_codes.get(pattern_name)
+        if code is None:
+            return
+        for i, pattern_code in enumerate(self._patterns):
+            if pattern_code == code:
+                yield self._get_record(i)
+
+    def iter_skipped(self):
+        for dir_code, file_name in zip(self._skipped_dirs, self._skipped_files):
+            yield self._join(self.source_root, self._dirs[dir_code], file_name)
+
+    @property
+    def skipped_paths(self) -> list:
+        return list(self.iter_skipped())
+
+    # export
+
+    def to_dict(self) -> dict:
+        """
+        Result in format of transfer_to(compact=False)
+        """
+        return dict(
+            remapped_paths=[dict(old_path=x.old_path, new_path=x.new_path) for x in self],
+            skipped_paths=self.skipped_paths
+        )
+
+    def to_jsonl(self, file, include_skipped: bool = True):
+        """
+        Write records as JSON lines
+
+        Parameters
+        ----------
+        file: str or file object
+        include_skipped: bool
+            Add lines with "skipped_path" key
+        """
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, 'w') as f:
+                return self.to_jsonl(f, include_skipped)
+        import json
+
+        for record in self:
+            file.write(json.dumps(record._asdict()) + '\n')
+        if include_skipped:
+            for path in self.iter_skipped():
+                file.write(json.dumps(dict(skipped_path=path)) + '\n')
+
+    # utils
+
+    def _get_record(self, i: int):
+        return self.record_class(
+            self._join(self.source_root, self._dirs[self._old_dirs[i]], self._old_files[i]),
+            self._join(self.target_root, self._dirs[self._new_dirs[i]], self._new_files[i]),
+            self._names[self._patterns[i]])
+
+    def _split(self, path: str, root: str) -> tuple:
+        if path.startswith(root + '/'):
+            path = path[len(root) + 1:]
+        dir_name, _, file_name = path.rpartition('/')
+        if not dir_name and path.startswith('/'):
+            dir_name = '/'
+        if dir_name not in self._dir_codes:
+            self._dir_codes[dir_name] = len(self._dirs)
+            self._dirs.append(dir_name)
+        return self._dir_codes[dir_name], file_name
+
+    @staticmethod
+    def _join(root: str, dir_name: str, file_name: str) -> str:
+        if dir_name.startswith('/'):
+            return '/'.join([dir_name.rstrip('/'), file_name])
+        return '/'.join(x for x in (root, dir_name, file_name) if x)
+
+
+# filesystem backends
+
+FileStat = collections.namedtuple('FileStat', ['st_mode', 'st_size', 'st_mtime_ns', 'st_uid', 'st_gid'])
+
+
+class FileSystem(abc.ABC):
+    """
+    Interface of filesystem used by drive classes.
+    Paths are absolute posix strings, errors are OSError subclasses like in module os.
+    Backends without real directories (supports_dirs = False) have no permissions and owners.
+
+    >>> tree = NamedPathTreeDrive('/mnt/projects', path_list, filesystem=MemoryFileSystem())
+    """
+    supports_dirs = True
+
+    def __repr__(self):
+        return '<{}>'.format(self.__class__.__name__)
+
+    # required
+
+    @abc.abstractmethod
+    def stat(self, path: str, follow_symlinks: bool = True):
+        pass
+
+    @abc.abstractmethod
+    def scandir(self, path: str) -> list:
+        """
+        Entries of directory, objects with attributes name, path and methods is_dir, is_symlink, stat
+        """
+
+    @abc.abstractmethod
+    def mkdir(self, path: str, mode: int = 0o777):
+        pass
+
+    @abc.abstractmethod
+    def chmod(self, path: str, mode):
+        pass
+
+    @abc.abstractmethod
+    def chown(self, path: str, user: str, group: str):
+        pass
+
+    @abc.abstractmethod
+    def symlink(self, source: str, path: str):
+        pass
+
+    @abc.abstractmethod
+    def readlink(self, path: str) -> str:
+        pass
+
+    @abc.abstractmethod
+    def link(self, source: str, path: str):
+        """
+        Hard link to existing file
+        """
+
+    @abc.abstractmethod
+    def rename(self, old_path: str, new_path: str):
+        pass
+
+    @abc.abstractmethod
+    def copy(self, old_path: str, new_path: str):
+        """
+        Copy file data and mode to new file, symbolic link is copied as link.
+        Existing target is an error
+        """
+
+    @abc.abstractmethod
+    def open(self, path: str, mode: str = 'rb'):
+        """
+        Binary file object, modes r, w, x and a
+        """
+
+    @abc.abstractmethod
+    def rmdir(self, path: str):
+        pass
+
+    @abc.abstractmethod
+    def remove(self, path: str):
+        pass
+
+    @abc.abstractmethod
+    def get_owner(self, path: str) -> tuple:
+        """
+        User and group names of path (None if unknown)
+        """
+
+    # derived
+
+    def lstat(self, path: str):
+        return self.stat(path, follow_symlinks=False)
+
+    def unlink(self, path: str):
+        self.remove(path)
+
+    def reflink(self, old_path: str, new_path: str):
+        """
+        Copy-on-write clone of file, simple copy if backend does not support it
+        """
+        self.copy(old_path, new_path)
+
+    def write_file(self, path: str, data: bytes = b''):
+        with self.open(path, 'wb') as f:
+            f.write(data)
+
+    def read_file(self, path: str) -> bytes:
+        with self.open(path, 'rb') as f:
+            return f.read()
+
+    def exists(self, path: str) -> bool:
+        try:
+            self.stat(path)
+        except OSError:
+            return False
+        return True
+
+    def lexists(self, path: str) -> bool:
+        try:
+            self.lstat(path)
+        except OSError:
+            return False
+        return True
+
+    def isdir(self, path: str) -> bool:
+        import stat
+
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def islink(self, path: str) -> bool:
+        import stat
+
+        try:
+            return stat.S_ISLNK(self.lstat(path).st_mode)
+        except OSError:
+            return False
+
+    def listdir(self, path: str) -> list:
+        return [entry.name for entry in self.scandir(path)]
+
+    def makedirs(self, path: str, mode: int = 0o777):
+        """
+        Create directory with parents, existing directory is not an error
+        """
+        missing = []
+        while not self.isdir(path):
+            missing.append(path)
+            parent = path.rpartition('/')[0] or '/'
+            if parent == path:
+                break
+            path = parent
+        for path in reversed(missing):
+            try:
+                self.mkdir(path, mode)
+            except FileExistsError:
+                if not self.isdir(path):
+                    raise
+
+
+class LocalFileSystem(FileSystem):
+    """
+    Local posix filesystem.
+    Files larger than large_file_size are copied with copy_file_range or sendfile.
+    """
+    _FICLONE = 0x40049409
+
+    def __init__(self, large_file_size: int = 16 * 1024 * 1024):
+        self.large_file_size = large_file_size
+
+    def stat(self, path: str, follow_symlinks: bool = True):
+        return os.stat(path, follow_symlinks=follow_symlinks)
+
+    def scandir(self, path: str) -> list:
+        with os.scandir(path) as it:
+            return list(it)
+
+    def mkdir(self, path: str, mode: int = 0o777):
+        os.mkdir(path, mode)
+
+    def makedirs(self, path: str, mode: int = 0o777):
+        os.makedirs(path, mode, exist_ok=True)
+
+    def chmod(self, path: str, mode):
+        chmod(path, mode)
+
+    def chown(self, path: str, user: str, group: str):
+        chown(path, user, group)
+
+    def symlink(self, source: str, path: str):
+        os.symlink(source, path)
+
+    def readlink(self, path: str) -> str:
+        return os.readlink(path)
+
+    def link(self, source: str, path: str):
+        os.link(source, path)
+
+    def rename(self, old_path: str, new_path: str):
+        os.rename(old_path, new_path)
+
+    def copy(self, old_path: str, new_path: str):
+        import shutil
+
+        if os.path.islink(old_path):
+            os.symlink(os.readlink(old_path), new_path)
+            return
+        with open(old_path, 'rb') as src:
+            size = os.fstat(src.fileno()).st_size
+            with open(new_path, 'xb') as dst:
+                if size >= self.large_file_size:
+                    self._copy_range(src.fileno(), dst.fileno(), size)
+                else:
+                    shutil.copyfileobj(src, dst)
+        shutil.copystat(old_path, new_path)
+
+    def reflink(self, old_path: str, new_path: str):
+        import fcntl
+        import shutil
+
+        with open(old_path, 'rb') as src:
+            with open(new_path, 'xb') as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), self._FICLONE, src.fileno())
+                except OSError:
+                    cloned = False
+                else:
+                    cloned = True
+        if not cloned:
+            os.unlink(new_path)
+            self.copy(old_path, new_path)
+        else:
+            shutil.copystat(old_path, new_path)
+
+    def open(self, path: str, mode: str = 'rb'):
+        return open(path, mode)
+
+    def rmdir(self, path: str):
+        os.rmdir(path)
+
+    def remove(self, path: str):
+        os.unlink(path)
+
+    def write_file(self, path: str, data: bytes = b''):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def get_owner(self, path: str) -> tuple:
+        import pwd
+        import grp
+
+        st = os.lstat(path)
+        names = []
+        for value, func in ((st.st_uid, pwd.getpwuid), (st.st_gid, grp.getgrgid)):
+            try:
+                names.append(func(value)[0])
+            except KeyError:
+                names.append(str(value))
+        return tuple(names)
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(path)
+
+    def isdir(self, path: str) -> bool:
+        return os.path.isdir(path)
+
+    def islink(self, path: str) -> bool:
+        return os.path.islink(path)
+
+    def listdir(self, path: str) -> list:
+        return os.listdir(path)
+
+    @staticmethod
+    def _copy_range(src_fd: int, dst_fd: int, size: int):
+        offset = 0
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        while offset < size:
+            try:
+                if copy_file_range:
+                    copied = copy_file_range(src_fd, dst_fd, size - offset)
+                else:
+                    copied = os.sendfile(dst_fd, src_fd, offset, size - offset)
+            except OSError:
+                if not copy_file_range:
+                    raise
+                # not supported between these filesystems
+                copy_file_range = None
+                os.lseek(src_fd, offset, os.SEEK_SET)
+                continue
+            if not copied:
+                break
+            offset += copied
+
+
+class _BufferFile(io.BytesIO):
+    """
+    File object in memory, data is passed to callback on close if file is opened for writing
+    """
+
+    def __init__(self, data: bytes = b'', on_close: Callable = None, append: bool = False):
+        super(_BufferFile, self).__init__(data)
+        self._on_close = on_close
+        if append:
+            self.seek(0, io.SEEK_END)
+
+    def writable(self):
+        return self._on_close is not None
+
+    def write(self, data):
+        if self._on_close is None:
+            raise io.UnsupportedOperation('not writable')
+        return super(_BufferFile, self).write(data)
+
+    def close(self):
+        if not self.closed and self._on_close is not None:
+            self._on_close(self.getvalue())
+        super(_BufferFile, self).close()
+
+
+def _check_file_mode(mode: str) -> str:
+    kind = mode.replace('b', '')
+    if kind not in ('r', 'w', 'x', 'a'):
+        raise ValueError('Unsupported file mode: {}'.format(mode))
+    return kind
+
+
+class _MemoryNode(object):
+    __slots__ = ('mode', 'user', 'group', 'link', 'data', 'mtime_ns')
+
+    def __init__(self, mode: int, link: str = None, data: bytes = b''):
+        self.mode = mode
+        self.user = self.group = None
+        self.link = link
+        self.data = data
+        self.mtime_ns = time.time_ns()
+
+
+class MemoryFileSystem(FileSystem):
+    """
+    Filesystem in memory for tests, dry runs and simulations of large structures.
+    Owners are stored as names without checking of users and groups.
+    """
+
+    def __init__(self):
+        import stat
+
+        self._stat = stat
+        self._nodes = {'/': _MemoryNode(stat.S_IFDIR | 0o755)}
+        self._children = {'/': set()}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _norm(path: str) -> str:
+        return _as_posix(path).rstrip('/') or '/'
+
+    def _error(self, cls, path: str):
+        import errno
+
+        code = {FileNotFoundError: errno.ENOENT, FileExistsError: errno.EEXIST,
+                NotADirectoryError: errno.ENOTDIR, IsADirectoryError: errno.EISDIR}.get(cls, errno.ENOTEMPTY)
+        return cls(code, os.strerror(code), path)
+
+    def _get(self, path: str, follow_symlinks: bool = True) -> tuple:
+        path = self._norm(path)
+        for _ in range(40):
+            node = self._nodes.get(path)
+            if node is None:
+                raise self._error(FileNotFoundError, path)
+            if not follow_symlinks or node.link is None:
+                return path, node
+            path = self._norm(_posix_join(path.rpartition('/')[0] or '/', node.link))
+        raise OSError('Too many levels of symbolic links: {}'.format(path))
+
+    def _add(self, path: str, node: _MemoryNode):
+        path = self._norm(path)
+        parent, _, name = path.rpartition('/')
+        parent_path, parent_node = self._get(parent or '/')
+        if not self._stat.S_ISDIR(parent_node.mode):
+            raise self._error(NotADirectoryError, parent_path)
+        if path in self._nodes:
+            raise self._error(FileExistsError, path)
+        self._nodes[path] = node
+        self._children[parent_path].add(name)
+        parent_node.mtime_ns = time.time_ns()
+        if self._stat.S_ISDIR(node.mode):
+            self._children[path] = set()
+
+    def _pop(self, path: str) -> _MemoryNode:
+        parent, _, name = path.rpartition('/')
+        self._children[parent or '/'].discard(name)
+        self._nodes[parent or '/'].mtime_ns = time.time_ns()
+        self._children.pop(path, None)
+        return self._nodes.pop(path)
+
+    def stat(self, path: str, follow_symlinks: bool = True):
+        _, node = self._get(path, follow_symlinks)
+        return FileStat(node.mode, len(node.data), node.mtime_ns, 0, 0)
+
+    def scandir(self, path: str) -> list:
+        with self._lock:
+            path, node = self._get(path)
+            if not self._stat.S_ISDIR(node.mode):
+                raise self._error(NotADirectoryError, path)
+            prefix = path.rstrip('/')
+            return [_StatEntry('/'.join([prefix, name]), self.lstat('/'.join([prefix, name])), self)
+                    for name in sorted(self._children[path])]
+
+    def mkdir(self, path: str, mode: int = 0o777):
+        with self._lock:
+            self._add(path, _MemoryNode(self._stat.S_IFDIR | mode))
+
+    def chmod(self, path: str, mode):
+        if isinstance(mode, str):
+            mode = int(mode, 8)
+        with self._lock:
+            _, node = self._get(path)
+            node.mode = self._stat.S_IFMT(node.mode) | mode
+
+    def chown(self, path: str, user: str, group: str):
+        with self._lock:
+            _, node = self._get(path)
+            node.user, node.group = user, group
+
+    def get_owner(self, path: str) -> tuple:
+        _, node = self._get(path, False)
+        return node.user, node.group
+
+    def symlink(self, source: str, path: str):
+        with self._lock:
+            self._add(path, _MemoryNode(self._stat.S_IFLNK | 0o777, link=_as_posix(source)))
+
+    def readlink(self, path: str) -> str:
+        _, node = self._get(path, False)
+        if node.link is None:
+            raise OSError('Not a symbolic link: {}'.format(path))
+        return node.link
+
+    def link(self, source: str, path: str):
+        with self._lock:
+            source, node = self._get(source, False)
+            if self._stat.S_ISDIR(node.mode):
+                raise self._error(IsADirectoryError, source)
+            # both paths share the node
+            self._add(path, node)
+
+    def open(self, path: str, mode: str = 'rb'):
+        kind = _check_file_mode(mode)
+        with self._lock:
+            if kind == 'r':
+                path, node = self._get(path)
+                if self._stat.S_ISDIR(node.mode):
+                    raise self._error(IsADirectoryError, path)
+                return _BufferFile(node.data)
+            if kind == 'x' and self.lexists(path):
+                raise self._error(FileExistsError, path)
+            data = b''
+            if kind == 'a' and self.exists(path):
+                data = self._get(path)[1].data
+            self.write_file(path, data)
+        return _BufferFile(data, lambda value: self.write_file(path, value), append=kind == 'a')
+
+    def rename(self, old_path: str, new_path: str):
+        with self._lock:
+            old_path, node = self._get(old_path, False)
+            new_path = self._norm(new_path)
+            if new_path in self._nodes:
+                raise self._error(FileExistsError, new_path)
+            if new_path.startswith(old_path + '/'):
+                raise OSError('Can not move {} inside itself'.format(old_path))
+            paths = self._iter_subtree(old_path)
+            nodes = [self._nodes[path] for path in paths]
+            for path in reversed(paths):
+                self._pop(path)
+            try:
+                self._add(new_path, node)
+            except OSError:
+                for path, node in zip(paths, nodes):
+                    self._add(path, node)
+                raise
+            for path, node in zip(paths[1:], nodes[1:]):
+                self._add(new_path + path[len(old_path):], node)
+
+    def _iter_subtree(self, path: str) -> list:
+        paths = [path]
+        for name in sorted(self._children.get(path, ())):
+            paths.extend(self._iter_subtree('/'.join([path.rstrip('/'), name])))
+        return paths
+
+    def copy(self, old_path: str, new_path: str):
+        with self._lock:
+            _, node = self._get(old_path, False)
+            if self._stat.S_ISDIR(node.mode):
+                raise self._error(IsADirectoryError, old_path)
+            new_node = _MemoryNode(node.mode, node.link, node.data)
+            new_node.user, new_node.group = node.user, node.group
+            self._add(new_path, new_node)
+
+    def rmdir(self, path: str):
+        with self._lock:
+            path, node = self._get(path, False)
+            if not self._stat.S_ISDIR(node.mode):
+                raise self._error(NotADirectoryError, path)
+            if self._children[path]:
+                raise self._error(OSError, path)
+            self._pop(path)
+
+    def remove(self, path: str):
+        with self._lock:
+            path, node = self._get(path, False)
+            if self._stat.S_ISDIR(node.mode):
+                raise self._error(IsADirectoryError, path)
+            self._pop(path)
+
+    def write_file(self, path: str, data: bytes = b''):
+        with self._lock:
+            try:
+                _, node = self._get(path)
+            except FileNotFoundError:
+                self._add(path, _MemoryNode(self._stat.S_IFREG | 0o644, data=data))
+            else:
+                node.data = data
+                node.mtime_ns = time.time_ns()
+
+
+class ObjectStoreFileSystem(FileSystem):
+    """
+    Flat key space of object storage. Directories are only prefixes of keys:
+    mkdir, chmod and chown do nothing, listing and existence of directories are prefix based.
+    Subclass implements key methods for a real storage (see LocalObjectStore).
+    Key of path is path without leading slash.
+    """
+    supports_dirs = False
+
+    # keys
+
+    @abc.abstractmethod
+    def list_keys(self, prefix: str):
+        """
+        Iterate sorted keys starting with prefix
+        """
+
+    @abc.abstractmethod
+    def head(self, key: str):
+        """
+        ObjectInfo of key or None
+        """
+
+    @abc.abstractmethod
+    def get(self, key: str) -> bytes:
+        """
+        Data of object
+        """
+
+    @abc.abstractmethod
+    def put(self, key: str, data: bytes = b'', link: str = None):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abc.abstractmethod
+    def copy_key(self, old_key: str, new_key: str):
+        pass
+
+    # filesystem
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return _as_posix(path).strip('/')
+
+    def _has_prefix(self, key: str) -> bool:
+        return next(iter(self.list_keys(key + '/' if key else '')), None) is not None
+
+    def _object_stat(self, info):
+        import stat
+
+        mode = stat.S_IFLNK | 0o777 if info.link is not None else stat.S_IFREG | 0o644
+        return FileStat(mode, info.size, info.mtime_ns, 0, 0)
+
+    def stat(self, path: str, follow_symlinks: bool = True):
+        import stat
+
+        key = self._key(path)
+        info = self.head(key) if key else None
+        if info is not None:
+            if follow_symlinks and info.link is not None:
+                return self.stat(_posix_join('/' + key.rpartition('/')[0], info.link))
+            return self._object_stat(info)
+        if not key or self._has_prefix(key):
+            return FileStat(stat.S_IFDIR | 0o755, 0, 0, 0, 0)
+        raise FileNotFoundError(2, 'No such file or directory', path)
+
+    def scandir(self, path: str) -> list:
+        import stat
+
+        key = self._key(path)
+        prefix = key + '/' if key else ''
+        entries = {}
+        for child in self.list_keys(prefix):
+            name, sep, _ = child[len(prefix):].partition('/')
+            if name in entries:
+                continue
+            if sep:
+                st = FileStat(stat.S_IFDIR | 0o755, 0, 0, 0, 0)
+            else:
+                st = self._object_stat(self.head(child))
+            entries[name] = _StatEntry('/' + prefix + name, st, self)
+        if not entries and key and not self.exists(path):
+            raise FileNotFoundError(2, 'No such file or directory', path)
+        return list(entries.values())
+
+    def mkdir(self, path: str, mode: int = 0o777):
+        pass
+
+    def makedirs(self, path: str, mode: int = 0o777):
+        pass
+
+    def chmod(self, path: str, mode):
+        pass
+
+    def chown(self, path: str, user: str, group: str):
+        pass
+
+    def get_owner(self, path: str) -> tuple:
+        return None, None
+
+    def symlink(self, source: str, path: str):
+        self.put(self._key(path), link=_as_posix(source))
+
+    def readlink(self, path: str) -> str:
+        info = self.head(self._key(path))
+        if info is None or info.link is None:
+            raise OSError('Not a symbolic link: {}'.format(path))
+        return info.link
+
+    def rename(self, old_path: str, new_path: str):
+        old_key, new_key = self._key(old_path), self._key(new_path)
+        if self.head(old_key) is not None:
+            pairs = [(old_key, new_key)]
+        else:
+            pairs = [(key, new_key + key[len(old_key):]) for key in self.list_keys(old_key + '/')]
+            if not pairs:
+                raise FileNotFoundError(2, 'No such file or directory', old_path)
+        for old, new in pairs:
+            self.copy_key(old, new)
+            self.delete(old)
+
+    def copy(self, old_path: str, new_path: str):
+        new_key = self._key(new_path)
+        if self.head(new_key) is not None:
+            raise FileExistsError(17, 'File exists', new_path)
+        self.copy_key(self._key(old_path), new_key)
+
+    def link(self, source: str, path: str):
+        # objects are immutable, copy is equal to hard link
+        self.copy(source, path)
+
+    def open(self, path: str, mode: str = 'rb'):
+        kind = _check_file_mode(mode)
+        key = self._key(path)
+        info = self.head(key)
+        if kind == 'r' or kind == 'a':
+            if info is None and kind == 'r':
+                raise FileNotFoundError(2, 'No such file or directory', path)
+            data = self.get(key) if info is not None else b''
+            if kind == 'r':
+                return _BufferFile(data)
+        elif kind == 'x' and info is not None:
+            raise FileExistsError(17, 'File exists', path)
+        else:
+            data = b''
+        return _BufferFile(data, lambda value: self.put(key, value), append=kind == 'a')
+
+    def rmdir(self, path: str):
+        key = self._key(path)
+        if self._has_prefix(key):
+            raise OSError('Directory not empty: {}'.format(path))
+
+    def remove(self, path: str):
+        key = self._key(path)
+        if self.head(key) is None:
+            raise FileNotFoundError(2, 'No such file or directory', path)
+        self.delete(key)
+
+    def write_file(self, path: str, data: bytes = b''):
+        self.put(self._key(path), data)
+
+
+ObjectInfo = collections.namedtuple('ObjectInfo', ['size', 'mtime_ns', 'link'])
+
+
+class LocalObjectStore(ObjectStoreFileSystem):
+    """
+    Object store kept in local directory, one file per key. Stand-in of bucket for tests.
+    """
+
+    def __init__(self, store_dir: str | os.PathLike):
+        self.store_dir = _as_posix(store_dir)
+        os.makedirs(self.store_dir, exist_ok=True)
+        self._keys = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{} "{}">'.format(self.__class__.__name__, self.store_dir)
+
+    def _file(self, key: str) -> str:
+        from urllib.parse import quote
+
+        return '/'.join([self.store_dir, quote(key, safe='')])
+
+    def _get_keys(self) -> list:
+        if self._keys is None:
+            from urllib.parse import unquote
+
+            self._keys = sorted(unquote(name) for name in os.listdir(self.store_dir))
+        return self._keys
+
+    def list_keys(self, prefix: str):
+        import bisect
+
+        with self._lock:
+            keys = self._get_keys()
+            start = bisect.bisect_left(keys, prefix)
+            end = bisect.bisect_left(keys, prefix + '\U0010ffff') if prefix else len(keys)
+            return keys[start:end]
+
+    def head(self, key: str):
+        file = self._file(key)
+        try:
+            st = os.lstat(file)
+        except FileNotFoundError:
+            return None
+        if os.path.islink(file):
+            return ObjectInfo(0, st.st_mtime_ns, os.readlink(file))
+        return ObjectInfo(st.st_size, st.st_mtime_ns, None)
+
+    def put(self, key: str, data: bytes = b'', link: str = None):
+        import bisect
+
+        file = self._file(key)
+        if os.path.lexists(file):
+            os.unlink(file)
+        if link is not None:
+            os.symlink(link, file)
+        else:
+            with open(file, 'wb') as f:
+                f.write(data)
+        with self._lock:
+            keys = self._get_keys()
+            i = bisect.bisect_left(keys, key)
+            if i == len(keys) or keys[i] != key:
+                keys.insert(i, key)
+
+    def delete(self, key: str):
+        import bisect
+
+        os.unlink(self._file(key))
+        with self._lock:
+            keys = self._get_keys()
+            i = bisect.bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                del keys[i]
+
+    def get(self, key: str) -> bytes:
+        with open(self._file(key), 'rb') as f:
+            return f.read()
+
+    def copy_key(self, old_key: str, new_key: str):
+        info = self.head(old_key)
+        if info is None:
+            raise FileNotFoundError(2, 'No such file or directory', old_key)
+        if info.link is not None:
+            self.put(new_key, link=info.link)
+        else:
+            self.put(new_key, self.get(old_key))
+
+
+_LOCAL_FILESYSTEM = LocalFileSystem()
+
+
+def _same_filesystem(fs1: FileSystem, fs2: FileSystem) -> bool:
+    """
+    Paths of both backends are in the same storage
+    """
+    return fs1 is fs2 or (isinstance(fs1, LocalFileSystem) and isinstance(fs2, LocalFileSystem))
+
+
+def chown(path: str, user: str, group: str):
+    if os.name == 'nt':
+        raise OSError('Not implemented for Windows OS')
+    # TODO: implement for windows
+    import pwd, grp
+    uid = pwd.getpwnam(user).pw_uid
+    gid = grp.getgrnam(group).gr_gid
+    try:
         os.chown(path, uid, gid)
     except Exception as e:
         raise type(e)("%s %s:%s (%s:%s)" % (e, user, group, uid, gid))
@@ -1079,6 +5560,67 @@ def chmod(path: str, mode: str):
         raise type(e)("%s %s" % (e, mode))
 
 
+_OPTIONAL_BLOCK = re.compile(r"<.*?\{([\w\d:]+)}>")
+_OPTIONAL_ANY = re.compile(r"<.*?>")
+
+
+def _posix_join(*segments) -> str:
+    """
+    Join path segments with same result as PurePosixPath(*segments).as_posix()
+    """
+    path = '/'.join(segments)
+    if not segments[0] or '//' in path or '/./' in path or path.endswith(('/', '/.')) \
+            or path.startswith('./') or path == '.':
+        root = ''
+        parts = []
+        for segment in segments:
+            if not segment:
+                continue
+            if segment.startswith('/'):
+                root = '//' if segment.startswith('//') and not segment.startswith('///') else '/'
+                parts = []
+            parts.extend(x for x in segment.split('/') if x and x != '.')
+        path = root + '/'.join(parts) if root or parts else '.'
+    return path
+
+
+def _as_posix(path) -> str:
+    """
+    Same result as Path(path).as_posix() without pathlib objects
+    """
+    path = os.fspath(path)
+    if os.sep != '/':
+        path = path.replace(os.sep, '/')
+    return _posix_join(path)
+
+
+def _shard_index(key: str, count: int) -> int:
+    """
+    Stable shard number of key, independent of process hash seed
+    """
+    import hashlib
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') % count
+
+
+def _has_suffix(name: str) -> bool:
+    """
+    Same as bool(PurePosixPath(name).suffix) for single component
+    """
+    i = name.rfind('.')
+    return 0 < i < len(name) - 1
+
+
+def _to_path(path: str):
+    from pathlib import Path
+    return Path(path)
+
+
+def _filtered_value(value, name: str):
+    if not value:
+        raise ValueError('No value {}'.format(name))
+    return value
+
+
 class CustomFormatString(str):
     """
     Extended string with advanced formatting.
@@ -1099,6 +5641,7 @@ class CustomFormatString(str):
     sep = '|'
 
     def format(self, *args, **kwargs):
+        import copy
         context = copy.deepcopy(kwargs)
         variables = re.findall(r"({([\w\d_:]+)([%s\w]+\(.*?\))?})" % self.sep, self)
         for full_pat, var, expr in variables:
@@ -1147,3 +5690,31 @@ class NoPatternMatchError(CustomException):
 
 class PathContextError(CustomException):
     msg = 'Wrong context for pattern'
+
+
+class TransferConflictError(CustomException):
+    msg = 'Transfer conflict'
+
+
+def main(argv: list = None):
+    """
+    Run NamedPathServer from command line
+
+    python namedpath.py --socket /tmp/namedpath.sock --root /mnt/projects patterns.json
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve named path tree on Unix domain socket')
+    parser.add_argument('files', nargs='+', help='Config files of patterns')
+    parser.add_argument('--socket', required=True, help='Socket path')
+    parser.add_argument('--root', required=True, help='Root path of tree')
+    parser.add_argument('--check-interval', type=float, default=1.0, help='Seconds between checks of config files')
+    parser.add_argument('--watch', action='store_true', help='Watch filesystem changes for "find" requests')
+    args = parser.parse_args(argv)
+    setup_logger()
+    NamedPathServer(args.socket, args.root, args.files, check_interval=args.check_interval,
+                    watch=args.watch).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
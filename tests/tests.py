@@ -1,8 +1,15 @@
 import getpass
+import json
 import os
-from namedpath import NamedPathTree, PathContextError
+import statistics
+import subprocess
+import sys
+from namedpath import NamedPathTree, NamedPathTreeDrive, NamedPathIndex, NamedPathWatcher, PathContextError, \
+    TransferConflictError, TransferAction, TransferJournal, MemoryFileSystem, LocalObjectStore, NoPatternMatchError, \
+    NamedPathServer, NamedPathClient, NamedPathCatalog, FileSystem, PathNameError
 import pytest
 import tempfile
+import shutil
 
 ROOT = os.path.join(tempfile.gettempdir(), 'my_struct')
 CURRENT_USER = getpass.getuser()
@@ -114,7 +121,23 @@ def context_map():
 # =======================================================
 
 def test_unique_patterns(tree, context):
-    tree.check_uniqueness_of_parsing(context)
+    result = tree.check_uniqueness_of_parsing(context)
+    assert not result['errors']
+    assert tree.find_ambiguous_patterns() == []
+
+
+def test_ambiguous_patterns():
+    tree = NamedPathTree('/mnt', dict(
+        SHOT='{PROJECT}/shots/{ENTITY_NAME}',
+        ASSET='{PROJECT}/assets/{ENTITY_NAME}',
+        ANY='{PROJECT}/{DIR}/{NAME}',
+        RENDER='{PROJECT}/render/{NAME}_v{VERSION}.exr',
+        CACHE='{PROJECT}/render/{NAME}.abc',
+    ))
+    assert tree.find_ambiguous_patterns() == [('ANY', 'ASSET'), ('ANY', 'CACHE'), ('ANY', 'RENDER'), ('ANY', 'SHOT')]
+    result = tree.check_uniqueness_of_parsing()
+    assert set(result['errors']) == {'ANY', 'ASSET', 'CACHE', 'RENDER', 'SHOT'}
+    assert not result['success']
 
 
 def test_pattern_creation(tree, patterns):
@@ -163,7 +186,26 @@ def test_path_glob_pattern(path_ctl1):
 
 def test_path_regex_pattern(path_ctl1):
     pat = path_ctl1.as_regex()
-    assert pat == r'^(?P<PROJECT_NAME>[^/\\]+)/shot/(?P<ENTITY_NAME>[^/\\]+)/publish/v(?P<VERSION>[^/\\]+)/[^/\\]+_v[^/\\]+\.(?P<EXT>[^/\\]+)$'
+    assert pat == r'^(?P<PROJECT_NAME>[^/\\]+)/shot/(?P<ENTITY_NAME>[^/\\]+)/publish/v(?P<VERSION>(?:-\d{2,}|\d{3,}))/[^/\\]+_v(?:-\d{2,}|\d{3,})\.(?P<EXT>[^/\\]+)$'
+
+
+def test_typed_variable_patterns():
+    tree = NamedPathTree('/mnt', dict(
+        RENDER={
+            'path': '{ENTITY_NAME}/{ENTITY_NAME}_v{VERSION:03d}_{FRAME:05d}.{EXT}',
+            'choices': {'EXT': ['exr', 'jpg']},
+            'regex': {'ENTITY_NAME': r'sh\d+'},
+            'types': {'VERSION': 'int', 'FRAME': 'int'},
+        },
+        PREVIEW='{ENTITY_NAME}/{ENTITY_NAME}_{TAKE}_{FRAME}.{EXT}',
+    ))
+    ctx = dict(ENTITY_NAME='sh010', VERSION=3, FRAME=1001, EXT='exr')
+    assert tree.get_path_instance('RENDER').parse(tree.get_path('RENDER', ctx)) == ctx
+    assert tree.parse('/mnt/sh010/sh010_v003_preview.mov') == 'PREVIEW'
+    assert tree.get_path_instance('RENDER').parse('/mnt/sh010/sh010_v003_01001.mov') is None
+    assert tree.get_path_instance('RENDER').parse('/mnt/sh010/sh010_v1234_01001.exr')['VERSION'] == 1234
+    assert NamedPathTree.path_class.format_spec_to_regex('.2f') == r'-?\d+\.\d{2}'
+    assert NamedPathTree.path_class.format_spec_to_regex('>10') == r'[^/\\]+'
 
 
 # def test_path_permissions_list(path_ctl1):
@@ -244,3 +286,806 @@ def test_object_attributes_access():
 
 # def test_makedirs_path(path_ctl1, context):
 #     path_ctl1.makedirs(context)
+
+
+def test_path_index(tmp_path, patterns):
+    tree = NamedPathTree(tmp_path.as_posix(), patterns)
+    for entity, versions in (('sh001', (1, 2)), ('sh002', (1, 5, 12))):
+        for version in versions:
+            path = tree.get_path('SHOT_PUBLISH', dict(PROJECT_NAME='prj', ENTITY_NAME=entity, VERSION=version, EXT='exr'))
+            os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+    index = NamedPathIndex(tree).scan()
+    assert index.list_values('SHOT', 'ENTITY_NAME') == ['sh001', 'sh002']
+    assert index.list_values('SHOT_PUBLISH', 'VERSION', {'ENTITY_NAME': 'sh001'}) == [1, 2]
+    path, ctx = index.latest('SHOT_PUBLISH', {'ENTITY_NAME': 'sh002'}, key='VERSION')
+    assert path == tree.get_path('SHOT_PUBLISH', ctx) and ctx['VERSION'] == 12
+    assert index.latest('SHOT_PUBLISH', {'ENTITY_NAME': 'sh003'}) is None
+
+    shot_path = tree.get_path('SHOT', dict(PROJECT_NAME='prj', ENTITY_NAME='sh001'))
+    shutil.rmtree(shot_path)
+    path = tree.get_path('SHOT_PUBLISH', dict(PROJECT_NAME='prj', ENTITY_NAME='sh001', VERSION=7, EXT='exr'))
+    os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+    index.refresh(shot_path)
+    assert index.list_values('SHOT_PUBLISH', 'VERSION', {'ENTITY_NAME': 'sh001'}) == [7]
+    assert index.list_values('SHOT_PUBLISH', 'VERSION', {'ENTITY_NAME': 'sh002'}) == [1, 5, 12]
+
+    manifest = NamedPathIndex(tree).load_manifest(['prj/shot/sh005', 'prj/shot/sh005/publish/v003/sh005_v003.exr'])
+    assert manifest.find('SHOT_PUBLISH') == [tree.get_path('SHOT_PUBLISH', dict(
+        PROJECT_NAME='prj', ENTITY_NAME='sh005', VERSION=3, EXT='exr'))]
+
+
+@pytest.mark.parametrize('use_inotify', [False, True])
+def test_path_watcher(tmp_path, patterns, context, use_inotify):
+    tree = NamedPathTree(tmp_path.as_posix(), patterns)
+    index = NamedPathIndex(tree).scan()
+    watcher = NamedPathWatcher(index, poll_interval=0.05, use_inotify=use_inotify)
+    if use_inotify and watcher.backend != 'inotify':
+        pytest.skip('inotify is not available')
+    # descriptor is opened by setup() only
+    assert watcher._fd is None
+    events = []
+    watcher.subscribe(lambda name, ctx, event: events.append((name, event)))
+    watcher.setup()
+    path = tree.get_path('SHOT_PUBLISH', context)
+    os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+    for _ in range(20):
+        watcher.poll(0.1)
+        if ('SHOT_PUBLISH', 'created') in events:
+            break
+    assert sorted(events) == [('PROJECT', 'created'), ('SHOT', 'created'), ('SHOTS', 'created'),
+                              ('SHOT_PUBLISH', 'created')]
+    assert index.latest('SHOT_PUBLISH')[0] == path
+    del events[:]
+    shutil.rmtree(tree.get_path('SHOT', context))
+    for _ in range(20):
+        watcher.poll(0.1)
+        if ('SHOT', 'deleted') in events:
+            break
+    assert sorted(events) == [('SHOT', 'deleted'), ('SHOT_PUBLISH', 'deleted')]
+    assert index.find('SHOT_PUBLISH') == []
+    watcher.stop()
+    assert watcher._fd is None
+
+
+def test_transfer_compact_result(tmp_path, path_list1, path_list2, pattern_names_map, context_map):
+    t1 = NamedPathTreeDrive((tmp_path / 'projects1').as_posix(), path_list1)
+    t2 = NamedPathTree((tmp_path / 'projects2').as_posix(), path_list2)
+    for name in ('box/box0001.exr', 'box/box0002.exr', 'cube/cube_0001.exr'):
+        os.makedirs(os.path.dirname(os.path.join(t1.root, 'prj1/shots', name)), exist_ok=True)
+        open(os.path.join(t1.root, 'prj1/shots', name), 'w').close()
+    os.makedirs(os.path.join(t1.root, 'prj1/.config'))
+    result = t1.transfer_to(t2, pattern_names_map, context_map, compact=True)
+    assert len(result) == 6
+    assert sorted(x.new_path for x in result.filter('SHOT')) == [
+        t2.root + '/prj1/shots/prod/box001.exr', t2.root + '/prj1/shots/prod/box002.exr',
+        t2.root + '/prj1/shots/prod/cube001.exr']
+    assert sorted(result.skipped_paths) == [t1.root + '/prj1/shots/box', t1.root + '/prj1/shots/cube']
+    as_dict = result.to_dict()
+    assert as_dict == t1.transfer_to(t2, pattern_names_map, context_map)
+    assert {'old_path': t1.root + '/prj1/.config', 'new_path': t2.root + '/prj1/.conf'} in as_dict['remapped_paths']
+    result.to_jsonl((tmp_path / 'result.jsonl').as_posix())
+    lines = (tmp_path / 'result.jsonl').read_text().splitlines()
+    assert len(lines) == 8 and '"pattern_name": "CONFIG"' in '\n'.join(lines)
+
+
+def test_compiled_solver(patterns, context):
+    patterns.update(
+        OPTIONAL='[SHOT]/{filename}<_{suffix}>.{ext}',
+        FILTERS='[PROJECT]/{ENTITY_NAME|upper()}/{ENTITY_NAME|center(10, "-")}/{VERSION:>5}',
+    )
+    tree = NamedPathTree(ROOT, dict(patterns))
+    interpreted = NamedPathTree(ROOT, dict(patterns), compile_solvers=False)
+    contexts = [context, dict(context, filename='f', ext='png'), dict(context, filename='f', ext='png', suffix='s'),
+                dict(context, ENTITY_NAME='/abs/', PROJECT_NAME='*'), dict(PROJECT_NAME='x')]
+    for name in tree.get_path_names():
+        assert tree.get_path_instance(name).get_solver() is not None
+        assert interpreted.get_path_instance(name).get_solver() is None
+        for ctx in contexts:
+            for kwargs in ({}, {'relative': True}, {'local': True}):
+                try:
+                    expected = interpreted.get_path(name, ctx, **kwargs)
+                except PathContextError:
+                    with pytest.raises(PathContextError):
+                        tree.get_path(name, ctx, **kwargs)
+                else:
+                    assert tree.get_path(name, ctx, **kwargs) == expected
+
+
+@pytest.mark.parametrize('max_memory_paths', [1, 1000])
+def test_transfer_conflicts(tmp_path, path_list1, path_list2, pattern_names_map, context_map, max_memory_paths):
+    t1 = NamedPathTreeDrive((tmp_path / 'projects1').as_posix(), path_list1)
+    t2 = NamedPathTree((tmp_path / 'projects2').as_posix(), path_list2)
+    for name in ('box/box0001.exr', 'cube/cube0001.exr', 'cube/cube_0001.exr', 'cube/cube0002.exr'):
+        os.makedirs(os.path.dirname(os.path.join(t1.root, 'prj1/shots', name)), exist_ok=True)
+        open(os.path.join(t1.root, 'prj1/shots', name), 'w').close()
+    os.makedirs(os.path.join(t2.root, 'prj1/shots/prod'))
+    open(os.path.join(t2.root, 'prj1/shots/prod/box001.exr'), 'w').close()
+    actions = []
+    result = t1.transfer_to(t2, pattern_names_map, context_map, action=lambda *args: actions.append(args),
+                            compact=True, max_memory_paths=max_memory_paths, on_conflict='skip')
+    assert sorted((os.path.basename(x.old_path), x.reason) for x in result.conflicts) == [
+        ('box0001.exr', 'exists'), ('cube_0001.exr', 'collision')]
+    assert [os.path.basename(x.new_path) for x in result.filter('SHOT')] == ['cube001.exr', 'cube002.exr']
+    assert len(actions) == len(result) == 4
+    # conflicts are only reported by default
+    result = t1.transfer_to(t2, pattern_names_map, context_map, action=actions.append, dry_run=True, compact=True)
+    assert len(result) == 6 and len(result.conflicts) == 2
+    assert len(actions) == 4
+    with pytest.raises(TransferConflictError):
+        t1.transfer_to(t2, pattern_names_map, context_map, on_conflict='error')
+
+
+@pytest.mark.parametrize('mode', ['copy', 'move', 'hardlink', 'symlink', 'reflink'])
+def test_transfer_actions(tmp_path, path_list1, path_list2, pattern_names_map, context_map, mode):
+    path_list1['SHOTS'].pop('symlink_to')
+    t1 = NamedPathTreeDrive((tmp_path / 'projects1').as_posix(), path_list1)
+    t2 = NamedPathTreeDrive((tmp_path / 'projects2').as_posix(), path_list2)
+    sources = {}
+    for name in ('box/box0001.exr', 'box/box0002.exr', 'cube/cube0001.exr'):
+        path = os.path.join(t1.root, 'prj1/shots', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(name * 100)
+        sources[name] = path
+    os.makedirs(os.path.join(t1.root, 'prj1/.config'))
+    action = TransferAction(mode, workers=3, large_file_size=100)
+    result = t1.transfer_to(t2, pattern_names_map, context_map, action=action, compact=True)
+    assert not result.failed
+    assert os.path.isdir(os.path.join(t2.root, 'prj1/.conf'))
+    for name, target in (('box/box0001.exr', 'box001.exr'), ('cube/cube0001.exr', 'cube001.exr')):
+        target = os.path.join(t2.root, 'prj1/shots/prod', target)
+        if mode == 'move':
+            assert not os.path.exists(sources[name])
+        else:
+            assert os.path.exists(sources[name])
+        assert open(target).read() == name * 100
+        assert os.path.islink(target) == (mode == 'symlink')
+        if mode == 'hardlink':
+            assert os.path.samefile(sources[name], target)
+
+
+def test_transfer_action_failures(tmp_path, path_list1, path_list2, pattern_names_map, context_map):
+    t1 = NamedPathTreeDrive((tmp_path / 'projects1').as_posix(), path_list1)
+    t2 = NamedPathTreeDrive((tmp_path / 'projects2').as_posix(), path_list2)
+    for name in ('box/box0001.exr', 'box/box0002.exr'):
+        os.makedirs(os.path.dirname(os.path.join(t1.root, 'prj1/shots', name)), exist_ok=True)
+        open(os.path.join(t1.root, 'prj1/shots', name), 'w').close()
+    # existing target, copy fails
+    os.makedirs(os.path.join(t2.root, 'prj1/shots/prod'))
+    open(os.path.join(t2.root, 'prj1/shots/prod/box002.exr'), 'w').close()
+    result = t1.transfer_to(t2, pattern_names_map, context_map, action=TransferAction('copy', workers=2),
+                            compact=True)
+    assert [os.path.basename(x[0]) for x in result.failed] == ['box0002.exr']
+    assert [os.path.basename(x.new_path) for x in result.filter('SHOT')] == ['box001.exr']
+
+    # errors other than OSError in worker threads are reported too
+    action = TransferAction('copy', workers=2)
+
+    def broken_copy(old_path, new_path):
+        raise RuntimeError('Injected failure')
+
+    action._copy = broken_copy
+    result = t1.transfer_to(t2, pattern_names_map, context_map, action=action, compact=True)
+    assert sorted(os.path.basename(x[0]) for x in result.failed) == ['box0001.exr', 'box0002.exr']
+    assert list(result.filter('SHOT')) == []
+
+
+def test_transfer_journal(tmp_path, path_list1, path_list2, pattern_names_map, context_map):
+    t1 = NamedPathTreeDrive((tmp_path / 'projects1').as_posix(), path_list1)
+    t2 = NamedPathTree((tmp_path / 'projects2').as_posix(), path_list2)
+    for i in range(1, 6):
+        path = os.path.join(t1.root, 'prj1/shots/box/box%04d.exr' % i)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+    processed = []
+
+    def failing_action(old_path, new_path):
+        if old_path.endswith('box0003.exr'):
+            raise RuntimeError('Injected failure')
+        processed.append(os.path.basename(old_path))
+
+    journal_path = (tmp_path / 'transfer.journal').as_posix()
+    with pytest.raises(RuntimeError):
+        t1.transfer_to(t2, pattern_names_map, context_map, action=failing_action, journal=journal_path)
+    assert processed == ['prj1', 'shots', 'box0001.exr', 'box0002.exr']
+    del processed[:]
+
+    journal = TransferJournal(journal_path)
+    t1.transfer_to(t2, pattern_names_map, context_map, action=lambda old, new: processed.append(
+        os.path.basename(old)), journal=journal)
+    assert processed == ['box0003.exr', 'box0004.exr', 'box0005.exr']
+    status = journal.get_status()
+    assert (status['done'], status['resumed'], status['failed'], status['pending']) == (3, 4, 0, 0)
+    with pytest.raises(ValueError):
+        NamedPathTreeDrive(t2.root, path_list2).transfer_to(t1, action=print, journal=journal_path)
+
+
+def test_stats(tmp_path, patterns, context):
+    patterns['SHOT_PUBLISH'].pop('users')
+    patterns['SHOT_PUBLISH'].pop('groups')
+    tree = NamedPathTreeDrive(tmp_path.as_posix(), patterns)
+    events = []
+    tree.enable_stats(callback=lambda kind, name, value: events.append((kind, name)))
+    for _ in range(3):
+        path = tree.get_path('SHOT_PUBLISH', context)
+    assert tree.parse(path) == 'SHOT_PUBLISH'
+    tree.get_path('SHOT', context, create=True)
+    stats = tree.get_stats()
+    assert stats['timings']['get_path']['count'] == 4
+    assert stats['timings']['parse']['count'] == 1
+    assert stats['timings']['fs.makedirs']['count'] == 3
+    assert stats['counters']['cache.hit'] >= 2
+    assert 'compile.parse_regex' in stats['timings'] and 'compile.solver' in stats['timings']
+    assert sum(stats['timings']['get_path']['histogram'].values()) == 4
+    assert ('timing', 'get_path') in events and ('count', 'cache.miss') in events
+    tree.disable_stats()
+    tree.get_path('SHOT_PUBLISH', context)
+    assert tree.get_stats() == {}
+
+
+def test_startup_budget():
+    # generous budget: median of several runs in fresh interpreters
+    script = '''
+import sys, time
+t = time.perf_counter()
+import namedpath
+import_time = time.perf_counter() - t
+patterns = {'P%d' % i: ('[P%d]/dir%d_{VAR%d}' % (i // 10, i, i) if i >= 10 else 'root%d' % i) for i in range(1000)}
+t = time.perf_counter()
+tree = namedpath.NamedPathTree('/tmp', patterns)
+tree_time = time.perf_counter() - t
+names = tree.get_path_names()
+compiled = [name for name in names if tree.get_path_instance(name)._cache]
+tree.get_path('P999', {'VAR%d' % i: 'x' for i in range(1000)})
+compiled_after_solve = [name for name in names if tree.get_path_instance(name)._cache]
+modules = [m for m in ('json', 'copy', 'getpass', 'pathlib', 'shutil', 'pwd', 'grp') if m in sys.modules]
+import json
+print(json.dumps(dict(import_time=import_time, tree_time=tree_time, patterns=len(names), modules=modules,
+                      compiled=compiled, compiled_after_solve=len(compiled_after_solve))))
+'''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = [json.loads(subprocess.check_output([sys.executable, '-c', script], cwd=root).decode().strip()
+                          .splitlines()[-1]) for _ in range(5)]
+    result = results[0]
+    assert result['patterns'] == 1000
+    # no heavy modules at import and no pattern is compiled before first use
+    assert result['modules'] == []
+    assert result['compiled'] == []
+    assert 0 < result['compiled_after_solve'] < 10
+    assert statistics.median(x['import_time'] for x in results) < 0.5
+    assert statistics.median(x['tree_time'] for x in results) < 1.0
+
+
+def test_string_paths(patterns, context):
+    from pathlib import Path
+    tree = NamedPathTree(ROOT, patterns)
+    pub = tree.get_path_instance('SHOT_PUBLISH')
+    assert pub.get_short_parts() == ('publish', 'v{VERSION:03d}', '{ENTITY_NAME}_v{VERSION:03d}.{EXT}')
+    assert pub.get_relative() == '{PROJECT_NAME}/shot/{ENTITY_NAME}/publish/v{VERSION:03d}/{ENTITY_NAME}_v{VERSION:03d}.{EXT}'
+    assert pub.get_absolute() == Path(ROOT, pub.get_relative()).resolve().as_posix()
+    path = tree.get_path('SHOT_PUBLISH', context)
+    assert isinstance(path, str)
+    assert tree.get_path('SHOT_PUBLISH', context, as_path=True) == Path(path)
+    assert pub.solve(context, skip_context_errors=True) == path
+    parts = list(pub.iter_path(context, full_path=True))
+    assert parts == [Path(path).parent.parent.as_posix(), Path(path).parent.as_posix()]
+    assert list(pub.iter_path(context, full_path=True, as_path=True)) == [Path(x) for x in parts]
+    assert tree.get_path('SHOTS', dict(context, PROJECT_NAME='a//b/./c/')) == Path(ROOT, 'a/b/c/shot').as_posix()
+
+
+def test_path_levels(tmp_path, patterns, context):
+    root = tmp_path.as_posix()
+    tree = NamedPathTreeDrive(root, patterns)
+    pub = tree.get_path_instance('SHOT_PUBLISH')
+    assert [x.name for x in pub.get_parent_chain()] == ['PROJECT', 'SHOTS', 'SHOT', 'SHOT_PUBLISH']
+    root = tree.root
+    expected = [root + '/example', root + '/example/shot', root + '/example/shot/sh001',
+                root + '/example/shot/sh001/publish', root + '/example/shot/sh001/publish/v015']
+    assert list(pub.iter_path(context, full_path=True, include_parents=True)) == expected
+    assert list(pub.iter_path(context, full_path=True)) == expected[-2:]
+    levels = list(pub.iter_path_levels(dict(PROJECT_NAME='example'), skip_context_errors=True))
+    assert [x[2] for x in levels] == [True, True, False, False]
+    assert list(pub.iter_path(dict(PROJECT_NAME='example'), full_path=True, include_parents=True,
+                              skip_context_errors=True)) == expected[:2]
+    with pytest.raises(PathContextError):
+        list(pub.iter_path(dict(PROJECT_NAME='example'), full_path=True))
+    assert pub.makedirs(dict(PROJECT_NAME='example'), skip_context_errors=True) is False
+    assert os.path.isdir(expected[1]) and not os.path.exists(expected[2])
+    assert tree.get_path_instance('SHOT').makedirs(context) is True
+    assert os.path.isdir(expected[2])
+
+
+def test_materialize(tmp_path, patterns):
+    root = tmp_path.as_posix()
+    tree = NamedPathTreeDrive(root, patterns)
+    rows_file = os.path.join(root, 'shots.csv')
+    with open(rows_file, 'w') as f:
+        f.write('PROJECT_NAME,ENTITY_NAME,VERSION,EXT\n')
+        f.write('example,sh001,1,exr\nexample,sh002,2,exr\nexample,sh002,3,exr\nexample,,1,exr\n')
+    names = ['SHOT', 'SHOT_PUBLISH']
+    plan = tree.materialize(rows_file, names=names, dry_run=True)
+    assert plan['created'][:3] == [tree.root + '/example', tree.root + '/example/shot', tree.root + '/example/shot/sh001']
+    assert len(plan['created']) == 9
+    assert not os.path.exists(plan['created'][0])
+    assert [(x['row'], x['name']) for x in plan['failed_rows']] == [(3, 'SHOT'), (3, 'SHOT_PUBLISH')]
+    assert 'ENTITY_NAME' in plan['failed_rows'][0]['error']
+    result = tree.materialize(rows_file, names=names, workers=4)
+    assert sorted(result['created']) == sorted(plan['created'])
+    assert all(os.path.isdir(x) for x in result['created'])
+    assert os.path.isdir(os.path.join(tree.root, 'example/shot/sh002/publish/v003'))
+    assert not result['failed_paths']
+    result = tree.materialize([dict(PROJECT_NAME='example', ENTITY_NAME='sh001', VERSION=1, EXT='exr')], names=names)
+    assert result['created'] == [] and result['existing'] == 5
+    # same variable is typed by each pattern separately
+    typed = NamedPathTreeDrive(root, dict(
+        PROJECT='{PROJECT_NAME}',
+        SHOT={'path': '[PROJECT]/shot/{CODE:03d}', 'types': {'CODE': 'int'}},
+        TAG={'path': '[PROJECT]/tag/{CODE}', 'types': {'CODE': 'str'}},
+    ))
+    result = typed.materialize([dict(PROJECT_NAME='typed', CODE='7'), dict(PROJECT_NAME='typed', CODE='x')])
+    assert os.path.isdir(os.path.join(root, 'typed/shot/007')) and os.path.isdir(os.path.join(root, 'typed/tag/7'))
+    assert [(x['row'], x['name']) for x in result['failed_rows']] == [(1, 'SHOT')]
+    assert os.path.isdir(os.path.join(root, 'typed/tag/x'))
+
+
+def test_tree_diff(tmp_path):
+    root = tmp_path.as_posix()
+    tree = NamedPathTreeDrive(root, dict(
+        PROJECT='{PROJECT_NAME}',
+        SHOTS='[PROJECT]/shots',
+        SHOT={'path': '[SHOTS]/{ENTITY_NAME}', 'perm': '0o750'},
+        SHOT_RENDER='[SHOT]/render',
+    ))
+    contexts = [dict(PROJECT_NAME='prj', ENTITY_NAME=name) for name in ('sh001', 'sh002', 'sh003')]
+    tree.materialize(contexts)
+    assert list(tree.diff(contexts)) == []
+    shots = os.path.join(tree.root, 'prj/shots')
+    shutil.rmtree(os.path.join(shots, 'sh002'))
+    os.makedirs(os.path.join(shots, 'sh001/render/v001'))
+    os.makedirs(os.path.join(shots, 'tmp'))
+    os.chmod(os.path.join(shots, 'sh003'), 0o700)
+    result = [(x.status, os.path.relpath(x.path, shots), x.pattern_name) for x in tree.diff(contexts)]
+    assert result == [
+        ('missing', 'sh002', 'SHOT'),
+        ('missing', 'sh002/render', 'SHOT_RENDER'),
+        ('mismatch', 'sh003', 'SHOT'),
+        ('extra', 'tmp', None),
+    ]
+    assert [x.status for x in tree.diff(contexts + [dict(PROJECT_NAME='prj', ENTITY_NAME='sh004')],
+                                        names=['SHOT'])] == ['missing', 'mismatch', 'missing', 'extra']
+
+    # files of patterns are expected
+    files = NamedPathTreeDrive((tmp_path / 'files').as_posix(), dict(
+        P='{PROJECT_NAME}', F='[P]/{NAME}.txt', D='[P]/v{VERSION:03d}'))
+    ctx = dict(PROJECT_NAME='p', NAME='readme', VERSION=1)
+    files.makedirs(ctx)
+    readme = files.get_path('F', ctx)
+    assert [(x.status, x.path) for x in files.diff([ctx])] == [('missing', readme)]
+    open(readme, 'w').close()
+    assert list(files.diff([ctx])) == []
+    os.remove(readme)
+    os.makedirs(readme)
+    assert [(x.status, x.message) for x in files.diff([ctx])] == [('mismatch', 'not a file')]
+
+
+def test_tree_snapshots(patterns, context):
+    import threading
+    tree = NamedPathTree(ROOT, patterns, default_context=dict(EXT='exr'))
+    snapshot = tree.snapshot()
+    shot = tree.get_path_instance('SHOT')
+    path_v1 = tree.get_path('SHOT', context)
+    tree.update_patterns({'SHOT+': {'path': '[SHOTS]/v2/{ENTITY_NAME}'}})
+    path_v2 = tree.get_path('SHOT', context)
+    assert path_v2 != path_v1
+    assert shot.solve(context) == path_v1 and snapshot.get_path('SHOT', context) == path_v1
+    with pytest.raises(TypeError):
+        snapshot.update_patterns({'NEW': 'new'})
+    with pytest.raises(TypeError):
+        tree.default_context['EXT'] = 'jpg'
+    tree.update_default_context(dict(EXT='jpg'))
+    assert snapshot.default_context['EXT'] == 'exr' and tree.default_context['EXT'] == 'jpg'
+    context_copy = tree.get_context()
+    context_copy['EXT'] = 'png'
+    assert json.loads(json.dumps(context_copy)) == {'EXT': 'png'} and tree.default_context['EXT'] == 'jpg'
+
+    errors = []
+    stop = threading.Event()
+
+    def read():
+        while not stop.is_set():
+            try:
+                ctl = tree.get_path_instance('SHOT_PUBLISH')
+                if not ctl.solve(context).startswith((path_v1, path_v2)):
+                    errors.append(ctl.solve(context))
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for i in range(100):
+        tree.update_patterns({'SHOT': '[SHOTS]/v2/{ENTITY_NAME}' if i % 2 else '[SHOTS]/{ENTITY_NAME}'})
+    stop.set()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+
+def test_sharding(tmp_path, patterns):
+    root = tmp_path.as_posix()
+    volumes = [os.path.join(root, 'vol%d' % i) for i in range(3)]
+    patterns['SHOT'] = {'path': '[SHOTS]/{ENTITY_NAME}', 'shard': {'keys': ['ENTITY_NAME'], 'map': {'sh000': 2}}}
+    tree = NamedPathTreeDrive(os.path.join(root, 'main'), dict(patterns), shard_roots=volumes)
+    shots = ['sh%03d' % i for i in range(30)]
+    paths = [tree.get_path('SHOT_PUBLISH', dict(PROJECT_NAME='prj', ENTITY_NAME=x, VERSION=1, EXT='ma'))
+             for x in shots]
+    assert paths[0] == os.path.join(volumes[2], 'prj/shot/sh000/publish/v001/sh000_v001.ma')
+    assert {x.split('/vol')[1][0] for x in paths} == {'0', '1', '2'}
+    assert paths == [NamedPathTree(os.path.join(root, 'main'), dict(patterns), shard_roots=volumes).get_path(
+        'SHOT_PUBLISH', dict(PROJECT_NAME='prj', ENTITY_NAME=x, VERSION=1, EXT='ma')) for x in shots]
+    assert tree.get_path('ASSET', dict(PROJECT_NAME='prj', ENTITY_NAME='a')).startswith(os.path.join(root, 'main'))
+    with pytest.raises(PathContextError):
+        tree.get_path_instance('SHOT').get_base_dir({})
+    site_patterns = dict(patterns, SHOT={'path': '[SHOTS]/{ENTITY_NAME}', 'shard': {'keys': ['SITE']}})
+    site_tree = NamedPathTreeDrive(os.path.join(root, 'main'), site_patterns, shard_roots=volumes)
+    site_context = dict(PROJECT_NAME='prj', ENTITY_NAME='sh001')
+    with pytest.raises(PathContextError):
+        site_tree.get_path_instance('SHOT').makedirs(site_context)
+    # skipped context errors cut sharded levels instead of using main root
+    site_tree.makedirs(site_context, names=['SHOT'])
+    assert os.path.isdir(os.path.join(root, 'main', 'prj/shot'))
+    assert not os.path.exists(os.path.join(root, 'main', 'prj/shot/sh001'))
+    assert tree.parse(paths[5], True) == ('SHOT_PUBLISH', dict(PROJECT_NAME='prj', ENTITY_NAME='sh005',
+                                                               VERSION=1, EXT='ma'))
+    # paths on shard roots are kept absolute in index
+    assert NamedPathIndex(tree).load_manifest([paths[5]]).find('SHOT_PUBLISH') == [paths[5]]
+
+    for name in shots[:6]:
+        tree.makedirs(dict(PROJECT_NAME='prj', ENTITY_NAME=name), names=['SHOT'])
+    walked = [path for path, is_dir in tree.iter_entries()]
+    assert all(tree.get_path('SHOT', dict(PROJECT_NAME='prj', ENTITY_NAME=x)) in walked for x in shots[:6])
+    shot_paths = sorted(tree.get_path('SHOT', dict(PROJECT_NAME='prj', ENTITY_NAME=x)) for x in shots[:6])
+    assert sorted(NamedPathIndex(tree).scan().find('SHOT')) == shot_paths
+    assert sorted(NamedPathCatalog(tree, ':memory:').scan().find('SHOT')) == shot_paths
+    moves = list(tree.iter_rebalance(volumes + [os.path.join(root, 'vol3')]))
+    assert moves and all(x.pattern_name == 'SHOT' for x in moves)
+    assert all(os.path.isdir(x.old_path) and x.new_path.split('/vol')[1][0] != x.old_path.split('/vol')[1][0]
+               for x in moves)
+    assert not list(tree.iter_rebalance())
+    with pytest.raises(PathNameError):
+        list(tree.iter_rebalance(shard_rules={'UNKNOWN': {'keys': ['ENTITY_NAME']}}))
+
+
+def test_filesystem_backends(tmp_path, patterns, context):
+    patterns['SHOT'] = {'path': '[SHOTS]/{ENTITY_NAME}', 'perm': '0o750', 'users': 'artist'}
+    fs = MemoryFileSystem()
+    tree = NamedPathTreeDrive('/mnt/projects', dict(patterns), filesystem=fs)
+    tree.makedirs(context, names=['SHOT_PUBLISH'])
+    shot = tree.get_path('SHOT', context)
+    assert fs.isdir(shot) and not os.path.exists('/mnt/projects')
+    assert oct(fs.stat(shot).st_mode & 0o777) == '0o750' and fs.get_owner(shot)[0] == 'artist'
+    publish = tree.get_path('SHOT_PUBLISH', context)
+    fs.write_file(publish, b'data')
+    assert [x.status for x in tree.diff([context], names=['SHOT'])] == []
+    other = NamedPathTreeDrive('/mnt/other', dict(patterns), filesystem=fs)
+    result = tree.transfer_to(other, action='move', compact=True)
+    assert not result.failed and fs.stat(other.get_path('SHOT_PUBLISH', context)).st_size == 4
+    assert not fs.exists(publish)
+    fs.rename('/mnt/other', '/mnt/renamed')
+    assert fs.listdir('/mnt') == ['projects', 'renamed']
+
+    store_dir = (tmp_path / 'store').as_posix()
+    store = LocalObjectStore(store_dir)
+    tree = NamedPathTreeDrive('/mnt/projects', dict(patterns), filesystem=store)
+    tree.makedirs(context, names=['SHOT_PUBLISH'])
+    assert os.listdir(store_dir) == [] and not store.exists(shot)
+    store.write_file(publish, b'data')
+    assert store.isdir(shot) and store.listdir(os.path.dirname(shot)) == [os.path.basename(shot)]
+    assert [x for x, is_dir in tree.iter_entries() if not is_dir] == [publish]
+    other = NamedPathTreeDrive('/mnt/other', dict(patterns), filesystem=store)
+    tree.transfer_to(other, action='copy')
+    assert sorted(store.list_keys('mnt/')) == [x.lstrip('/') for x in (other.get_path('SHOT_PUBLISH', context),
+                                                                         publish)]
+    assert len(os.listdir(store_dir)) == 2
+
+
+@pytest.mark.parametrize('mode', ['move', 'copy', 'hardlink', 'symlink', 'reflink'])
+def test_memory_filesystem_transfer(patterns, context, mode):
+    fs = MemoryFileSystem()
+    tree = NamedPathTreeDrive('/mnt/projects', dict(patterns), filesystem=fs)
+    publish = tree.get_path('SHOT_PUBLISH', context)
+    tree.get_path('SHOT', context, create=True)
+    fs.makedirs(os.path.dirname(publish))
+    with fs.open(publish, 'wb') as f:
+        f.write(b'data')
+    other = NamedPathTreeDrive('/mnt/other', dict(patterns), filesystem=fs)
+    result = tree.transfer_to(other, action=mode, compact=True)
+    new_path = other.get_path('SHOT_PUBLISH', context)
+    assert not result.failed and not os.path.exists('/mnt/projects') and not os.path.exists('/mnt/other')
+    assert fs.read_file(new_path) == b'data' and fs.exists(publish) == (mode != 'move')
+    assert fs.islink(new_path) == (mode == 'symlink')
+    assert NamedPathIndex(other).scan().find('SHOT_PUBLISH') == [new_path]
+    with pytest.raises(TypeError):
+        FileSystem()
+
+
+@pytest.mark.parametrize('mode', ['copy', 'move'])
+def test_transfer_between_filesystems(tmp_path, patterns, context, mode):
+    patterns['SHOT_PUBLISH'].pop('users')
+    patterns['SHOT_PUBLISH'].pop('groups')
+    local = NamedPathTreeDrive((tmp_path / 'local').as_posix(), dict(patterns))
+    publish = local.get_path('SHOT_PUBLISH', context)
+    os.makedirs(os.path.dirname(publish))
+    with open(publish, 'wb') as f:
+        f.write(b'data' * 1000)
+    store = LocalObjectStore((tmp_path / 'store').as_posix())
+    remote = NamedPathTreeDrive('/bucket', dict(patterns), filesystem=store)
+    result = local.transfer_to(remote, action=mode, compact=True)
+    assert not result.failed
+    assert store.read_file(remote.get_path('SHOT_PUBLISH', context)) == b'data' * 1000
+    assert os.path.exists(publish) == (mode == 'copy')
+    with pytest.raises(ValueError):
+        local.transfer_to(remote, action='symlink')
+    with pytest.raises(ValueError):
+        local.transfer_to(remote, action=TransferAction('copy'))
+
+
+def test_parse_nearest(patterns, context):
+    tree = NamedPathTree(ROOT, patterns)
+    context = dict(context, EXT='ma')
+    for name in ('PROJECT', 'SHOT', 'SHOT_PUBLISH', 'ASSET_MODELS'):
+        path = tree.get_path(name, context)
+        assert tree.parse_nearest(path) == (name, tree.parse(path, True)[1], '')
+    shot = tree.get_path('SHOT', context)
+    match = tree.parse_nearest(shot + '/cache/tmp/file.abc')
+    assert match.name == 'SHOT' and match.remainder == 'cache/tmp/file.abc'
+    assert match.context == tree.parse(shot, True)[1]
+    publish = tree.parse_nearest(tree.get_path('SHOT_PUBLISH', context) + '/extra')
+    assert publish.name == 'SHOT_PUBLISH' and publish.context['VERSION'] == context['VERSION']
+    with pytest.raises(NoPatternMatchError):
+        tree.parse_nearest('/other/root/file')
+
+
+def test_server_client(tmp_path, context):
+    root = tmp_path.as_posix()
+    config = os.path.join(root, 'patterns.json')
+    with open(config, 'w') as f:
+        json.dump(dict(PROJECT='{PROJECT_NAME}', SHOT='[PROJECT]/{ENTITY_NAME}'), f)
+    socket_path = os.path.join(root, 'np.sock')
+    tree_root = os.path.join(root, 'projects')
+    local = NamedPathTree.load_from_files(tree_root, [config])
+    shot = local.get_path('SHOT', context)
+
+    offline = NamedPathClient(socket_path, tree_root, [config], retry_interval=0)
+    assert offline.get_path('SHOT', context) == shot and not offline.is_remote
+    with pytest.raises(ConnectionError):
+        NamedPathClient(socket_path).get_path('SHOT', context)
+
+    with NamedPathServer(socket_path, tree_root, [config], check_interval=0) as server:
+        # local fallback connects when server is started
+        assert offline.get_path('SHOT', context) == shot and offline.is_remote
+        offline.close()
+        with NamedPathClient(socket_path) as client:
+            assert client.is_remote
+            assert client.get_path('SHOT', context) == shot
+            assert client.parse(shot, True) == local.parse(shot, True)
+            assert client.parse_nearest(shot + '/cache/file') == local.parse_nearest(shot + '/cache/file')
+            results = client.batch([['get_path', 'PROJECT', context], ['parse', '/other/path']], raise_errors=False)
+            assert results[0] == local.get_path('PROJECT', context)
+            assert isinstance(results[1], NoPatternMatchError) and str(results[1]) == str(
+                NoPatternMatchError('/other/path'))
+            with pytest.raises(PathContextError):
+                client.get_path('SHOT', {})
+            os.makedirs(shot)
+            assert client.find('SHOT', {'ENTITY_NAME': context['ENTITY_NAME']}) == [shot]
+            # index without watch is rescanned after check interval
+            os.makedirs(shot + '_new')
+            assert sorted(client.find('SHOT')) == [shot, shot + '_new']
+
+            with open(config, 'w') as f:
+                json.dump(dict(PROJECT='{PROJECT_NAME}', SHOT='[PROJECT]/shots/{ENTITY_NAME}'), f)
+            os.utime(config, ns=(0, os.stat(config).st_mtime_ns + 10 ** 9))
+            assert client.get_path('SHOT', context) == os.path.join(os.path.dirname(shot), 'shots',
+                                                                    context['ENTITY_NAME'])
+    assert not os.path.exists(socket_path)
+
+
+def test_usage(tmp_path, patterns, context):
+    root = tmp_path.as_posix()
+    tree = NamedPathTree(root, patterns)
+    for name, size in (('sh001', 10), ('sh002', 100)):
+        ctx = dict(context, ENTITY_NAME=name)
+        publish = tree.get_path('SHOT_PUBLISH', ctx)
+        os.makedirs(os.path.join(os.path.dirname(publish), 'cache', 'deep'))
+        for path in (publish, os.path.join(os.path.dirname(publish), 'cache', 'deep', 'tmp.bin')):
+            with open(path, 'wb') as f:
+                f.write(b'0' * size)
+        with open(os.path.join(tree.get_path('SHOT', ctx), 'notes.txt'), 'wb') as f:
+            f.write(b'0' * size)
+    with open(os.path.join(root, 'junk.txt'), 'wb') as f:
+        f.write(b'0' * 5)
+    table = tree.usage(group_by=('ENTITY_NAME',), workers=4)
+    by_key = {(x.pattern_name, x.values): x[2:] for x in table}
+    # shot dir, notes and unmatched content of publish dir
+    assert by_key[('SHOT', ('sh001',))] == (2, 5, 20)
+    assert by_key[('SHOT_PUBLISH', ('sh002',))] == (1, 0, 100)
+    # project dir and file matched as project name
+    assert by_key[('PROJECT', (None,))] == (1, 1, 5)
+    assert [x.values for x in tree.usage(names=['SHOT_PUBLISH'])] == [('sh001',), ('sh002',)]
+    partial = list(tree.iter_usage(partial_dirs=2, workers=1))
+    assert len(partial) > 1 and partial[-1] == table
+    # only entries of root are parsed from root, others inherit match of their directory
+    parents = []
+    parse_nearest = tree._parse_nearest
+    tree._parse_nearest = lambda path, parent=None: parents.append(parent) or parse_nearest(path, parent)
+    assert tree.usage(group_by=('ENTITY_NAME',), workers=1) == table
+    assert parents.count(None) == 2 and len(parents) > 2
+
+
+def test_clear_empty_dirs(tmp_path, patterns, context):
+    root = tmp_path.as_posix()
+    patterns['ASSET_MODELS'] = {'path': '[ASSET]/models', 'protected': True}
+    patterns['SHOT_PUBLISH'] = {'path': '[SHOT]/publish/v{VERSION:03d}/{ENTITY_NAME}_v{VERSION:03d}.{EXT}'}
+    tree = NamedPathTreeDrive(root, dict(patterns))
+    for name in ('sh001', 'sh002', 'sh003'):
+        tree.makedirs(dict(context, ENTITY_NAME=name), names=['SHOT_PUBLISH', 'ASSET_MODELS'])
+    shot = tree.get_path('SHOT', context)
+    publish_dir = os.path.dirname(tree.get_path('SHOT_PUBLISH', dict(context, ENTITY_NAME='sh002')))
+    with open(os.path.join(publish_dir, 'file.ma'), 'w'):
+        pass
+    os.makedirs(os.path.join(shot, 'cache', 'deep'))
+
+    planned = tree.clear_empty_dirs(dry_run=True)
+    assert all(os.path.isdir(x) for x in planned)
+    removed = tree.clear_empty_dirs(workers=4)
+    assert sorted(removed) == sorted(planned)
+    shot3 = tree.get_path('SHOT', dict(context, ENTITY_NAME='sh003'))
+    assert shot3 in removed and not os.path.exists(shot3)
+    # unmatched dir keeps shot, file keeps publish, protected models are kept
+    assert os.path.isdir(os.path.join(shot, 'cache', 'deep')) and not os.path.exists(os.path.join(shot, 'publish'))
+    assert os.path.isdir(publish_dir)
+    assert os.path.isdir(tree.get_path('ASSET_MODELS', context))
+
+    tree.makedirs(dict(context, ENTITY_NAME='sh004'), names=['SHOT_PUBLISH'])
+    shot4 = tree.get_path('SHOT', dict(context, ENTITY_NAME='sh004'))
+    removed = tree.clear_empty_dirs(dict(context, ENTITY_NAME='sh004'), names=['SHOT_PUBLISH'])
+    assert removed == [shot4 + '/publish/v015', shot4 + '/publish'] and os.path.isdir(shot4)
+    assert tree.clear_empty_dirs(dict(context, ENTITY_NAME='sh004'), names=['SHOT']) == [shot4]
+
+
+def test_allocate_next(tmp_path, patterns, context):
+    import threading
+    root = tmp_path.as_posix()
+    context = dict(PROJECT_NAME='prj', ENTITY_NAME='sh001')
+    trees = [NamedPathTree(root, dict(patterns)) for _ in range(4)]
+    tree = trees[0]
+    publish = os.path.dirname(os.path.dirname(tree.get_path('SHOT_PUBLISH', dict(context, VERSION=1, EXT='ma'))))
+    os.makedirs(os.path.join(publish, 'v004'))
+    os.makedirs(os.path.join(publish, 'tmp'))
+    assert tree.allocate_next('SHOT_PUBLISH', context) == 5
+    assert os.path.isdir(os.path.join(publish, 'v005'))
+    os.makedirs(os.path.join(publish, 'v006'))
+    # cached value collides, directory is listed again
+    assert tree.allocate_next('SHOT_PUBLISH', context) == 7
+
+    results = []
+
+    def allocate(tr):
+        for _ in range(10):
+            results.append(tr.allocate_next('SHOT_PUBLISH', context))
+
+    threads = [threading.Thread(target=allocate, args=(tr,)) for tr in trees]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results) == list(range(8, 48))
+    with pytest.raises(ValueError):
+        NamedPathTree(root, dict(patterns, FILE='[SHOT]/file_v{VERSION:03d}.ma')).allocate_next('FILE', context)
+
+
+def test_as_regex_partial_context(patterns, context):
+    import re
+    tree = NamedPathTree(ROOT, patterns)
+    shot = tree.get_path_instance('SHOT')
+    # missing variables stay regex groups
+    regex = re.compile(shot.as_regex(tree.root, context={'PROJECT_NAME': context['PROJECT_NAME']}))
+    match = regex.match(tree.get_path('SHOT', context))
+    assert match and match.groupdict() == {'ENTITY_NAME': context['ENTITY_NAME']}
+    assert not regex.match(tree.get_path('SHOT', dict(context, PROJECT_NAME='other')))
+
+
+def test_parse_optional_blocks():
+    tree = NamedPathTree(ROOT, dict(
+        RENDER={'path': '{PROJECT_NAME}/{NAME}<_v{VERSION:03d}><.{FRAME:04d}>.{EXT}',
+                'types': {'VERSION': 'int', 'FRAME': 'int'}, 'regex': {'NAME': '[a-z]+'}}))
+    for optional in ({}, {'VERSION': 3}, {'FRAME': 12}, {'VERSION': 3, 'FRAME': 12}):
+        context = dict(PROJECT_NAME='prj', NAME='box', EXT='exr', **optional)
+        path = tree.get_path('RENDER', context)
+        assert tree.parse(path, True) == ('RENDER', context)
+        assert tree.parse_nearest(path + '/tmp').context == context
+    assert tree.get_path_instance('RENDER').remove_optional('{A}<_{B}><.{C}>', {'C': 1}) == '{A}.{C}'
+
+
+def test_path_catalog(tmp_path, patterns):
+    tree = NamedPathTree(tmp_path.as_posix(), patterns)
+    for entity, versions in (('sh001', (1, 2)), ('sh002', (1, 5, 12, 14))):
+        for version in versions:
+            path = tree.get_path('SHOT_PUBLISH', dict(PROJECT_NAME='prj', ENTITY_NAME=entity, VERSION=version, EXT='exr'))
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write('x' * version)
+    db_path = tmp_path / 'catalog.db'
+    with NamedPathCatalog(tree, db_path) as catalog:
+        catalog.scan()
+        assert 'ENTITY_NAME' in catalog.columns and 'VERSION' in catalog.columns
+        assert catalog.list_values('SHOT', 'ENTITY_NAME') == ['sh001', 'sh002']
+        found = catalog.find('SHOT_PUBLISH', {'ENTITY_NAME': 'sh002'}, where=[('VERSION', '>', 4)])
+        assert found == [tree.get_path('SHOT_PUBLISH', dict(PROJECT_NAME='prj', ENTITY_NAME='sh002', VERSION=v,
+                                                            EXT='exr')) for v in (5, 12, 14)]
+        assert catalog.list_values('SHOT_PUBLISH', 'VERSION', where=[('VERSION', 'in', [2, 12])]) == [2, 12]
+        path, ctx = catalog.latest('SHOT_PUBLISH', {'ENTITY_NAME': 'sh002'})
+        assert ctx['VERSION'] == 14 and path == tree.get_path('SHOT_PUBLISH', ctx)
+        assert catalog.get_usage('SHOT_PUBLISH', {'ENTITY_NAME': 'sh002'}) == (4, 32)
+        with pytest.raises(ValueError):
+            catalog.find('SHOT_PUBLISH', where=[('VERSION', 'drop', 1)])
+        with pytest.raises(ValueError):
+            catalog.find('SHOT_PUBLISH', {'UNKNOWN': 1})
+
+        shot_path = tree.get_path('SHOT', dict(PROJECT_NAME='prj', ENTITY_NAME='sh001'))
+        shutil.rmtree(shot_path)
+        path = tree.get_path('SHOT_PUBLISH', dict(PROJECT_NAME='prj', ENTITY_NAME='sh001', VERSION=7, EXT='exr'))
+        os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+        catalog.refresh(shot_path)
+        assert catalog.list_values('SHOT_PUBLISH', 'VERSION', {'ENTITY_NAME': 'sh001'}) == [7]
+        assert catalog.list_values('SHOT_PUBLISH', 'VERSION', {'ENTITY_NAME': 'sh002'}) == [1, 5, 12, 14]
+
+    # reopened database keeps entries
+    with NamedPathCatalog(tree, db_path) as catalog:
+        assert catalog.latest('SHOT_PUBLISH', {'ENTITY_NAME': 'sh001'})[0] == path
+        catalog.load_manifest(['prj/shot/sh005/publish/v003/sh005_v003.exr'])
+        assert catalog.list_values('SHOT', 'ENTITY_NAME') == ['sh001', 'sh002']
+        assert catalog.list_values('SHOT_PUBLISH', 'ENTITY_NAME') == ['sh001', 'sh002', 'sh005']
+
+
+def test_path_catalog_column_types(tmp_path, monkeypatch):
+    tree = NamedPathTree(tmp_path.as_posix(), dict(
+        PROJECT='{PROJECT_NAME}',
+        TAKE='[PROJECT]/take/t{VERSION:03d}',
+        NOTE='[PROJECT]/note/n{NOTE}.txt',
+    ))
+    for version in (9, 10, 11):
+        os.makedirs(tree.get_path('TAKE', dict(PROJECT_NAME='prj', VERSION=version)))
+    os.makedirs(os.path.join(tree.root, 'prj/note'))
+    for note in ('9', '10'):
+        open(tree.get_path('NOTE', dict(PROJECT_NAME='prj', NOTE=note)), 'w').close()
+    catalog = NamedPathCatalog(tree).scan()
+    # format spec makes numeric column, text of path is stored as number
+    assert catalog.latest('TAKE')[1]['VERSION'] == 11
+    assert catalog.list_values('TAKE', 'VERSION', where=[('VERSION', '>=', 10)]) == [10, 11]
+    # untyped variable is text
+    assert catalog.list_values('NOTE', 'NOTE') == ['10', '9']
+    with pytest.raises(ValueError):
+        catalog.find('NOTE', where=[('NOTE', '>', 9)])
+    with pytest.raises(ValueError):
+        catalog.latest('NOTE', key='NOTE')
+
+    # failed scan keeps previous entries
+    count = len(catalog)
+    take = tree.get_path('TAKE', dict(PROJECT_NAME='prj', VERSION=10))
+
+    def make_row(path, st=None):
+        if path == take:
+            raise RuntimeError('Injected failure')
+        return original(path, st)
+
+    original = catalog._make_row
+    monkeypatch.setattr(catalog, '_make_row', make_row)
+    monkeypatch.setattr(catalog, '_batch_size', 1)
+    with pytest.raises(RuntimeError):
+        catalog.refresh(os.path.join(tree.root, 'prj'))
+    assert len(catalog) == count